@@ -0,0 +1,438 @@
+import argparse
+import datetime
+import glob
+import itertools
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# opciones de SAR_Indexer.py que combina el benchmark de construccion
+INDEX_FLAGS = ['-S', '-P', '-M', '-O']
+
+# palabras mas frecuentes del castellano, ocupan los primeros puestos de la distribucion de Zipf
+COMMON_WORDS = ('de la que el en y a los del se las por un para con no una su al lo como más pero sus le ya o '
+                'este sí porque esta entre cuando muy sin sobre también me hasta hay donde quien desde todo nos '
+                'durante todos uno les ni contra otros ese eso ante ellos e esto antes algunos qué unos otro '
+                'otras otra él tanto esa estos mucho quienes nada muchos cual poco ella estar estas algunas algo '
+                'casa cosa isla valencia cultura historia lenguaje programación sistema información años país '
+                'ciudad guerra gobierno parte mundo nombre forma desarrollo estado grupo música ejemplo').split()
+# silabas para formar el resto del vocabulario
+SYLLABLES = ('ba be bi bo ca ce ci co cu da de di do du fa fe fi ga go gu la le li lo lu ma me mi mo mu na ne '
+             'ni no nu pa pe pi po pu ra re ri ro ru sa se si so su ta te ti to tu va ve vi vo za ción sión '
+             'es en an in on al el ar er ir or tra tre pro pre gra bra cla cha che chi lla lle ña ño rá ré rí '
+             'ró tá té tí tó').split()
+
+
+def git_revision() -> str:
+    """Devuelve el commit actual del repositorio, o '' si no se puede obtener"""
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip()
+    except OSError:
+        return ''
+
+
+def save_result(result: dict, output: str):
+    """Muestra el resultado en formato json y, si se indica un fichero, lo añade como una línea más"""
+    result = dict(result, date=datetime.datetime.now().isoformat(timespec='seconds'), revision=git_revision())
+    print(json.dumps(result, ensure_ascii=False))
+    if output is not None:
+        with open(output, 'a', encoding='utf-8') as fh:
+            print(json.dumps(result, ensure_ascii=False), file=fh)
+
+
+def bench_startup(args) -> dict:
+    """
+    Mide el tiempo de pared de "python SAR_Searcher.py index -C -Q query",
+    es decir, lo que paga una consulta de conteo desde que arranca el proceso.
+    """
+    searcher = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SAR_Searcher.py')
+    cmd = [sys.executable, searcher, args.index, '-C', '-Q', args.query]
+    times = []
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - t0)
+    return {'benchmark': 'startup', 'index': args.index, 'query': args.query, 'repeat': args.repeat,
+            'min': min(times), 'median': statistics.median(times), 'max': max(times)}
+
+
+def json_files(root: str) -> list:
+    """Devuelve los ficheros .json de un directorio (o el propio fichero) en el orden en que los indexa index_dir"""
+    if os.path.isfile(root):
+        return [root]
+    return [os.path.join(d, f) for d, _, files in os.walk(root) for f in sorted(files) if f.endswith('.json')]
+
+
+def bench_tokenize(args) -> dict:
+    """
+    Compara los tokens/s de la tokenizacion por campos (tokenize_fields, cada fragmento una vez)
+    con la anterior (parse_article + tokenize de 'all', 'title', 'summary' y 'section-name').
+    """
+    from SAR_lib import SAR_Indexer
+
+    indexer = SAR_Indexer()
+    indexer.multifield = True
+    fields = [field for field, tokenize in indexer.fields if tokenize]
+    lines = [line for filename in json_files(args.dir) for line in open(filename, encoding='utf-8')]
+    articles = [json.loads(line) for line in lines]
+    ntokens = sum(len(indexer.tokenize(text)) for art in articles for _, text in indexer.get_segments(art))
+
+    def per_field():
+        for line in lines:
+            art = indexer.parse_article(line)
+            for field in fields:
+                indexer.tokenizer.sub(' ', art[field].lower()).split()
+
+    def segments():
+        for line in lines:
+            indexer.tokenize_fields(json.loads(line))
+
+    result = {'benchmark': 'tokenize', 'dir': args.dir, 'articles': len(lines), 'tokens': ntokens}
+    for name, fnc in (('per_field', per_field), ('segments', segments)):
+        times = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            fnc()
+            times.append(time.perf_counter() - t0)
+        result[name + '_tokens_per_s'] = ntokens / min(times)
+    return result
+
+
+class ZipfWords:
+    """Generador de palabras con una distribucion de Zipf sobre un vocabulario parecido al castellano"""
+
+    def __init__(self, size: int, rng: random.Random, exponent: float = 1.0):
+        vocabulary = list(COMMON_WORDS)
+        seen = set(vocabulary)
+        while len(vocabulary) < size:
+            word = ''.join(rng.choice(SYLLABLES) for _ in range(rng.choice((2, 2, 3, 3, 3, 4, 5))))
+            if word not in seen:
+                seen.add(word)
+                vocabulary.append(word)
+        self.vocabulary = vocabulary
+        self.cum_weights = list(itertools.accumulate(1 / rank ** exponent for rank in range(1, size + 1)))
+        self.rng = rng
+
+    def words(self, k: int) -> list:
+        return self.rng.choices(self.vocabulary, cum_weights=self.cum_weights, k=k)
+
+    def text(self, nwords: int) -> str:
+        """Texto de "nwords" palabras en frases de 8 a 25 palabras"""
+        words = self.words(nwords)
+        sentences = []
+        pos = 0
+        while pos < len(words):
+            n = self.rng.randint(8, 25)
+            sentence = ' '.join(words[pos:pos + n])
+            sentences.append(sentence[:1].upper() + sentence[1:] + '.')
+            pos += n
+        return ' '.join(sentences)
+
+    def name(self, nwords: int) -> str:
+        return ' '.join(word.capitalize() for word in self.words(nwords))
+
+
+def synthetic_article(artid: int, words: ZipfWords, rng: random.Random) -> dict:
+    """Artículo sintetico con el mismo formato que SAR_Wiki_Crawler.parse_wikipedia_textual_content"""
+    title = words.name(rng.randint(1, 4))
+    article = {
+        'url': f"https://es.wikipedia.org/wiki/{title.replace(' ', '_')}_{artid}",
+        'title': title,
+        'summary': words.text(rng.randint(30, 150)),
+        'sections': [],
+    }
+    for _ in range(rng.randint(0, 8)):
+        section = {'name': words.name(rng.randint(1, 3)), 'text': words.text(rng.randint(40, 400)),
+                   'subsections': []}
+        for _ in range(rng.choice((0, 0, 0, 1, 2, 3))):
+            section['subsections'].append({'name': words.name(rng.randint(1, 3)),
+                                           'text': words.text(rng.randint(30, 250))})
+        article['sections'].append(section)
+    return article
+
+
+def generate_corpus(base_filename: str, articles: int, batch_size: int, vocabulary: int, seed: int):
+    """
+    Escribe "articles" artículos sinteticos en ficheros json lines de "batch_size" artículos,
+    con los mismos nombres de fichero que SAR_Wiki_Crawler.save_documents.
+    """
+    from SAR_Crawler_lib import SAR_Wiki_Crawler
+
+    rng = random.Random(seed)
+    words = ZipfWords(vocabulary, rng)
+    crawler = SAR_Wiki_Crawler()
+    total_files = (articles + batch_size - 1) // batch_size
+    for num_file in range(1, total_files + 1):
+        first = (num_file - 1) * batch_size
+        documents = [synthetic_article(artid, words, rng)
+                     for artid in range(first + 1, min(articles, first + batch_size) + 1)]
+        crawler.save_documents(documents, base_filename, num_file, total_files)
+
+
+def bench_generate(args) -> dict:
+    """Genera un corpus sintetico (ver generate_corpus)"""
+    if not args.out_base_filename.endswith('.json'):
+        raise ValueError('Debe de ser un fichero con extensión .json')
+    t0 = time.perf_counter()
+    generate_corpus(args.out_base_filename, args.articles, args.batch_size, args.vocabulary, args.seed)
+    return {'benchmark': 'generate', 'articles': args.articles, 'batch_size': args.batch_size,
+            'vocabulary': args.vocabulary, 'seed': args.seed, 'time_s': time.perf_counter() - t0}
+
+
+def bench_scale(args) -> dict:
+    """
+    Curvas de escalado: genera corpus sinteticos de cada tamaño y mide la construccion
+    del indice con las opciones indicadas.
+    """
+    flags = ['-' + f for f in args.flags]
+    runs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            corpus = os.path.join(tmp, f'synthetic_{size}')
+            os.mkdir(corpus)
+            generate_corpus(os.path.join(corpus, 'synthetic.json'), size, args.batch_size, args.vocabulary, args.seed)
+            run = {'articles': size}
+            run.update(build_index(corpus, os.path.join(tmp, 'index.bin'), flags))
+            runs.append(run)
+            print(f"{size}: {run['build_s']:.2f}s", file=sys.stderr)
+    return {'benchmark': 'scale', 'flags': args.flags, 'vocabulary': args.vocabulary, 'seed': args.seed,
+            'runs': runs}
+
+
+def percentile(values: list, p: float) -> float:
+    """Percentil p (0-100) de una lista de valores, por el metodo del rango mas cercano"""
+    values = sorted(values)
+    pos = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return values[pos]
+
+
+def query_class(query: str, stemming: bool) -> str:
+    """Clase de una consulta para agrupar las latencias: stemmed, phrase, wildcard, multifield, not o plain"""
+    if stemming:
+        return 'stemmed'
+    if '"' in query:
+        return 'phrase'
+    if '*' in query or '?' in query:
+        return 'wildcard'
+    if ':' in query:
+        return 'multifield'
+    if 'not' in query.lower().split():
+        return 'not'
+    return 'plain'
+
+
+def build_index(corpus: str, filename: str, flags: list) -> dict:
+    """
+    Construye un indice en un proceso aparte con SAR_Indexer.py y devuelve
+    el tiempo de construccion, el pico de memoria residente y el tamaño del fichero.
+    El pico de memoria lo mide el propio indexador (--metrics), es None si el sistema no lo permite.
+    """
+    indexer = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SAR_Indexer.py')
+    metrics = filename + '.metrics.json'
+    t0 = time.perf_counter()
+    proc = subprocess.run([sys.executable, indexer, corpus, filename, '--metrics', metrics] + flags,
+                          stdout=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - t0
+    if proc.returncode != 0:
+        raise RuntimeError(f'SAR_Indexer.py {corpus} {" ".join(flags)} failed with code {proc.returncode}')
+    with open(metrics, encoding='utf-8') as fh:
+        peak = json.load(fh)['peak_memory']
+    os.remove(metrics)
+    return {'build_s': elapsed, 'peak_memory': peak, 'size_bytes': os.path.getsize(filename)}
+
+
+def replay_queries(filename: str, queries: list, stemming: bool, repeat: int) -> dict:
+    """
+    Carga el indice y resuelve cada consulta "repeat" veces.
+    Devuelve las latencias (p50, p95, p99 en ms) por clase de consulta y, en "failures",
+    las consultas que han fallado con su error, que tambien se muestran por stderr.
+    """
+    from SAR_lib import SAR_Indexer
+
+    searcher = SAR_Indexer()
+    searcher.load_info(filename)
+    modes = [False, True] if stemming else [False]
+    latencies = {}
+    failures = []
+    for use_stemming in modes:
+        searcher.set_stemming(use_stemming)
+        for query in queries:
+            times = []
+            try:
+                for _ in range(repeat):
+                    t0 = time.perf_counter()
+                    searcher.solve_query(query)
+                    times.append(time.perf_counter() - t0)
+            except Exception as e:
+                # p.ej. consultas con campos sobre un indice sin multifield
+                failures.append({'query': query, 'stemming': use_stemming, 'error': f'{type(e).__name__}: {e}'})
+                print(f"{filename}: query {query!r} failed: {failures[-1]['error']}", file=sys.stderr)
+                continue
+            latencies.setdefault(query_class(query, use_stemming), []).extend(times)
+    res = {'failures': failures}
+    for qclass, times in sorted(latencies.items()):
+        res[qclass] = {'n': len(times)}
+        for p in (50, 95, 99):
+            res[qclass][f'p{p}_ms'] = percentile(times, p) * 1000
+    return res
+
+
+def bench_build(args) -> dict:
+    """
+    Construye indices de cada corpus con todas las combinaciones de -S/-P/-M/-O y
+    repite las consultas de los ficheros de pruebas sobre cada uno.
+    """
+    queries = []
+    for filename in sorted(glob.glob(os.path.join(args.queries, '*.txt'))):
+        with open(filename, encoding='utf-8') as fh:
+            queries += [q for q in fh.read().split('\n') if len(q) > 0 and q[0] != '#']
+    queries = list(dict.fromkeys(queries))
+
+    runs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for corpus in args.corpus:
+            for n in range(len(INDEX_FLAGS) + 1):
+                for flags in itertools.combinations(INDEX_FLAGS, n):
+                    filename = os.path.join(tmp, 'index.bin')
+                    run = {'corpus': corpus, 'flags': ''.join(f[1] for f in flags)}
+                    run.update(build_index(corpus, filename, list(flags)))
+                    run['queries'] = replay_queries(filename, queries, '-S' in flags, args.repeat)
+                    runs.append(run)
+                    print(f"{corpus} {run['flags'] or '-'}: {run['build_s']:.2f}s", file=sys.stderr)
+    return {'benchmark': 'build', 'repeat': args.repeat, 'runs': runs}
+
+
+def sample_phrases(corpus: str, n: int, seed: int) -> list:
+    """
+    Elige "n" frases de 2 a 4 terminos consecutivos de fragmentos al azar del corpus,
+    como consultas entre comillas. Todas tienen al menos un resultado.
+    """
+    from SAR_lib import SAR_Indexer
+
+    indexer = SAR_Indexer()
+    rng = random.Random(seed)
+    segments = []
+    for filename in json_files(corpus):
+        for _, article in indexer.iter_articles(filename):
+            segments.extend(tokens for tokens in (indexer.tokenize(text) for _, text in indexer.get_segments(article))
+                            if len(tokens) >= 4)
+    phrases = []
+    for _ in range(n):
+        tokens = rng.choice(segments)
+        length = rng.choice((2, 2, 2, 3, 3, 4))
+        pos = rng.randrange(len(tokens) - length + 1)
+        phrases.append('"' + ' '.join(tokens[pos:pos + length]) + '"')
+    return phrases
+
+
+def bench_phrase(args) -> dict:
+    """
+    Compromiso tamaño/latencia del indice de biwords: construye el indice sin biwords y con
+    biwords podados con cada frecuencia minima y repite sobre cada uno las frases de los ficheros
+    de pruebas y frases elegidas al azar del corpus (ver sample_phrases).
+    """
+    queries = []
+    for filename in sorted(glob.glob(os.path.join(args.queries, '*.txt'))):
+        with open(filename, encoding='utf-8') as fh:
+            queries += [q for q in fh.read().split('\n') if len(q) > 0 and q[0] != '#' and '"' in q]
+    queries = list(dict.fromkeys(queries + sample_phrases(args.corpus, args.phrases, args.seed)))
+    flags = ['-' + f for f in args.flags]
+
+    runs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for min_df in [None] + args.min_df:
+            filename = os.path.join(tmp, 'index.bin')
+            extra = [] if min_df is None else ['-W', '--biword-min-df', str(min_df)]
+            run = {'biword_min_df': min_df}
+            run.update(build_index(args.corpus, filename, flags + extra))
+            run['queries'] = replay_queries(filename, queries, False, args.repeat)
+            runs.append(run)
+            print(f"biword min df {min_df}: {run['size_bytes']} bytes", file=sys.stderr)
+    return {'benchmark': 'phrase', 'corpus': args.corpus, 'flags': args.flags, 'queries': len(queries),
+            'repeat': args.repeat, 'runs': runs}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmarks of the indexer and the searcher.')
+    parser.add_argument('-o', '--output', dest='output', type=str, default=None,
+                        help='append the results (one json per line) to this file.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    startup = subparsers.add_parser('startup', help='wall time of a count query from a fresh process.')
+    startup.add_argument('index', type=str, help='name of the index.')
+    startup.add_argument('-Q', '--query', dest='query', type=str, default='casa', help='query.')
+    startup.add_argument('-r', '--repeat', dest='repeat', type=int, default=10,
+                         help='number of runs.')
+    startup.set_defaults(func=bench_startup)
+
+    tokenize = subparsers.add_parser('tokenize', help='tokens/s of the multifield tokenization.')
+    tokenize.add_argument('dir', type=str, nargs='?', default='python_100',
+                          help='directory with the Wikipedia articles.')
+    tokenize.add_argument('-r', '--repeat', dest='repeat', type=int, default=5,
+                          help='number of runs.')
+    tokenize.set_defaults(func=bench_tokenize)
+
+    build = subparsers.add_parser('build', help='index build time, memory and size, and query latency '
+                                                 'for every combination of index options.')
+    build.add_argument('-c', '--corpus', dest='corpus', action='append', default=None,
+                       help='directory with the Wikipedia articles (can be repeated).')
+    build.add_argument('-q', '--queries', dest='queries', type=str, default='pruebas',
+                       help='directory with the query files.')
+    build.add_argument('-r', '--repeat', dest='repeat', type=int, default=5,
+                       help='runs of each query.')
+    build.set_defaults(func=bench_build)
+
+    generate = subparsers.add_parser('generate', help='write a synthetic corpus in the crawler format.')
+    generate.add_argument('out_base_filename', type=str,
+                          help='base name of the .json files (as SAR_Crawler.py --out-base-filename).')
+    generate.add_argument('-n', '--articles', dest='articles', type=int, default=1000,
+                          help='number of articles.')
+    generate.add_argument('--batch-size', dest='batch_size', type=int, default=1000,
+                          help='articles per file.')
+    generate.add_argument('--vocabulary', dest='vocabulary', type=int, default=200000,
+                          help='vocabulary size.')
+    generate.add_argument('--seed', dest='seed', type=int, default=0, help='random seed.')
+    generate.set_defaults(func=bench_generate)
+
+    scale = subparsers.add_parser('scale', help='index build time, memory and size over synthetic corpora '
+                                                 'of increasing size.')
+    scale.add_argument('sizes', type=int, nargs='+', help='number of articles of each corpus.')
+    scale.add_argument('-f', '--flags', dest='flags', type=str, default='',
+                       help='SAR_Indexer.py options, e.g. SPM.')
+    scale.add_argument('--batch-size', dest='batch_size', type=int, default=1000,
+                       help='articles per file.')
+    scale.add_argument('--vocabulary', dest='vocabulary', type=int, default=200000,
+                       help='vocabulary size.')
+    scale.add_argument('--seed', dest='seed', type=int, default=0, help='random seed.')
+    scale.set_defaults(func=bench_scale)
+
+    phrase = subparsers.add_parser('phrase', help='index size and phrase query latency without biwords and '
+                                                  'with biwords pruned at several document frequencies.')
+    phrase.add_argument('corpus', type=str, nargs='?', default='python_100',
+                        help='directory with the Wikipedia articles.')
+    phrase.add_argument('-f', '--flags', dest='flags', type=str, default='M',
+                        help='other SAR_Indexer.py options, e.g. SM.')
+    phrase.add_argument('--min-df', dest='min_df', type=int, nargs='+', default=[1, 2, 5],
+                        help='minimum document frequency of the biwords of each index.')
+    phrase.add_argument('-q', '--queries', dest='queries', type=str, default='pruebas',
+                        help='directory with the query files, their phrase queries are included.')
+    phrase.add_argument('-n', '--phrases', dest='phrases', type=int, default=200,
+                        help='number of phrases sampled from the corpus.')
+    phrase.add_argument('-r', '--repeat', dest='repeat', type=int, default=5,
+                        help='runs of each query.')
+    phrase.add_argument('--seed', dest='seed', type=int, default=0, help='random seed.')
+    phrase.set_defaults(func=bench_phrase)
+
+    args = parser.parse_args()
+    if args.benchmark == 'build' and args.corpus is None:
+        args.corpus = ['python_100', 'tests/100', 'tests/200']
+    save_result(args.func(args), args.output)
@@ -40,20 +40,65 @@ if __name__ == "__main__":
         help="Profundidad máxima de captura"
     )
 
+    parser.add_argument(
+        "--metadata", help=(
+            "Fichero json con el ETag, Last-Modified y hash de cada URL capturada. "
+            "Si existe, las páginas que no han cambiado desde la captura anterior "
+            "no se vuelven a procesar ni a guardar"
+        )
+    )
+
+    parser.add_argument(
+        "--archive", help=(
+            "Archivo comprimido de solo añadir donde se guarda el html de cada "
+            "página capturada, para poder repetir la extracción (--from-archive)"
+        )
+    )
+    parser.add_argument(
+        "--from-archive", help=(
+            "Extrae los documentos de las páginas de un archivo (--archive) "
+            "en lugar de capturarlas"
+        )
+    )
+    parser.add_argument(
+        "--processes", type=int,
+        help="Número de procesos con --from-archive, por defecto uno por CPU"
+    )
+    parser.add_argument(
+        "--dedup", type=float, metavar="SIM",
+        help=(
+            "Descarta los artículos casi iguales a uno ya capturado: fracción "
+            "mínima de bits iguales de sus huellas SimHash (por ejemplo 0.95)"
+        )
+    )
+
     args = parser.parse_args()
 
-    if args.initial_url is None and args.urls_filename is None:
+    if args.initial_url is None and args.urls_filename is None and args.from_archive is None:
         raise ValueError((
-            "Se debe especificar la dirección inicial (--initial-url) o"
-            " un fichero de direcciones (--urls-filename)"
+            "Se debe especificar la dirección inicial (--initial-url),"
+            " un fichero de direcciones (--urls-filename) o un archivo de"
+            " páginas (--from-archive)"
         ))
 
     if not args.out_base_filename.endswith(".json"):
         raise ValueError("Debe de ser un fichero con extensión .json")
 
     crawler = SAR_Wiki_Crawler()
+    if args.metadata is not None:
+        crawler.load_metadata(args.metadata)
+    if args.archive is not None:
+        crawler.open_archive(args.archive)
+    if args.dedup is not None:
+        crawler.set_dedup(args.dedup)
 
-    if args.initial_url is not None:
+    if args.from_archive is not None:
+        crawler.extract_from_archive(
+            args.from_archive, args.document_limit, args.out_base_filename,
+            args.batch_size, args.processes
+        )
+
+    elif args.initial_url is not None:
         crawler.wikipedia_crawling_from_url(
             args.initial_url, args.document_limit, args.out_base_filename,
             args.batch_size, args.max_depth_level
@@ -64,3 +109,6 @@ if __name__ == "__main__":
             args.urls_filename, args.document_limit,
             args.out_base_filename, args.batch_size
         )
+
+    if args.dedup is not None:
+        print(f"{len(crawler.near_duplicates)} artículos casi duplicados descartados")
@@ -10,13 +10,132 @@ from urllib.parse import urljoin
 import json
 import math
 import os
+import hashlib
+import gzip
+from datetime import datetime, timezone
+from multiprocessing import Pool
+
+from SAR_Dedup_lib import SimHashIndex, article_terms
+
+# Segundos de espera máximos de cada petición (conexión y lectura)
+REQUEST_TIMEOUT = 10
+
+
+class SAR_Page_Archive:
+    """Archivo comprimido de solo añadir con el html de las páginas capturadas.
+
+    Cada página es un registro tipo WARC (cabeceras WARC/1.0 + html) comprimido como
+    un miembro gzip independiente; el Content-Type lleva la codificación de la respuesta, de forma que se puede leer cualquier registro
+    descomprimiendo solo sus bytes. En el fichero "<archivo>.idx" se añade una línea
+    url<TAB>posición<TAB>longitud por registro.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.index_filename = filename + ".idx"
+
+    def append(self, url: str, html: bytes, encoding: Optional[str] = None):
+        """Añade el html de una página al final del archivo
+
+        Args:
+            url (str): Dirección de la página
+            html (bytes): Contenido de la respuesta, sin decodificar
+            encoding (Optional[str]): Codificación con la que se decodificó la respuesta
+        """
+        content_type = "text/html" if encoding is None else f"text/html; charset={encoding}"
+        header = (
+            "WARC/1.0\r\n"
+            "WARC-Type: response\r\n"
+            f"WARC-Target-URI: {url}\r\n"
+            f"WARC-Date: {datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(html)}\r\n\r\n"
+        ).encode("utf-8")
+        record = gzip.compress(header + html + b"\r\n\r\n")
+        with open(self.filename, "ab") as ofile:
+            offset = ofile.tell()
+            ofile.write(record)
+        with open(self.index_filename, "a", encoding="utf-8") as ofile:
+            print(f"{url}\t{offset}\t{len(record)}", file=ofile)
+
+    def records(self) -> Dict[str, Tuple[int, int]]:
+        """Devuelve la posición y la longitud del último registro de cada url,
+        en el orden en que se capturaron por primera vez
+        """
+        records = {}
+        with open(self.index_filename, "r", encoding="utf-8") as ifile:
+            for line in ifile:
+                url, offset, length = line.rstrip("\n").split("\t")
+                records[url] = (int(offset), int(length))
+        return records
+
+    def read(self, offset: int, length: int, ifile=None) -> Tuple[str, bytes, Optional[str]]:
+        """Lee un registro del archivo
+
+        Args:
+            offset (int): Posición del registro (ver records)
+            length (int): Longitud del registro comprimido
+            ifile: Fichero del archivo ya abierto en modo binario, si no se abre aquí
+
+        Returns:
+            Tuple[str, bytes, Optional[str]]: url, html de la página y su codificación,
+                None si el registro no la tiene
+        """
+        if ifile is None:
+            with open(self.filename, "rb") as ifile:
+                return self.read(offset, length, ifile)
+        ifile.seek(offset)
+        record = gzip.decompress(ifile.read(length))
+        header, _, rest = record.partition(b"\r\n\r\n")
+        fields = dict(line.split(": ", 1) for line in header.decode("utf-8").split("\r\n")[1:])
+        _, _, charset = fields["Content-Type"].partition("charset=")
+        return fields["WARC-Target-URI"], rest[:int(fields["Content-Length"])], charset or None
+
+
+# Crawler y fichero abierto de cada proceso de extract_archived_page
+_worker_state = {}
+
+
+def extract_archived_page(job: Tuple[str, str, int, int]) -> Optional[Dict]:
+    """Extrae el artículo de un registro del archivo de páginas (ver
+    SAR_Wiki_Crawler.extract_from_archive), se ejecuta en los procesos del Pool
+
+    Args:
+        job: (fichero del archivo, url, posición, longitud)
+
+    Returns:
+        Optional[Dict]: El artículo como lo devuelve parse_wikipedia_textual_content
+    """
+    filename, url, offset, length = job
+    if _worker_state.get("filename") != filename:
+        if "file" in _worker_state:
+            _worker_state["file"].close()
+        _worker_state.update(filename=filename, file=open(filename, "rb"),
+                             crawler=SAR_Wiki_Crawler(), archive=SAR_Page_Archive(filename))
+    crawler = _worker_state["crawler"]
+    _, html, encoding = _worker_state["archive"].read(offset, length, _worker_state["file"])
+    try:
+        # la misma codificación con la que se decodificó la página al capturarla
+        html = html.decode(encoding or "utf-8", errors="replace")
+    except LookupError:
+        html = html.decode("utf-8", errors="replace")
+    text, _ = crawler.extract_wikipedia_content(html)
+    return crawler.parse_wikipedia_textual_content(text, url)
 
 
 class SAR_Wiki_Crawler:
 
-    def __init__(self):
+    def __init__(self, base_url: Optional[str] = None):
+        """
+        Args:
+            base_url (Optional[str]): Servidor de los artículos, por ejemplo uno local para
+                las pruebas. None (por defecto) para la Wikipedia en español, por http o https
+        """
+        # Servidor con el que se completan los enlaces relativos (ver asegurar_url_absoluta)
+        self.base_url = base_url if base_url is not None else "https://es.wikipedia.org"
+        host = re.escape(base_url) if base_url is not None else r"http(s)?:\/\/(es)\.wikipedia\.org"
         # Expresión regular para detectar si es un enlace de la Wikipedia
-        self.wiki_re = re.compile(r"(http(s)?:\/\/(es)\.wikipedia\.org)?\/wiki\/[\w\/_\(\)\%]+")
+        self.wiki_re = re.compile(r"(" + host + r")?\/wiki\/[\w\/_\(\)\%]+")
         # Expresión regular para limpiar anclas de editar
         self.edit_re = re.compile(r"\[(editar)\]")
         # Formato para cada nivel de sección
@@ -32,6 +151,82 @@ class SAR_Wiki_Crawler:
         self.subsections_re = re.compile(r"--.+--\n")
         self.subsection_re = re.compile(r"--(?P<name>.+)--\n(?P<text>(.+|\n)*)")
 
+        # Metadatos de cada url capturada para las recapturas condicionales:
+        # url --> {'etag', 'last_modified', 'hash' (sha1 del html), 'links'}
+        self.metadata: Dict[str, Dict] = {}
+        # Fichero donde se guardan los metadatos, None para no recogerlos ni guardarlos
+        self.metadata_filename: Optional[str] = None
+        # Archivo con el html de las páginas capturadas, None para no guardarlo
+        self.archive: Optional[SAR_Page_Archive] = None
+        # Huellas SimHash de los artículos capturados, None para no buscar casi duplicados
+        self.dedup: Optional[SimHashIndex] = None
+        # Artículos descartados por ser casi duplicados: url --> url del artículo que se ha guardado
+        self.near_duplicates: Dict[str, str] = {}
+
+    def load_metadata(self, filename: str):
+        """Carga los metadatos de una captura anterior, si el fichero existe,
+        y los guardará en el mismo fichero al terminar la captura
+
+        Args:
+            filename (str): Fichero json con los metadatos (ver save_metadata)
+        """
+        self.metadata_filename = filename
+        if os.path.exists(filename):
+            with open(filename, "r", encoding="utf-8") as ifile:
+                self.metadata = json.load(ifile)
+
+    def set_dedup(self, similarity: float):
+        """Descarta los artículos casi iguales a uno ya capturado (redirecciones,
+        copias, listas casi idénticas...), comparando sus huellas SimHash
+
+        Args:
+            similarity (float): Fracción mínima de bits iguales de las huellas (ver SimHashIndex)
+        """
+        self.dedup = SimHashIndex(similarity)
+        # las páginas de capturas anteriores que no cambien no se vuelven a parsear,
+        # su huella se guarda en los metadatos
+        for url, meta in self.metadata.items():
+            if "simhash" in meta:
+                self.dedup.add(meta["simhash"], url)
+
+    def is_near_duplicate(self, article: Dict) -> bool:
+        """Indica si un artículo es casi igual a otro ya capturado, si no lo es
+        se añade su huella para compararlo con los siguientes
+
+        Args:
+            article (Dict): Artículo estructurado (ver parse_wikipedia_textual_content)
+
+        Returns:
+            bool: True si hay que descartarlo
+        """
+        if self.dedup is None:
+            return False
+        url = article["url"]
+        fingerprint = self.dedup.fingerprint(article_terms(article))
+        # una versión anterior de la misma página no cuenta
+        matches = [key for _, key in self.dedup.find(fingerprint) if key != url] if fingerprint is not None else []
+        if fingerprint is None or matches:
+            # la huella de la versión anterior, si la había, ya no es la de la página
+            self.dedup.remove(url)
+        if matches:
+            self.near_duplicates[url] = matches[0]
+            return True
+        if fingerprint is None:
+            return False
+        self.dedup.add(fingerprint, url)
+        if url in self.metadata:
+            self.metadata[url]["simhash"] = fingerprint
+        return False
+
+    def save_metadata(self):
+        """Guarda los metadatos de las urls capturadas en self.metadata_filename"""
+        if self.metadata_filename is None:
+            return
+        tmp_filename = self.metadata_filename + ".tmp"
+        with open(tmp_filename, "w", encoding="utf-8") as ofile:
+            json.dump(self.metadata, ofile, ensure_ascii=True)
+        os.replace(tmp_filename, self.metadata_filename)
+
     def is_valid_url(self, url: str) -> bool:
         """Verifica si es una dirección válida para indexar
 
@@ -45,21 +240,48 @@ class SAR_Wiki_Crawler:
 
     def asegurar_url_absoluta(self, link):
         if not link.startswith("http"):
-            link = urljoin("https://es.wikipedia.org", link)
+            link = urljoin(self.base_url, link)
         return link
         
 
+    def fetch(self, url: str) -> Optional[requests.Response]:
+        """Descarga una página. Si ya se capturó antes se hace una petición condicional
+        (If-None-Match / If-Modified-Since) con los metadatos guardados, de forma que
+        el servidor puede responder 304 sin enviar la página.
+
+        Args:
+            url (str): Dirección de la página
+
+        Returns:
+            Optional[requests.Response]: La respuesta o None si ha habido un error
+                o no ha respondido en REQUEST_TIMEOUT segundos
+        """
+        headers = {}
+        meta = self.metadata.get(url)
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        try:
+            return requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        except Exception as ex:
+            print(f"ERROR: - {url} - {ex}")
+            return None
+
     def get_wikipedia_entry_content(
-            self, url: str) -> Optional[Tuple[str, List[str]]]:
+            self, url: str) -> Optional[Tuple[Optional[str], List[str]]]:
         """Devuelve el texto en crudo y los enlaces de un artículo de la wikipedia
 
         Args:
             url (str): Enlace a un artículo de la Wikipedia
 
         Returns:
-            Optional[Tuple[str, List[str]]]: Si es un enlace correcto a un artículo
+            Optional[Tuple[Optional[str], List[str]]]: Si es un enlace correcto a un artículo
                 de la Wikipedia en inglés o castellano, devolverá el texto y los
                 enlaces que contiene la página.
+                Si la página no ha cambiado desde la captura anterior (respuesta 304
+                o mismo hash) no se parsea: el texto es None y los enlaces son los guardados.
 
         Raises:
             ValueError: En caso de que no sea un enlace a un artículo de la Wikipedia
@@ -70,62 +292,95 @@ class SAR_Wiki_Crawler:
                 f"El enlace '{url}' no es un artículo de la Wikipedia en español"
             ))
 
-        try:
-            req = requests.get(url)
-        except Exception as ex:
-            print(f"ERROR: - {url} - {ex}")
+        req = self.fetch(url)
+        if req is None:
             return None
 
+        meta = self.metadata.get(url)
+        # La página no ha cambiado: no la volvemos a parsear
+        if req.status_code == 304 and meta is not None:
+            return None, meta["links"]
+
         # Solo devolvemos el resultado si la petición ha sido correcta
         if req.status_code == 200:
-            soup = bs4.BeautifulSoup(req.text, "lxml")
-            urls = set()
-
-            for ele in soup.select(
-                ('div#catlinks, div.printfooter, div.mw-authority-control')):
-                ele.decompose()
-
-            # Recogemos todos los enlaces del contenido del artículo
-            for a in soup.select("div#bodyContent a", href=True):
-                href = a.get("href")
-                if href is not None:
-                    urls.add(href)
-
-            # Contenido del artículo
-            content = soup.select(("h1.firstHeading,"
-                                   "div#mw-content-text h2,"
-                                   "div#mw-content-text h3,"
-                                   "div#mw-content-text h4,"
-                                   "div#mw-content-text p,"
-                                   "div#mw-content-text ul,"
-                                   "div#mw-content-text li,"
-                                   "div#mw-content-text span"))
-
-            dedup_content = []
-            seen = set()
-
-            for element in content:
-                if element in seen:
-                    continue
+            page_hash = hashlib.sha1(req.content).hexdigest()
+            new_meta = {
+                "etag": req.headers.get("ETag"),
+                "last_modified": req.headers.get("Last-Modified"),
+                "hash": page_hash,
+            }
+            if meta is not None and meta.get("hash") == page_hash:
+                # Mismo contenido aunque el servidor no entienda las peticiones condicionales
+                meta.update(new_meta)
+                return None, meta["links"]
+
+            if self.archive is not None:
+                # req.text usa la codificación de la respuesta o, si no la indica, la que se deduce del contenido
+                self.archive.append(url, req.content, req.encoding or req.apparent_encoding)
+            text, links = self.extract_wikipedia_content(req.text)
+            # solo se guardan si se van a usar en la siguiente captura (--metadata)
+            if self.metadata_filename is not None:
+                new_meta["links"] = links
+                self.metadata[url] = new_meta
+            return text, links
 
-                dedup_content.append(element)
+        return None
 
-                # Añadimos a vistos, tanto el elemento como sus descendientes
-                for desc in element.descendants:
-                    seen.add(desc)
+    def extract_wikipedia_content(self, html: str) -> Tuple[str, List[str]]:
+        """Extrae el texto en crudo y los enlaces del html de un artículo de la Wikipedia
 
-                seen.add(element)
+        Args:
+            html (str): Contenido de la página
 
-            text = "\n".join(
-                self.section_format.get(element.name, "{}").format(
-                    element.text) for element in dedup_content)
+        Returns:
+            Tuple[str, List[str]]: El texto y la lista ordenada de enlaces
+        """
+        soup = bs4.BeautifulSoup(html, "lxml")
+        urls = set()
 
-            # Eliminamos el texto de las anclas de editar
-            text = self.edit_re.sub('', text)
+        for ele in soup.select(
+            ('div#catlinks, div.printfooter, div.mw-authority-control')):
+            ele.decompose()
 
-            return text, sorted(list(urls))
+        # Recogemos todos los enlaces del contenido del artículo
+        for a in soup.select("div#bodyContent a", href=True):
+            href = a.get("href")
+            if href is not None:
+                urls.add(href)
 
-        return None
+        # Contenido del artículo
+        content = soup.select(("h1.firstHeading,"
+                               "div#mw-content-text h2,"
+                               "div#mw-content-text h3,"
+                               "div#mw-content-text h4,"
+                               "div#mw-content-text p,"
+                               "div#mw-content-text ul,"
+                               "div#mw-content-text li,"
+                               "div#mw-content-text span"))
+
+        dedup_content = []
+        seen = set()
+
+        for element in content:
+            if element in seen:
+                continue
+
+            dedup_content.append(element)
+
+            # Añadimos a vistos, tanto el elemento como sus descendientes
+            for desc in element.descendants:
+                seen.add(desc)
+
+            seen.add(element)
+
+        text = "\n".join(
+            self.section_format.get(element.name, "{}").format(
+                element.text) for element in dedup_content)
+
+        # Eliminamos el texto de las anclas de editar
+        text = self.edit_re.sub('', text)
+
+        return text, sorted(list(urls))
 
     def parse_wikipedia_textual_content(#Ricardo Díaz 
             self, text: str,
@@ -271,6 +526,9 @@ class SAR_Wiki_Crawler:
         documents: List[dict] = []
         # Contador del número de documentos capturados
         total_documents_captured = 0
+        # Contador de las páginas que no han cambiado desde la captura anterior (ver load_metadata),
+        # cuentan para el límite pero no se vuelven a guardar
+        total_documents_unchanged = 0
         # Contador del número de ficheros escritos
         files_count = 0
 
@@ -284,7 +542,7 @@ class SAR_Wiki_Crawler:
             total_files = math.ceil(document_limit / batch_size)
 
         # COMPLETAR
-        while queue and total_documents_captured < document_limit:
+        while queue and total_documents_captured + total_documents_unchanged < document_limit:
             depth, parent_url, url = hq.heappop(queue)    #Sacar profundidad y url de la cola de prioridad
             if url not in visited and depth <= max_depth_level:
                 visited.add(url)
@@ -296,20 +554,80 @@ class SAR_Wiki_Crawler:
                             link_abs = self.asegurar_url_absoluta(link)        #Método creado para asegurar qué el link sea absoluto porque sino los enlaces que saca de la Wikipedia son del tipo /wiki/Articulo
                             if self.is_valid_url(link_abs) and link_abs not in visited:
                                 hq.heappush(queue, (depth + 1, url, link_abs))    #Meter en la cola de prioridad los links de otras páginas relacionadas de la Wikipedia junto son su profundidad y la página de donde se ha sacado el link
-                    if content:
+                    if content is None:
+                        total_documents_unchanged += 1
+                    elif content:
                         structured_content = self.parse_wikipedia_textual_content(
                             content, url)
-                        if structured_content is not None:
+                        if structured_content is not None and not self.is_near_duplicate(structured_content):
                             documents.append(structured_content)
                             total_documents_captured += 1
-                if batch_size is not None and total_documents_captured % batch_size == 0:    #Si se ha puesto un límite en los documentos que se guardan por fichero, cuando se alcance ese límite los guarda y vuelve a empezar a guardar en otro fichero nuevo.
+                if batch_size is not None and len(documents) == batch_size:    #Si se ha puesto un límite en los documentos que se guardan por fichero, cuando se alcance ese límite los guarda y vuelve a empezar a guardar en otro fichero nuevo.
                     files_count += 1
                     self.save_documents(documents, base_filename, files_count, total_files)
+                    self.save_metadata()
                     documents = []
                     
         if documents:    #Esto se ejecuta si no se ha definido un batch_size por lo tanto todo se guarda en un fichero. Si sí se define un Batch_size, esto se ejecuta para recoger los documentos que no se hayan guardado en un fichero si el número máximo de documemtos no es múltiplo del batch_size.
             self.save_documents(documents, base_filename, files_count, total_files)
             files_count += 1
+        self.save_metadata()
+
+    def open_archive(self, filename: str):
+        """Guarda el html de cada página que se descarga y parsea en un archivo
+        de solo añadir (ver SAR_Page_Archive), para poder repetir la extracción
+        sin volver a capturar (ver extract_from_archive)
+
+        Args:
+            filename (str): Fichero del archivo, se crea si no existe
+        """
+        self.archive = SAR_Page_Archive(filename)
+
+    def extract_from_archive(self, archive_filename: str, document_limit: int,
+                             base_filename: str, batch_size: Optional[int],
+                             processes: Optional[int] = None):
+        """Vuelve a extraer los artículos de las páginas guardadas en un archivo
+        (ver open_archive) sin acceder a la red. Las páginas se reparten entre
+        varios procesos y los artículos se guardan en el orden del archivo; de cada
+        url se usa la última versión guardada.
+
+        Args:
+            archive_filename (str): Fichero del archivo de páginas
+            document_limit (int): Máximo número de documentos a extraer
+            base_filename (str): Nombre base del fichero de guardado.
+            batch_size (Optional[int]): Cada cuantos documentos se guardan en
+                fichero. Si se asigna None, se guardará al finalizar.
+            processes (Optional[int]): Número de procesos, por defecto uno por CPU
+        """
+        records = SAR_Page_Archive(archive_filename).records()
+        jobs = [(archive_filename, url, offset, length)
+                for url, (offset, length) in records.items()]
+
+        documents: List[dict] = []
+        total_documents = 0
+        files_count = 0
+        if batch_size is None:
+            total_files = None
+        else:
+            total_files = math.ceil(min(document_limit, len(jobs)) / batch_size)
+
+        with Pool(processes) as pool:
+            for document in pool.imap(extract_archived_page, jobs, chunksize=16):
+                if total_documents >= document_limit:
+                    break
+                if document is None or self.is_near_duplicate(document):
+                    continue
+                documents.append(document)
+                total_documents += 1
+                if batch_size is not None and len(documents) == batch_size:
+                    files_count += 1
+                    self.save_documents(documents, base_filename, files_count, total_files)
+                    documents = []
+
+        if documents:
+            if batch_size is not None:
+                files_count += 1
+            self.save_documents(documents, base_filename, files_count, total_files)
 
     def wikipedia_crawling_from_url(self, initial_url: str,
                                     document_limit: int, base_filename: str,
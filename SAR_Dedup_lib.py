@@ -0,0 +1,128 @@
+import hashlib
+import re
+from functools import lru_cache
+from operator import add
+from typing import Dict, List, Optional, Tuple
+
+# bits de las huellas SimHash
+FINGERPRINT_BITS = 64
+# los hash de los terminos se suman con un byte por bit, de 255 en 255 para que no se desborden
+# (ver SimHashIndex.fingerprint)
+LANE_MAX = 255
+BITS_FORMAT = f'0{FINGERPRINT_BITS}b'
+BIT_BYTES = bytes.maketrans(b'01', b'\x00\x01')
+# terminos cuyo hash se guarda (ver SimHashIndex.spread)
+SPREAD_CACHE_SIZE = 1 << 16
+
+termre = re.compile(r"\w+")
+
+
+def article_terms(article: Dict) -> set:
+    """
+    Terminos de un artículo tal como lo guarda el crawler ('title', 'summary' y 'sections'),
+    los mismos que SAR_Indexer.tokenize_fields guarda en 'all'.
+    """
+    texts = [article['title'], article['summary']]
+    for sec in article['sections']:
+        texts += [sec['name'], sec['text']]
+        for subsec in sec['subsections']:
+            texts += [subsec['name'], subsec['text']]
+    terms = set()
+    for text in texts:
+        terms.update(termre.findall(text.lower()))
+    return terms
+
+
+class SimHashIndex:
+    """
+    Deteccion de artículos casi duplicados con huellas SimHash.
+
+    La huella de un artículo tiene un bit a 1 en cada posicion en la que mas de la mitad de sus
+    terminos (sin repetir) tienen un 1 en su hash, asi que dos artículos con casi los mismos terminos
+    tienen huellas a poca distancia de Hamming. Para no comparar con todas las huellas se usa LSH:
+    la huella se parte en max_dist + 1 bloques y, si dos huellas estan a distancia max_dist o menos,
+    al menos uno de sus bloques es igual; cada bloque tiene su propio hash bloque --> claves.
+    """
+
+    def __init__(self, similarity: float = 0.95):
+        """
+        param:  "similarity": fraccion minima de bits iguales de las huellas de dos artículos
+                para considerarlos casi duplicados
+        """
+        self.similarity = similarity
+        self.max_dist = int((1 - similarity) * FINGERPRINT_BITS + 1e-9)
+        nblocks = self.max_dist + 1
+        size = FINGERPRINT_BITS // nblocks
+        # (desplazamiento, mascara) de cada bloque, el ultimo se queda con los bits que sobran
+        self.blocks = [(k * size, (1 << (size if k < nblocks - 1 else FINGERPRINT_BITS - k * size)) - 1)
+                       for k in range(nblocks)]
+        self.tables = [{} for _ in self.blocks]
+        # huella de cada clave añadida, para quitarla de las tablas (ver remove)
+        self.keys = {}
+
+    @staticmethod
+    @lru_cache(maxsize=SPREAD_CACHE_SIZE)
+    def spread(term: str) -> int:
+        """
+        Hash de 64 bits de un termino con el bit i en el byte i, para sumar los bits de muchos hash a la vez.
+        Se guardan los de los SPREAD_CACHE_SIZE terminos usados mas recientemente.
+        """
+        h = int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+        return int.from_bytes(format(h, BITS_FORMAT).encode().translate(BIT_BYTES), 'big')
+
+    def fingerprint(self, terms: set) -> Optional[int]:
+        """
+        Huella SimHash de un conjunto de terminos. En lugar de recorrer los 64 bits de cada termino,
+        se suman sus hash con un byte por bit (ver spread) y cada suma da 64 contadores.
+        None si no hay terminos: la huella seria 0 y todos los artículos vacios serian casi duplicados.
+        """
+        if len(terms) == 0:
+            return None
+        spreads = list(map(self.spread, terms))
+        # contadores del bit 63 al 0
+        counts = [0] * FINGERPRINT_BITS
+        for k in range(0, len(spreads), LANE_MAX):
+            counts = list(map(add, counts, sum(spreads[k:k + LANE_MAX]).to_bytes(FINGERPRINT_BITS, 'big')))
+        n = len(spreads)
+        return int(''.join(['1' if 2 * c > n else '0' for c in counts]), 2)
+
+    def find(self, fingerprint: int) -> List[Tuple[int, object]]:
+        """
+        Busca las huellas añadidas a distancia self.max_dist o menos
+
+        return: lista ordenada de tuplas (distancia, clave)
+        """
+        seen = set()
+        res = []
+        for (shift, mask), table in zip(self.blocks, self.tables):
+            for other, key in table.get(fingerprint >> shift & mask, ()):
+                if key not in seen:
+                    seen.add(key)
+                    dist = (fingerprint ^ other).bit_count()
+                    if dist <= self.max_dist:
+                        res.append((dist, key))
+        res.sort(key=lambda x: x[0])
+        return res
+
+    def add(self, fingerprint: int, key):
+        """
+        Añade la huella de un artículo, "key" lo identifica (artid, url...).
+        Si la clave ya tenia una huella (una version anterior del artículo) se sustituye.
+        """
+        self.remove(key)
+        self.keys[key] = fingerprint
+        for (shift, mask), table in zip(self.blocks, self.tables):
+            table.setdefault(fingerprint >> shift & mask, []).append((fingerprint, key))
+
+    def remove(self, key):
+        """Quita la huella de la clave "key", si se habia añadido"""
+        fingerprint = self.keys.pop(key, None)
+        if fingerprint is None:
+            return
+        for (shift, mask), table in zip(self.blocks, self.tables):
+            block = fingerprint >> shift & mask
+            bucket = table[block]
+            bucket.remove((fingerprint, key))
+            if len(bucket) == 0:
+                del table[block]
+
@@ -1,9 +1,12 @@
 import argparse
+import json
+import os
 import pickle
 import sys
 import time
 
 from SAR_lib import SAR_Indexer
+from SAR_Shard_lib import build_shards
 
 
 if __name__ == "__main__":
@@ -27,8 +30,63 @@ if __name__ == "__main__":
     parser.add_argument('-O', '--positional', dest='positional', action='store_true', default=False, 
                     help='compute positional index.')
 
+    parser.add_argument('-B', '--bitmap', dest='bitmap', action='store_true', default=False,
+                    help='store the posting lists of the most frequent terms as bitmaps.')
+
+    parser.add_argument('-U', '--unaccent', dest='unaccent', action='store_true', default=False,
+                    help='compute the accent-insensitive index.')
+
+    parser.add_argument('-D', '--compact', dest='compact', action='store_true', default=False,
+                    help='store the term dictionaries front-coded (less memory, prefix queries without permuterm).')
+
+    parser.add_argument('-X', '--suffix-array', dest='suffix', action='store_true', default=False,
+                    help='compute a suffix array of the vocabulary for wildcard queries (instead of the permuterm rotations).')
+
+    parser.add_argument('-G', '--tagged', dest='tagged', action='store_true', default=False,
+                    help='with -M, store a single posting list per term tagged with its fields (instead of one index per field).')
+
+    parser.add_argument('-W', '--biword', dest='biword', action='store_true', default=False,
+                    help='compute the biword index for phrase queries ("term1 term2").')
+
+    parser.add_argument('--biword-min-df', dest='biword_min_df', metavar='N', type=int, default=None,
+                    help='keep only the biwords that appear in at least N articles (default: %d).' % SAR_Indexer.BIWORD_MIN_DF)
+
+    parser.add_argument('--dedup', dest='dedup', metavar='SIM', type=float, default=None,
+                    help='skip the articles whose SimHash fingerprint shares at least a fraction SIM of its bits with an indexed one (e.g. 0.95).')
+
+    parser.add_argument('-F', '--fuzzy', dest='fuzzy', action='store_true', default=False,
+                    help='compute the deletes index for fuzzy queries (term~).')
+
+    parser.add_argument('--memory-budget', dest='memory_budget', metavar='MB', type=float, default=None,
+                    help='build the index in runs of about MB megabytes flushed to disk and merged when saving.')
+
+    parser.add_argument('--runs-dir', dest='runs_dir', metavar='DIR', type=str, default=None,
+                    help='directory for the temporary runs of --memory-budget (default: system temp dir).')
+
+    parser.add_argument('--progress', dest='progress', metavar='N', type=int, default=None,
+                    help='show progress every N articles.')
+
+    parser.add_argument('--metrics', dest='metrics', metavar='FILE', type=str, default=None,
+                    help='save the time of each indexing phase and other metrics in FILE (json).')
+
+    parser.add_argument('--shards', dest='shards', metavar='N', type=int, default=None,
+                    help='split the index in N shards, built in parallel (see SAR_Shard_lib).')
+
     args = parser.parse_args()
 
+    if args.shards is not None:
+        t0 = time.time()
+        shards = build_shards(args.dir, args.index, args.shards, **vars(args))
+        t1 = time.time()
+        print("========================================")
+        for shard in shards:
+            print(f"{shard['index']}: {len(shard['files'])} files, {shard['articles']} articles")
+        print("----------------------------------------")
+        print("Number of indexed articles: " + str(sum(shard['articles'] for shard in shards)))
+        print("Time indexing and saving: %2.2fs." % (t1 - t0))
+        print()
+        sys.exit(0)
+
     indexer = SAR_Indexer()
     t0 = time.time()
     indexer.index_dir(args.dir, **vars(args))
@@ -36,7 +94,13 @@ if __name__ == "__main__":
     indexer.save_info(args.index)
     t2 = time.time()
     indexer.show_stats()
+    indexer.show_metrics()
     print("Time indexing: %2.2fs." % (t1 - t0))
     print("Time saving: %2.2fs." % (t2 - t1))
     print()
+    if args.metrics is not None:
+        metrics = indexer.get_metrics()
+        metrics.update(time_indexing=t1 - t0, time_saving=t2 - t1, index_size=os.path.getsize(args.index))
+        with open(args.metrics, 'w', encoding='utf-8') as fh:
+            json.dump(metrics, fh, indent=2)
 
@@ -6,6 +6,7 @@ import pickle
 import sys
 
 from SAR_lib import SAR_Indexer
+from SAR_Shard_lib import SAR_Sharded_Indexer, is_shard_manifest
 
 
 if __name__ == "__main__":
@@ -20,6 +21,9 @@ if __name__ == "__main__":
                     help='use stem index by default.')
 
 
+    parser.add_argument('-U', '--unaccent', dest='unaccent', action='store_true', default=False,
+                    help='ignore accents and other diacritics in the query terms.')
+
     group0 = parser.add_mutually_exclusive_group()
     
     group0.add_argument('-N', '--snippet', dest='snippet', action='store_true', default=False, 
@@ -32,6 +36,20 @@ if __name__ == "__main__":
                     help='show all the results. If not used, only the first 10 results are showed. Does not apply with -C and -T options.')
 
 
+    parser.add_argument('-E', '--explain', '--profile', dest='explain', action='store_true', default=False,
+                    help='show the operator tree, the size and time of each node and the time of each lookup.')
+
+
+    parser.add_argument('--max-terms', dest='max_terms', metavar='N', type=int, default=None,
+                    help='maximum number of terms expanded by the wildcards, stems, fuzzy and unaccented terms of a query, 0 for no limit (default: no limit).')
+
+    parser.add_argument('--max-postings', dest='max_postings', metavar='N', type=int, default=None,
+                    help='maximum number of postings read by the expansions of a query, 0 for no limit (default: no limit).')
+
+    parser.add_argument('--timeout', dest='timeout', metavar='SECONDS', type=float, default=None,
+                    help='stop expanding terms after SECONDS since the start of a query, 0 for no limit (default: no limit).')
+
+
     group1 = parser.add_mutually_exclusive_group()
     group1.add_argument('-Q', '--query', dest='query', metavar= 'query', type=str, action='store',
                     help='query.')
@@ -42,11 +60,17 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    searcher = SAR_Indexer()
+    # un indice repartido en shards se consulta con un proceso por shard
+    if is_shard_manifest(args.index):
+        searcher = SAR_Sharded_Indexer()
+    else:
+        searcher = SAR_Indexer()
     searcher.load_info(args.index)
     searcher.set_stemming(args.stem)
+    searcher.set_unaccent(args.unaccent)
     searcher.set_showall(args.all)
     searcher.set_snippet(args.snippet)
+    searcher.set_budget(args.max_terms, args.max_postings, args.timeout)
 
     # se debe contar o mostrar resultados?
     if args.count is True:
@@ -65,7 +89,8 @@ if __name__ == "__main__":
         # opt: -T, testing
         with open(args.test, encoding='utf-8') as fh:
             query_list = fh.read().split('\n')
-        if searcher.solve_and_test(query_list):
+        # con -E cada query se comprueba tambien con explain_query
+        if searcher.solve_and_test(query_list, explain=args.explain):
             print('\nParece que todo está bien, buen trabajo!')
         else:
             print('\nParece que hay alguna consulta mal :-(')            
@@ -73,8 +98,14 @@ if __name__ == "__main__":
 
     elif args.query is not None:
         # opt: -Q, una query pasada como argumento
+        # se debe explicar la consulta?
+        if args.explain is True:
+            info = searcher.explain_query(args.query, show=not args.count)
+            if args.count is True:
+                print(f"{args.query}\t{info['results']}")
+            searcher.print_explain(info)
         # se debe contar o mostrar resultados?
-        if args.count is True:
+        elif args.count is True:
             searcher.solve_and_count([args.query])
         else:
             searcher.solve_and_show(args.query)
@@ -83,8 +114,14 @@ if __name__ == "__main__":
         # modo interactivo
         query = input("query: ")
         while query != "":
+            # se debe explicar la consulta?
+            if args.explain is True:
+                info = searcher.explain_query(query, show=not args.count)
+                if args.count is True:
+                    print(f"{query}\t{info['results']}")
+                searcher.print_explain(info)
             # se debe contar o mostrar resultados?
-            if args.count is True:
+            elif args.count is True:
                 searcher.solve_and_count([query])
             else:
                 searcher.solve_and_show(query)
@@ -0,0 +1,366 @@
+import json
+import os
+import time
+from bisect import bisect_right
+from typing import Optional, List, Dict
+
+from SAR_lib import SAR_Indexer
+
+# primera clave del fichero que describe un indice repartido en shards
+SHARDS_MAGIC = '{"sar_shards"'
+
+
+def split_files(files: List[str], nshards: int) -> List[List[str]]:
+    """
+    Reparte una lista de ficheros en grupos consecutivos de tamaño parecido (en bytes).
+    Al ser consecutivos, los artid de cada shard desplazados por los artículos de los
+    shards anteriores coinciden con los de un unico indice de todos los ficheros.
+
+    Args:
+        files (List[str]): ficheros en el orden en que los indexa index_dir
+        nshards (int): numero de shards, como mucho uno por fichero
+
+    Returns:
+        List[List[str]]: lista de grupos de ficheros
+    """
+    nshards = max(1, min(nshards, len(files)))
+    sizes = [os.path.getsize(f) for f in files]
+    total = sum(sizes)
+    groups = [[] for _ in range(nshards)]
+    acc = 0
+    for i, (filename, size) in enumerate(zip(files, sizes)):
+        # shard que toca segun los bytes acumulados, dejando al menos un fichero para cada shard restante
+        k = min(int(acc * nshards / total) if total > 0 else 0, nshards - 1)
+        k = max(k, nshards - (len(files) - i))
+        groups[k].append(filename)
+        acc += size
+    return [g for g in groups if len(g) > 0]
+
+
+def collect_urls(files: List[str]) -> set:
+    """Urls de los artículos de una lista de ficheros, se ejecuta en un proceso aparte"""
+    indexer = SAR_Indexer()
+    return {article['url'] for fname in files for _, article in indexer.iter_articles(fname)}
+
+
+def build_shard(job: tuple) -> Dict:
+    """
+    Construye y guarda el indice de un shard, se ejecuta en un proceso aparte.
+
+    Args:
+        job (tuple): (lista de ficheros, nombre del indice, argumentos de index_dir,
+                      urls de los shards anteriores, que no se deben volver a indexar)
+
+    Returns:
+        Dict: nombre del indice del shard, numero de artículos y ficheros
+    """
+    files, filename, args, seen = job
+    indexer = SAR_Indexer()
+    indexer.urls = seen
+    indexer.index_dir(files, **args)
+    indexer.save_info(filename)
+    return {'index': os.path.basename(filename), 'articles': len(indexer.articles), 'files': files}
+
+
+def build_shards(root: str, filename: str, nshards: int, **args) -> List[Dict]:
+    """
+    Indexa "root" en "nshards" shards, construidos en paralelo, uno por proceso.
+    Cada shard se guarda en "filename".shardN y en "filename" se guarda la lista de shards
+    con el desplazamiento de sus artid (ver SAR_Sharded_Indexer).
+
+    Antes de indexar se recogen en paralelo las urls de cada grupo de ficheros, para que cada
+    shard se salte los artículos que ya estan en un shard anterior, igual que haria un unico indice.
+
+    Args:
+        root (str): fichero o directorio con los artículos
+        filename (str): nombre del indice
+        nshards (int): numero de shards
+        args: argumentos de index_dir
+
+    Returns:
+        List[Dict]: descripcion de cada shard: 'index', 'articles', 'offset' y 'files'
+    """
+    from multiprocessing import Pool
+
+    args = dict(args, progress=None)
+    indexer = SAR_Indexer()
+    groups = split_files(indexer.get_files(root), nshards)
+    with Pool(len(groups)) as pool:
+        # las urls del ultimo grupo no las necesita ningun shard
+        urls = pool.map(collect_urls, groups[:-1])
+        jobs = []
+        seen = set()
+        for k, files in enumerate(groups):
+            jobs.append((files, f'{filename}.shard{k + 1}', args, set(seen)))
+            if k < len(urls):
+                seen.update(urls[k])
+        shards = pool.map(build_shard, jobs)
+    offset = 0
+    for shard in shards:
+        shard['offset'] = offset
+        offset += shard['articles']
+    with open(filename, 'w', encoding='utf-8') as fh:
+        json.dump({'sar_shards': 1, 'shards': shards}, fh, indent=2)
+    return shards
+
+
+def is_shard_manifest(filename: str) -> bool:
+    """Indica si "filename" es la lista de shards de un indice repartido (ver build_shards)"""
+    with open(filename, 'rb') as fh:
+        head = fh.read(64)
+    return b''.join(head.split()).startswith(SHARDS_MAGIC.encode())
+
+
+def shard_worker(conn, filename: str):
+    """
+    Proceso que atiende las peticiones del coordinador sobre un shard.
+
+    Mensajes: ('solve', query, use_stemming, use_unaccent, budget) --> (posting list con los artid locales del shard,
+                                                                      expansiones cortadas, ver SAR_Indexer.truncated)
+              ('count', query, use_stemming, use_unaccent, budget) --> (numero de resultados en el shard, expansiones cortadas)
+              ('top', query, use_stemming, use_unaccent, budget, n) --> (los n primeros artid locales, ver SAR_Indexer.solve_top,
+                                                                       expansiones cortadas)
+              ('page', query, use_stemming, use_unaccent, budget, n) --> ((los n primeros artid locales, numero de resultados),
+                                                                        expansiones cortadas), ver SAR_Indexer.solve_page
+              "budget" es la tupla de argumentos de set_budget (max_terms, max_postings, timeout)
+              ('explain', query, use_stemming, use_unaccent, budget) --> resultado de explain_query
+              ('suggest', query, use_stemming, use_unaccent) --> resultado de get_suggestions
+              ('duplicates',) --> artículos casi duplicados no indexados (SAR_Indexer.duplicates)
+              ('articles', [artid]) --> (artículos (sin 'all') para mostrarlos, bytes leidos del disco)
+              ('stop',) --> termina
+    Las respuestas son ('ok', resultado) o ('error', descripcion).
+    """
+    searcher = SAR_Indexer()
+    searcher.load_info(filename)
+    while True:
+        msg = conn.recv()
+        if msg[0] == 'stop':
+            break
+        try:
+            if msg[0] in ('solve', 'count', 'top', 'page'):
+                searcher.set_stemming(msg[2])
+                searcher.set_unaccent(msg[3])
+                searcher.set_budget(*msg[4])
+                if msg[0] == 'solve':
+                    res = searcher.solve_query(msg[1])
+                elif msg[0] == 'count':
+                    res = searcher.count_query(msg[1])
+                elif msg[0] == 'top':
+                    res = searcher.solve_top(msg[1], msg[5])
+                else:
+                    res = searcher.solve_page(msg[1], msg[5])
+                res = (res, searcher.truncated)
+            elif msg[0] == 'explain':
+                searcher.set_stemming(msg[2])
+                searcher.set_unaccent(msg[3])
+                searcher.set_budget(*msg[4])
+                res = searcher.explain_query(msg[1])
+            elif msg[0] == 'suggest':
+                searcher.set_stemming(msg[2])
+                searcher.set_unaccent(msg[3])
+                res = searcher.get_suggestions(msg[1])
+            elif msg[0] == 'duplicates':
+                res = searcher.duplicates
+            elif msg[0] == 'articles':
+                bytes_read = searcher.bytes_read
+                res = []
+                for artid in msg[1]:
+                    article = searcher.read_article(artid)
+                    article.pop('all')
+                    res.append(article)
+                res = (res, searcher.bytes_read - bytes_read)
+            else:
+                raise ValueError(f'unknown message {msg[0]}')
+            conn.send(('ok', res))
+        except Exception as ex:
+            conn.send(('error', repr(ex)))
+    conn.close()
+
+
+class SAR_Sharded_Indexer(SAR_Indexer):
+    """
+    Coordinador de un indice repartido en shards (ver build_shards).
+
+    Cada shard lo atiende un proceso (shard_worker) con el que se habla por un pipe.
+    Las consultas se envian a todos los shards a la vez y se juntan sus resultados:
+    cada shard resuelve los NOT respecto a sus propios artículos y los shards no
+    comparten artículos, asi que la union de los resultados y la suma de los conteos
+    son correctas para el corpus entero.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.shards = [] # descripcion de cada shard, ver build_shards
+        self.offsets = [] # desplazamiento de los artid de cada shard
+        self.conns = [] # pipe con el proceso de cada shard
+        self.procs = []
+
+    def load_info(self, filename: str):
+        """
+        Lee la lista de shards y arranca un proceso por shard que carga su indice
+        """
+        from multiprocessing import Pipe, Process
+
+        with open(filename, encoding='utf-8') as fh:
+            self.shards = json.load(fh)['shards']
+        base = os.path.dirname(filename)
+        self.offsets = [shard['offset'] for shard in self.shards]
+        for shard in self.shards:
+            parent, child = Pipe()
+            proc = Process(target=shard_worker, args=(child, os.path.join(base, shard['index'])), daemon=True)
+            proc.start()
+            self.conns.append(parent)
+            self.procs.append(proc)
+        self.articles = range(1, sum(shard['articles'] for shard in self.shards) + 1)
+        #los casi duplicados de cada shard con los artid globales, para mostrarlos con los resultados
+        for offset, duplicates in zip(self.offsets, self.scatter([('duplicates',)] * len(self.conns))):
+            self.duplicates.update((artid + offset, urls) for artid, urls in duplicates.items())
+
+    def close(self):
+        """Termina los procesos de los shards"""
+        for conn in self.conns:
+            conn.send(('stop',))
+        for proc in self.procs:
+            proc.join()
+        self.conns = []
+        self.procs = []
+
+    def scatter(self, messages: List[Optional[tuple]]) -> List:
+        """
+        Envia a la vez un mensaje a cada shard (None para no enviarle nada) y espera las respuestas.
+
+        Returns:
+            List: resultado de cada shard, None para los que no han recibido mensaje
+        """
+        for conn, msg in zip(self.conns, messages):
+            if msg is not None:
+                conn.send(msg)
+        res = []
+        for conn, msg in zip(self.conns, messages):
+            if msg is None:
+                res.append(None)
+                continue
+            status, val = conn.recv()
+            if status != 'ok':
+                raise RuntimeError(val)
+            res.append(val)
+        return res
+
+    def query_message(self, op: str, query: str, *extra) -> tuple:
+        """Mensaje 'solve', 'count', 'top' o 'page' para los shards con las opciones y el presupuesto del coordinador"""
+        return (op, query, self.use_stemming, self.use_unaccent,
+                (self.max_terms, self.max_postings, self.query_timeout)) + extra
+
+    def gather_truncated(self, replies: List[tuple]) -> List:
+        """
+        Separa los resultados de las respuestas de los shards y junta en self.truncated sus expansiones
+        cortadas: cada shard tiene su propio presupuesto, de un termino se queda el primer motivo
+        y el mayor numero de terminos expandidos.
+        """
+        self.truncated = []
+        cuts = {}
+        for _, truncated in replies:
+            for cut in truncated:
+                prev = cuts.get(cut['term'])
+                if prev is None:
+                    cuts[cut['term']] = dict(cut)
+                    self.truncated.append(cuts[cut['term']])
+                else:
+                    prev['expanded'] = max(prev['expanded'], cut['expanded'])
+        return [res for res, _ in replies]
+
+    def solve_query(self, query: str, prev: Dict = {}, tracer=None):
+        """
+        Resuelve una query en todos los shards y junta los resultados con los artid globales.
+        Los rangos de artid de los shards son consecutivos, asi que basta con concatenarlos en orden.
+        No se usa "tracer": cada shard mide la consulta por su cuenta (ver explain_query).
+        """
+        results = self.gather_truncated(self.scatter([self.query_message('solve', query)] * len(self.conns)))
+        if any(r is None for r in results):
+            return None
+        res = []
+        for offset, r in zip(self.offsets, results):
+            res.extend(artid + offset for artid in r)
+        return res
+
+    def solve_top(self, query: str, n: int) -> List[int]:
+        """
+        Los "n" primeros resultados: cada shard devuelve solo sus n primeros y, como los rangos
+        de artid son consecutivos, los n primeros del corpus son los primeros de la concatenacion.
+        """
+        results = self.gather_truncated(self.scatter([self.query_message('top', query, n)] * len(self.conns)))
+        res = []
+        for offset, r in zip(self.offsets, results):
+            res.extend(artid + offset for artid in r[:n - len(res)])
+        return res
+
+    def solve_page(self, query: str, n: int) -> tuple:
+        """Los "n" primeros resultados (ver solve_top) y el total con una sola consulta a los shards"""
+        results = self.gather_truncated(self.scatter([self.query_message('page', query, n)] * len(self.conns)))
+        res = []
+        for offset, (r, _) in zip(self.offsets, results):
+            res.extend(artid + offset for artid in r[:n - len(res)])
+        return res, sum(total for _, total in results)
+
+    def count_query(self, query: str) -> int:
+        """Suma los conteos de los shards, que no comparten artículos"""
+        return sum(self.gather_truncated(self.scatter([self.query_message('count', query)] * len(self.conns))))
+
+    def suggest_query(self, query: str) -> Optional[str]:
+        """
+        Cada shard busca sugerencias para sus terminos sin resultados; se cambian los que no estan
+        en ningun shard por la mejor sugerencia de todos (ver SAR_Indexer.apply_suggestions)
+        """
+        replies = self.scatter([('suggest', query, self.use_stemming, self.use_unaccent)] * len(self.conns))
+        return self.apply_suggestions(replies[0][0], *[suggestions for _, suggestions in replies])
+
+    def explain_query(self, query: str, show: bool = False) -> Dict:
+        """
+        Cada shard explica la consulta sobre sus artículos y se juntan sus arboles, que tienen la misma forma:
+        los tamaños de los nodos, los resultados y los bytes leidos se suman y, como los shards van en
+        paralelo, el tiempo de cada nodo y las busquedas de cada tipo son las del shard mas lento.
+        Con "show" los resultados se muestran despues con solve_and_show.
+        """
+        t0 = time.perf_counter()
+        infos = self.scatter([self.query_message('explain', query)] * len(self.conns))
+        self.gather_truncated([(info, info['truncated']) for info in infos])
+
+        def merge(nodes):
+            node = dict(nodes[0], size=sum(n['size'] for n in nodes), time_ms=max(n['time_ms'] for n in nodes))
+            node['children'] = [merge(children) for children in zip(*(n['children'] for n in nodes))]
+            return node
+
+        trees = [info['tree'] for info in infos]
+        lookups = {name: {key: max(info['lookups'][name][key] for info in infos) for key in ('calls', 'time_ms')}
+                   for name in infos[0]['lookups']}
+        results = [info['results'] for info in infos]
+        info = {'query': query, 'results': sum(results) if None not in results else None,
+                'tree': merge(trees) if None not in trees else None, 'lookups': lookups,
+                'bytes_read': sum(info['bytes_read'] for info in infos), 'truncated': list(self.truncated)}
+        if show:
+            bytes_read = self.bytes_read
+            info['results'] = self.solve_and_show(query)
+            info['bytes_read'] += self.bytes_read - bytes_read
+        info['total_ms'] = (time.perf_counter() - t0) * 1000
+        return info
+
+    def read_article(self, artid: int) -> Dict[str, str]:
+        """Pide el artículo al proceso del shard que lo contiene"""
+        return self.read_articles([artid])[0]
+
+    def read_articles(self, artids: List[int]) -> List[Dict[str, str]]:
+        """
+        Pide varios artículos a la vez, cada uno al shard que lo contiene
+
+        Returns:
+            List[Dict[str, str]]: los artículos en el mismo orden que "artids" (sin 'all')
+        """
+        local = [[] for _ in self.conns]
+        where = []
+        for artid in artids:
+            k = bisect_right(self.offsets, artid - 1) - 1
+            where.append((k, len(local[k])))
+            local[k].append(artid - self.offsets[k])
+        results = self.scatter([('articles', ids) if len(ids) > 0 else None for ids in local])
+        self.bytes_read += sum(r[1] for r in results if r is not None)
+        return [results[k][0][i] for k, i in where]
@@ -1,13 +1,774 @@
+import heapq
+import io
 import json
-from nltk import root_semrep
-from nltk.stem.snowball import SnowballStemmer
 import os
+import shutil
+import tempfile
 import re
 import sys
 import math
+import time
+import unicodedata
 from pathlib import Path
 from typing import Optional, List, Union, Dict
 import pickle
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left, bisect_right
+from contextlib import redirect_stdout
+from itertools import chain, groupby, islice
+from operator import itemgetter
+from urllib.parse import unquote
+
+from SAR_Dedup_lib import SimHashIndex
+
+
+def current_memory() -> int:
+    """
+    Memoria residente actual del proceso en bytes.
+    Si no se puede leer /proc (fuera de linux) devuelve el pico de memoria.
+    """
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return peak_memory() or 0
+
+
+def peak_memory() -> Optional[int]:
+    """
+    Pico de memoria residente del proceso en bytes.
+    Devuelve None si no existe el modulo resource (solo esta en unix).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss viene en bytes en macOS y en kilobytes en linux
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def fold_term(term:str) -> str:
+    """
+    Quita los diacriticos de un termino: descomposicion Unicode NFKD sin las marcas
+    combinables, en minusculas ('programación' --> 'programacion', 'año' --> 'ano').
+    """
+    if term.isascii():
+        return term
+    return ''.join(c for c in unicodedata.normalize('NFKD', term) if not unicodedata.combining(c)).lower()
+
+
+def edit_distance(s1:str, s2:str, max_dist:int) -> int:
+    """
+    Distancia de edicion entre dos cadenas: inserciones, borrados, sustituciones y
+    transposiciones de dos letras contiguas (Damerau-Levenshtein restringida).
+    Deja de calcular en cuanto la distancia supera "max_dist" y entonces devuelve max_dist + 1.
+    """
+    if abs(len(s1) - len(s2)) > max_dist:
+        return max_dist + 1
+    #el prefijo y el sufijo comunes no cambian la distancia
+    start = 0
+    while start < len(s1) and start < len(s2) and s1[start] == s2[start]:
+        start += 1
+    end = 0
+    while end < len(s1) - start and end < len(s2) - start and s1[-1 - end] == s2[-1 - end]:
+        end += 1
+    s1 = s1[start:len(s1) - end]
+    s2 = s2[start:len(s2) - end]
+    if len(s1) == 0 or len(s2) == 0:
+        return min(len(s1) + len(s2), max_dist + 1)
+    #solo se calculan las celdas a distancia max_dist de la diagonal, el resto valen max_dist + 1
+    big = max_dist + 1
+    n2 = len(s2)
+    prev2 = None
+    prev = [j if j <= max_dist else big for j in range(n2 + 1)]
+    for i in range(1, len(s1) + 1):
+        c1 = s1[i - 1]
+        cur = [big] * (n2 + 1)
+        if i <= max_dist:
+            cur[0] = i
+        rowmin = cur[0]
+        for j in range(max(1, i - max_dist), min(n2, i + max_dist) + 1):
+            d = prev[j - 1] if c1 == s2[j - 1] else prev[j - 1] + 1
+            if prev[j] + 1 < d:
+                d = prev[j] + 1
+            if cur[j - 1] + 1 < d:
+                d = cur[j - 1] + 1
+            if i > 1 and j > 1 and c1 == s2[j - 2] and s1[i - 2] == s2[j - 1] and prev2[j - 2] + 1 < d:
+                d = prev2[j - 2] + 1
+            cur[j] = d if d < big else big
+            if d < rowmin:
+                rowmin = d
+        if rowmin > max_dist:
+            return big
+        prev2, prev = prev, cur
+    return prev[n2]
+
+
+class LazyFields(dict):
+    """
+    Diccionario campo --> indice de ese campo (para la ampliacion multifield)
+    cuyos valores se deserializan desde el fichero del indice la primera vez
+    que se consultan.
+    """
+
+    def __init__(self, filename:str, sections:Dict[str, int]):
+        """
+        param:  "filename": fichero del indice
+                "sections": clave: campo, valor: posicion de su seccion en el fichero
+        """
+        super().__init__()
+        self.filename = filename
+        self.sections = dict(sections)
+
+    def __missing__(self, field:str):
+        if field not in self.sections:
+            raise KeyError(field)
+        pos = self.sections.pop(field)
+        with open(self.filename, 'rb') as fh:
+            fh.seek(pos)
+            val = pickle.load(fh)
+        self[field] = val
+        #los campos que comparten seccion comparten el mismo objeto (ver save_info)
+        for other in [other for other, opos in self.sections.items() if opos == pos]:
+            self[other] = val
+            del self.sections[other]
+        return val
+
+    def get(self, field:str, default=None):
+        return self[field] if field in self else default
+
+    def __contains__(self, field) -> bool:
+        return dict.__contains__(self, field) or field in self.sections
+
+    def __iter__(self):
+        yield from list(dict.keys(self)) + list(self.sections)
+
+    def __len__(self) -> int:
+        return dict.__len__(self) + len(self.sections)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[field] for field in self]
+
+    def items(self):
+        return [(field, self[field]) for field in self]
+
+
+class StreamedDict:
+    """
+    Se serializa con pickle como un dict cuyos pares (clave, valor) se van generando
+    mientras se escriben, sin tener el diccionario entero en memoria (ver save_merged_index).
+    Al cargarlo se obtiene un dict normal.
+    """
+
+    def __init__(self, items):
+        """
+        param:  "items": iterador de pares (clave, valor)
+        """
+        self.items = items
+
+    def __reduce__(self):
+        return (dict, (), None, None, self.items)
+
+
+class TermDict:
+    """
+    Diccionario de terminos de solo lectura guardado en bloques ordenados con front coding.
+
+    Los terminos se ordenan y se agrupan en bloques de BLOCK terminos. Del primer termino de
+    cada bloque se guarda la cadena (para la busqueda binaria) y de los demas solo la longitud
+    del prefijo comun con el anterior y el resto de sus bytes en utf-8, todos los bloques
+    seguidos en un unico bytes. Los valores se guardan en una lista en el orden de los terminos.
+
+    Admite las operaciones de dict que usan las consultas (get, [], in, len, keys, values, items
+    e iteracion, en orden) y la enumeracion por prefijo (ver prefix_items).
+    """
+
+    BLOCK = 16
+
+    def __init__(self, mapping:Dict):
+        """
+        param:  "mapping": diccionario con claves str
+        """
+        keys = sorted(mapping)
+        self.vals = [mapping[key] for key in keys]
+        self.heads = [] # primer termino de cada bloque
+        self.offsets = array('Q') # posicion en self.data del resto de terminos de cada bloque
+        data = bytearray()
+        prev = b''
+        for i, key in enumerate(keys):
+            raw = key.encode('utf-8')
+            if i % self.BLOCK == 0:
+                self.heads.append(key)
+                self.offsets.append(len(data))
+            else:
+                lcp = 0
+                n = min(len(prev), len(raw))
+                while lcp < n and prev[lcp] == raw[lcp]:
+                    lcp += 1
+                self.put_len(data, lcp)
+                self.put_len(data, len(raw) - lcp)
+                data += raw[lcp:]
+            prev = raw
+        self.offsets.append(len(data))
+        self.data = bytes(data)
+
+    @staticmethod
+    def put_len(data:bytearray, n:int):
+        """Añade una longitud: un byte si es menor que 255, si no 255 y 4 bytes"""
+        if n < 255:
+            data.append(n)
+        else:
+            data.append(255)
+            data += n.to_bytes(4, 'little')
+
+    @staticmethod
+    def get_len(data:bytes, pos:int) -> tuple:
+        """Lee una longitud guardada con put_len, devuelve (longitud, posicion siguiente)"""
+        n = data[pos]
+        if n < 255:
+            return n, pos + 1
+        return int.from_bytes(data[pos + 1:pos + 5], 'little'), pos + 5
+
+    def iter_block(self, b:int):
+        """Genera los terminos del bloque "b" en utf-8, en orden"""
+        key = self.heads[b].encode('utf-8')
+        yield key
+        data = self.data
+        pos, end = self.offsets[b], self.offsets[b + 1]
+        while pos < end:
+            lcp, pos = self.get_len(data, pos)
+            n, pos = self.get_len(data, pos)
+            key = key[:lcp] + data[pos:pos + n]
+            pos += n
+            yield key
+
+    def find(self, key:str) -> int:
+        """Devuelve la posicion de "key" en el orden de los terminos o -1 si no esta"""
+        if not isinstance(key, str):
+            return -1
+        b = bisect_right(self.heads, key) - 1
+        if b < 0:
+            return -1
+        raw = key.encode('utf-8')
+        for i, term in enumerate(self.iter_block(b)):
+            if term == raw:
+                return b * self.BLOCK + i
+            if term > raw:
+                break
+        return -1
+
+    def get(self, key:str, default=None):
+        pos = self.find(key)
+        return self.vals[pos] if pos >= 0 else default
+
+    def __getitem__(self, key:str):
+        pos = self.find(key)
+        if pos < 0:
+            raise KeyError(key)
+        return self.vals[pos]
+
+    def __contains__(self, key) -> bool:
+        return self.find(key) >= 0
+
+    def __len__(self) -> int:
+        return len(self.vals)
+
+    def __iter__(self):
+        for b in range(len(self.heads)):
+            for term in self.iter_block(b):
+                yield term.decode('utf-8')
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return self.vals
+
+    def items(self):
+        return zip(self, self.vals)
+
+    def prefix_items(self, prefix:str):
+        """Genera en orden los pares (termino, valor) de los terminos con el prefijo dado"""
+        raw = prefix.encode('utf-8')
+        first = max(bisect_right(self.heads, prefix) - 1, 0)
+        for b in range(first, len(self.heads)):
+            for i, term in enumerate(self.iter_block(b)):
+                if term.startswith(raw):
+                    yield term.decode('utf-8'), self.vals[b * self.BLOCK + i]
+                elif term > raw:
+                    return
+
+    def memory(self) -> int:
+        """Bytes que ocupan los terminos y la tabla de valores (sin contar los valores)"""
+        return (sys.getsizeof(self.data) + sys.getsizeof(self.offsets) + sys.getsizeof(self.vals)
+                + sys.getsizeof(self.heads) + sum(sys.getsizeof(head) for head in self.heads))
+
+
+def dict_memory(mapping) -> int:
+    """
+    Bytes que ocupa un diccionario de terminos sin contar sus valores:
+    la tabla hash y las cadenas de las claves, o TermDict.memory()
+    """
+    if isinstance(mapping, TermDict):
+        return mapping.memory()
+    return sys.getsizeof(mapping) + sum(sys.getsizeof(key) for key in mapping)
+
+
+class SuffixVocab:
+    """
+    Vocabulario para las busquedas con comodines sin rotaciones de permuterm.
+
+    Los terminos se ordenan y se concatenan en una unica cadena separados por '$'
+    ("$termino1$termino2$...$"). El suffix array es un array de enteros con las posiciones
+    de la cadena ordenadas por el sufijo que empieza en cada una (hasta el final de su termino),
+    asi que los terminos que empiezan por A ("$A") o acaban en B ("B$") se encuentran con
+    una busqueda binaria. Ocupa unos pocos bytes por caracter del vocabulario, frente a las
+    len(termino) + 1 claves con su lista que necesita el permuterm de cada termino.
+    """
+
+    SEP = '$'
+
+    def __init__(self, terms):
+        """
+        param:  "terms": terminos del vocabulario (p.ej. las claves de un indice), sin '$'
+        """
+        sep = self.SEP
+        self.text = sep + sep.join(sorted(terms)) + sep
+        text = self.text
+        typecode = 'I' if len(text) < 2**32 else 'Q'
+        # posicion del '$' que precede a cada termino (y la del '$' final)
+        self.starts = array(typecode, (i for i, c in enumerate(text) if c == sep))
+        # los sufijos se reparten por sus dos primeros caracteres y cada grupo se ordena por separado,
+        # para no tener a la vez en memoria las claves de todos; las comparaciones nunca pasan
+        # del '$' que cierra el termino del sufijo
+        buckets = {}
+        for i in range(len(text) - 1):
+            bucket = buckets.get(text[i:i + 2])
+            if bucket is None:
+                bucket = buckets[text[i:i + 2]] = array(typecode)
+            bucket.append(i)
+        self.sa = array(typecode)
+        for key in sorted(buckets):
+            self.sa.extend(sorted(buckets.pop(key), key=lambda i: text[i:text.find(sep, i + 1) + 1]))
+
+    def __len__(self) -> int:
+        return len(self.starts) - 1
+
+    def __iter__(self):
+        text, starts = self.text, self.starts
+        for k in range(len(starts) - 1):
+            yield text[starts[k] + 1:starts[k + 1]]
+
+    def find_range(self, pattern:str) -> tuple:
+        """Devuelve el rango [lo, hi) del suffix array de los sufijos que empiezan por el patron"""
+        text, sa, m = self.text, self.sa, len(pattern)
+        lo, hi = 0, len(sa)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if text[sa[mid]:sa[mid] + m] < pattern:
+                lo = mid + 1
+            else:
+                hi = mid
+        first, hi = lo, len(sa)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if text[sa[mid]:sa[mid] + m] <= pattern:
+                lo = mid + 1
+            else:
+                hi = mid
+        return first, lo
+
+    def wildcard(self, prefix:str, suffix:str, exact:bool) -> List[str]:
+        """
+        Devuelve los terminos que empiezan por "prefix" y acaban en "suffix", lo mismo que
+        el permuterm de prefix*suffix (o prefix?suffix, con exact).
+
+        param:  "prefix", "suffix": partes del termino antes y despues del comodin (pueden estar vacias)
+                "exact": True para '?', el comodin es exactamente un caracter
+
+        return: lista de terminos
+        """
+        sep = self.SEP
+        #se busca por la parte mas larga, el resto se comprueba en cada termino
+        if len(prefix) == 0 and len(suffix) == 0:
+            candidates = iter(self)
+        else:
+            text, starts = self.text, self.starts
+            lo, hi = self.find_range(sep + prefix if len(prefix) >= len(suffix) else suffix + sep)
+            ks = sorted({bisect_right(starts, pos) - 1 for pos in self.sa[lo:hi]})
+            candidates = (text[starts[k] + 1:starts[k + 1]] for k in ks)
+        size = len(prefix) + len(suffix)
+        return [term for term in candidates
+                if (len(term) == size + 1 if exact else len(term) >= size)
+                and term.startswith(prefix) and term.endswith(suffix)]
+
+    def memory(self) -> int:
+        """Bytes que ocupan la cadena de terminos, el suffix array y las posiciones de los terminos"""
+        return sys.getsizeof(self.text) + sys.getsizeof(self.sa) + sys.getsizeof(self.starts)
+
+
+def permuterm_memory(ptindex:Optional[Dict], terms) -> tuple:
+    """
+    Memoria de un indice permuterm: (numero de rotaciones, bytes).
+    Si no se ha construido ("ptindex" vacio o None) se estima a partir de "terms": cada termino
+    tiene len(termino) + 1 rotaciones, cada una con su clave, una lista de un termino y una
+    entrada de la tabla hash (unos 48 bytes).
+    """
+    if ptindex:
+        return len(ptindex), dict_memory(ptindex) + sum(sys.getsizeof(val) for val in ptindex.values())
+    keys = nbytes = 0
+    one = sys.getsizeof([None])
+    for term in terms:
+        n = len(term) + 1
+        keys += n
+        nbytes += n * (sys.getsizeof(term) + 1 + one + 48)
+    return keys, nbytes
+
+
+class FieldView:
+    """
+    Indice de un campo (multifield) sobre las posting list etiquetadas de SAR_Indexer.tindex.
+
+    Con la opcion tagged cada termino tiene una unica posting list para todos los campos y cada
+    elemento es (artid << FIELD_BITS) | mascara, con un bit por cada campo distinto de 'all' en el
+    que aparece el termino ('all' contiene el texto de todos los campos, ver field_masks).
+    La vista de un campo quita la mascara y, salvo en 'all', se queda solo con los artículos que
+    tienen su bit, asi que se usa como un dict termino --> posting list de solo lectura.
+    """
+
+    def __init__(self, owner, mask:int):
+        """
+        param:  "owner": SAR_Indexer con las posting list etiquetadas en tindex
+                "mask": bit del campo, 0 para 'all'
+        """
+        self.owner = owner
+        self.mask = mask
+        self._len = None
+
+    def __reduce__(self):
+        #las posting list se guardan en la seccion de tindex, load_info vuelve a crear las vistas
+        return (FieldView, (None, self.mask))
+
+    @property
+    def postings(self):
+        return self.owner.tindex
+
+    def decode(self, pl:List[int]) -> List[int]:
+        """Quita la mascara de una posting list etiquetada y se queda con los artid del campo"""
+        bits, mask = self.owner.FIELD_BITS, self.mask
+        if mask == 0:
+            return [p >> bits for p in pl]
+        return [p >> bits for p in pl if p & mask]
+
+    def get(self, term:str, default=None):
+        pl = self.postings.get(term)
+        if pl is None:
+            return default
+        pl = self.decode(pl)
+        return pl if len(pl) > 0 else default
+
+    def __getitem__(self, term:str):
+        pl = self.get(term)
+        if pl is None:
+            raise KeyError(term)
+        return pl
+
+    def __contains__(self, term) -> bool:
+        return self.get(term) is not None
+
+    def __len__(self) -> int:
+        if self.mask == 0:
+            return len(self.postings)
+        if self._len is None:
+            self._len = sum(1 for _ in self)
+        return self._len
+
+    def __iter__(self):
+        mask = self.mask
+        for term, pl in self.postings.items():
+            if mask == 0 or any(p & mask for p in pl):
+                yield term
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        for term, pl in self.postings.items():
+            pl = self.decode(pl)
+            if len(pl) > 0:
+                yield term, pl
+
+    def values(self):
+        return (pl for _, pl in self.items())
+
+    def prefix_items(self, prefix:str):
+        """Pares (termino, posting list) de los terminos con el prefijo dado, si tindex es un TermDict"""
+        for term, pl in self.postings.prefix_items(prefix):
+            pl = self.decode(pl)
+            if len(pl) > 0:
+                yield term, pl
+
+
+class QueryCursor(ABC):
+    """
+    Cursor sobre el resultado de una consulta: recorre sus artid en orden sin construir
+    las posting list intermedias (ver SAR_Indexer.iter_query).
+
+    "doc" es el artid actual: 0 antes de empezar y END cuando se acaba.
+    advance(target) avanza al primer artid >= target y next() al siguiente; los dos devuelven el nuevo doc.
+    gap(target) devuelve el primer artid >= target que NO esta en el cursor (para los NOT).
+    rest() cuenta los artid que quedan despues de doc y deja el cursor en END.
+    """
+
+    END = sys.maxsize
+
+    def __init__(self):
+        self.doc = 0
+
+    def next(self) -> int:
+        return self.advance(self.doc + 1)
+
+    @abstractmethod
+    def advance(self, target:int) -> int:
+        """Avanza al primer artid >= target y lo devuelve (END si no queda ninguno)"""
+
+    def gap(self, target:int) -> int:
+        """Primer artid >= target que no esta en el cursor, avanzandolo de uno en uno"""
+        while self.advance(target) == target:
+            target += 1
+        return target
+
+    def rest(self) -> int:
+        """Cuenta los artid que quedan recorriendolos, sin guardarlos"""
+        n = 0
+        while self.doc != self.END and self.next() != self.END:
+            n += 1
+        return n
+
+
+class PostingCursor(QueryCursor):
+    """Cursor sobre una posting list, ordenada o bitmap"""
+
+    # primer byte distinto de 0 de un bitmap
+    nonzero = re.compile(b'[^\x00]')
+
+    def __init__(self, p):
+        super().__init__()
+        if isinstance(p, int):
+            self.pl = None
+            self.bitmap = p
+            self.bits = p.to_bytes((p.bit_length() + 7) // 8, 'little')
+        else:
+            self.pl = p
+            self.pos = 0
+
+    def contains(self, artid:int) -> bool:
+        """Indica si el artid esta en la posting list, sin mover el cursor"""
+        if self.pl is None:
+            return self.bitmap >> artid & 1 == 1
+        i = bisect_left(self.pl, artid)
+        return i < len(self.pl) and self.pl[i] == artid
+
+    def gap(self, target:int) -> int:
+        """
+        Primer artid >= target que no esta en la posting list sin recorrer los que si estan:
+        en una lista ordenada sin repetidos pl[j] - j no decrece y es constante en cada tramo de
+        artid consecutivos, asi que el final del tramo se busca por biseccion; en un bitmap es
+        el primer bit a 0 desde target.
+        """
+        if self.pl is None:
+            zeros = ~(self.bitmap >> target)
+            target += (zeros & -zeros).bit_length() - 1
+        else:
+            pl = self.pl
+            i = bisect_left(pl, target, self.pos)
+            if i < len(pl) and pl[i] == target:
+                base = target - i
+                lo, hi = i, len(pl)
+                while hi - lo > 1:
+                    mid = (lo + hi) // 2
+                    if pl[mid] - mid == base:
+                        lo = mid
+                    else:
+                        hi = mid
+                target = pl[lo] + 1
+        self.advance(target)
+        return target
+
+    def rest(self) -> int:
+        """Los artid que quedan salen de la posicion en la lista o del popcount del bitmap"""
+        if self.doc == self.END:
+            return 0
+        if self.pl is not None:
+            n = len(self.pl) - bisect_right(self.pl, self.doc, self.pos)
+        else:
+            n = (self.bitmap >> (self.doc + 1)).bit_count()
+        self.doc = self.END
+        return n
+
+    def advance(self, target:int) -> int:
+        if target <= self.doc:
+            return self.doc
+        if self.pl is not None:
+            self.pos = bisect_left(self.pl, target, self.pos)
+            self.doc = self.pl[self.pos] if self.pos < len(self.pl) else self.END
+            return self.doc
+        #bitmap: primer bit a 1 desde target
+        bits = self.bits
+        i = target >> 3
+        byte = bits[i] >> (target & 7) if i < len(bits) else 0
+        if byte:
+            self.doc = target + (byte & -byte).bit_length() - 1
+        else:
+            m = self.nonzero.search(bits, i + 1)
+            if m is None:
+                self.doc = self.END
+            else:
+                byte = bits[m.start()]
+                self.doc = (m.start() << 3) + (byte & -byte).bit_length() - 1
+        return self.doc
+
+
+class AndCursor(QueryCursor):
+    """AND de varios cursores: cada uno salta hasta el artid del que va por delante"""
+
+    def __init__(self, children:List[QueryCursor]):
+        super().__init__()
+        self.children = children
+
+    def rest(self) -> int:
+        """
+        Si los operandos son posting list (o NOT de posting list) se recorren los artid que quedan
+        de la lista mas corta y se buscan en las demas; si no, se recorre el AND
+        """
+        lists = [c for c in self.children if isinstance(c, PostingCursor)]
+        negated = [c.child for c in self.children if isinstance(c, NotCursor) and isinstance(c.child, PostingCursor)]
+        if self.doc == self.END or len(lists) + len(negated) < len(self.children) or all(c.pl is None for c in lists):
+            return super().rest()
+        lead = min((c for c in lists if c.pl is not None), key=lambda c: len(c.pl))
+        others = [c for c in lists if c is not lead]
+        n = 0
+        for artid in islice(lead.pl, bisect_right(lead.pl, self.doc), None):
+            if all(c.contains(artid) for c in others) and not any(c.contains(artid) for c in negated):
+                n += 1
+        self.doc = self.END
+        return n
+
+    def advance(self, target:int) -> int:
+        if target <= self.doc:
+            return self.doc
+        while target != self.END:
+            for child in self.children:
+                doc = child.advance(target)
+                if doc != target:
+                    target = doc
+                    break
+            else:
+                break
+        self.doc = target
+        return target
+
+
+class OrCursor(QueryCursor):
+    """OR de varios cursores: el menor de sus artid"""
+
+    def __init__(self, children:List[QueryCursor]):
+        super().__init__()
+        self.children = children
+
+    def rest(self) -> int:
+        """
+        Si los operandos son posting list se cuentan los artid que quedan de la mas larga (o del bitmap)
+        y de cada una de las demas los que no estan en las anteriores; si no, se recorre el OR
+        """
+        if self.doc == self.END or not all(isinstance(c, PostingCursor) for c in self.children):
+            return super().rest()
+        children = sorted(self.children, key=lambda c: -1 if c.pl is None else -len(c.pl))
+        if any(c.pl is None for c in children[1:]):
+            return super().rest()
+        doc = self.doc
+        first = children[0]
+        if first.pl is None:
+            n = (first.bitmap >> (doc + 1)).bit_count()
+        else:
+            n = len(first.pl) - bisect_right(first.pl, doc)
+        for i, c in enumerate(children[1:], 1):
+            for artid in islice(c.pl, bisect_right(c.pl, doc), None):
+                if not any(prev.contains(artid) for prev in children[:i]):
+                    n += 1
+        self.doc = self.END
+        return n
+
+    def advance(self, target:int) -> int:
+        if target <= self.doc:
+            return self.doc
+        self.doc = min(child.advance(target) for child in self.children)
+        return self.doc
+
+
+class NotCursor(QueryCursor):
+    """NOT de un cursor: los artid de 1 a "ndocs" que no estan en el"""
+
+    def __init__(self, child:QueryCursor, ndocs:int):
+        super().__init__()
+        self.child = child
+        self.ndocs = ndocs
+
+    def advance(self, target:int) -> int:
+        if target <= self.doc:
+            return self.doc
+        target = self.child.gap(target)
+        self.doc = target if target <= self.ndocs else self.END
+        return self.doc
+
+    def rest(self) -> int:
+        """Los artid que quedan menos los que quedan en el cursor negado"""
+        if self.doc == self.END:
+            return 0
+        doc = self.doc
+        child = self.child.advance(doc + 1)
+        n = self.ndocs - doc - (1 + self.child.rest() if child != self.END else 0)
+        self.doc = self.END
+        return n
+
+
+class QueryTracer:
+    """
+    Lo que se mide al explicar una consulta (ver SAR_Indexer.explain_query), se pasa a eval_query
+    y a lookup_posting. "tree" es el arbol de operadores, cada nodo con 'op', 'size', 'time_ms',
+    'children' y 'term' en las hojas, y "lookups" el numero de llamadas y el tiempo de cada metodo de busqueda.
+    """
+
+    LOOKUPS = ('lookup_posting', 'get_stemming', 'get_permuterm', 'get_fuzzy', 'get_phrase')
+
+    def __init__(self):
+        self.nodes = [] # hijos del nodo que se esta evaluando, el primero de la raiz es el arbol
+        self.lookups = {name: {'calls': 0, 'time_ms': 0.0} for name in self.LOOKUPS}
+
+    @property
+    def tree(self) -> Optional[Dict]:
+        return self.nodes[0] if len(self.nodes) > 0 else None
+
+    def call(self, name:str, fnc, *args):
+        """Llama a fnc(*args) y suma la llamada y su tiempo a las busquedas "name" """
+        stats = self.lookups[name]
+        t0 = time.perf_counter()
+        try:
+            return fnc(*args)
+        finally:
+            stats['calls'] += 1
+            stats['time_ms'] += (time.perf_counter() - t0) * 1000
+
+    @staticmethod
+    def untimed(name:str, fnc, *args):
+        """Como call sin medir nada, para cuando no se explica la consulta"""
+        return fnc(*args)
+
 
 class SAR_Indexer:
     """
@@ -31,9 +792,40 @@ class SAR_Indexer:
     # numero maximo de documento a mostrar cuando self.show_all es False
     SHOW_MAX = 10
 
-    all_atribs = ['urls', 'index', 'sindex', 'ptindex', 'docs', 'weight', 'articles',
-                  'tokenizer', 'stemmer', 'show_all', 'use_stemming']
-
+    all_atribs = ['urls', 'index', 'sindex', 'ptindex', 'uindex', 'docs', 'weight', 'articles',
+                  'tokenizer', 'show_all', 'use_stemming', 'multifield', 'stemming', 'permuterm', 'bitmap',
+                  'fzindex', 'fuzzy', 'nindex', 'npindex', 'unaccent', 'compact', 'saindex', 'suffix',
+                  'tindex', 'tagged', 'bindex', 'biword', 'duplicates']
+    # atributos que con multifield se guardan con una seccion por campo
+    field_atribs = ['index', 'sindex', 'ptindex', 'fzindex', 'nindex', 'npindex', 'saindex']
+    # diccionarios de terminos que con la opcion compact se guardan como TermDict (ver make_compact)
+    compact_atribs = ['index', 'sindex', 'ptindex']
+    # atributos que load_info no deserializa hasta que se usan por primera vez
+    lazy_atribs = ['urls', 'sindex', 'ptindex', 'uindex', 'docs', 'weight', 'articles', 'fzindex',
+                   'nindex', 'npindex', 'saindex', 'tindex', 'bindex', 'duplicates']
+    # con la opcion bitmap, los terminos que aparecen en al menos esta fraccion de los artículos
+    # guardan su posting list como un bitmap (ver make_bitmaps)
+    BITMAP_DENSITY = 1 / 32
+    # a partir de este numero de artid (sumando las dos posting list) AND, OR y except
+    # se calculan con numpy, si esta instalado
+    NUMPY_MIN_SIZE = 1024
+    # distancia de edicion maxima de las busquedas aproximadas (operador ~, ver get_fuzzy)
+    FUZZY_MAX = 2
+    # el indice de borrados solo guarda los borrados de las primeras FUZZY_PREFIX letras de cada termino
+    FUZZY_PREFIX = 7
+    # motivos por los que se corta una expansion (ver set_budget y expand_posting)
+    TRUNCATED_REASONS = {'terms': 'max terms', 'postings': 'max postings', 'timeout': 'timeout'}
+    # estimacion de la memoria de cada artid de una posting list y de cada termino nuevo,
+    # para decidir cuando se vuelca el indice a disco con memory_budget (ver flush_run)
+    RUN_POSTING_BYTES = 9
+    RUN_TERM_BYTES = 200
+    # con la opcion biword solo se guardan los pares de terminos consecutivos que aparecen en al menos
+    # este numero de artículos, el resto de frases se comprueban en el texto (ver get_phrase)
+    BIWORD_MIN_DF = 2
+    # bits de la mascara de campos de las posting list etiquetadas, uno por campo distinto de 'all' (ver FieldView)
+    FIELD_BITS = 3
+    # marca de los ficheros de indice guardados por secciones
+    INDEX_MAGIC = b'SARIDX2\n'
     
 
     def __init__(self):
@@ -49,16 +841,61 @@ class SAR_Indexer:
         self.index = {} # hash para el indice invertido de terminos --> clave: termino, valor: posting list
         self.sindex = {} # hash para el indice invertido de stems --> clave: stem, valor: lista con los terminos que tienen ese stem
         self.ptindex = {} # hash para el indice permuterm.
+        self.tindex = {} # con la opcion tagged, posting list de todos los campos --> clave: termino, valor: lista de artid etiquetados con sus campos (ver FieldView)
+        self.bindex = {} # indice de biwords --> clave: "termino1 termino2" (consecutivos en el texto), valor: posting list (ver get_phrase)
+        self.saindex = {} # vocabulario con suffix array para los comodines, alternativa al permuterm (ver SuffixVocab)
+        self.fzindex = {} # hash para las busquedas aproximadas --> clave: termino con letras borradas, valor: lista de terminos (ver make_fuzzy)
+        self.nindex = {} # hash para las busquedas sin acentos --> clave: termino sin diacriticos (ver fold_term), valor: lista de terminos
+        self.npindex = {} # hash de posting list precalculadas --> clave: termino sin diacriticos con mas de un termino en self.nindex, valor: union de sus posting list
+        self.uindex = {} # urls normalizadas ordenadas para las busquedas por prefijo en el campo url (ver make_urlindex)
         self.docs = {} # diccionario de terminos --> clave: entero(docid),  valor: ruta del fichero.
         self.weight = {} # hash de terminos para el pesado, ranking de resultados.
+        self.duplicates = {} # artículos casi duplicados que no se han indexado --> clave: artid del artículo indexado, valor: lista de urls (ver index_file)
         self.articles = {} # hash de articulos --> clave entero (artid), valor: la info necesaria para diferencia los artículos dentro de su fichero
         self.tokenizer = re.compile("\W+") # expresion regular para hacer la tokenizacion
-        self.permtokenizer = re.compile("[^\w*?:-]+") # expresion regular para hacer la tokenizacion de permuterm
-        self.stemmer = SnowballStemmer('spanish') # stemmer en castellano
+        self.termre = re.compile("\w+") # expresion regular de los terminos, tokenize los extrae con una sola pasada
+        self.onesre = re.compile("1") # expresion regular para recorrer los bits de un bitmap (ver bitmap_to_list)
+        self.permtokenizer = re.compile("[^\w*?:~-]+") # expresion regular para hacer la tokenizacion de permuterm
+        self.phrasere = re.compile(r'((?:[\w-]+:)?"[^"]*")') # expresion regular de las frases entre comillas de las consultas, con su campo
+        self.schemere = re.compile("^[a-z][a-z0-9+.-]*://") # expresion regular para quitar el esquema de las urls
+        self.stemmer = None # stemmer en castellano, se crea la primera vez que se usa (ver la propiedad stemmer)
+        self._loads = None # decodificador json, se elige la primera vez que se usa (ver decode_article)
+        self.bytes_read = 0 # bytes leidos de los ficheros del crawler para mostrar resultados
+        self.progress = None # cada cuantos artículos se muestra el progreso de la indexacion, None para no mostrarlo
+        # tiempo de cada fase de la indexacion y contadores, ver show_metrics()
+        self.metrics = {'phases': {'parsing': 0.0, 'tokenization': 0.0, 'insertion': 0.0,
+                                   'stemming': 0.0, 'permuterm': 0.0, 'suffix': 0.0, 'fuzzy': 0.0, 'unaccent': 0.0,
+                                   'biwords': 0.0, 'dedup': 0.0, 'runs': 0.0, 'serialization': 0.0},
+                        'files': 0, 'articles': 0, 'lines': 0}
         self.show_all = False # valor por defecto, se cambia con self.set_showall()
         self.show_snippet = False # valor por defecto, se cambia con self.set_snippet()
         self.use_stemming = False # valor por defecto, se cambia con self.set_stemming()
+        self.use_unaccent = False # valor por defecto, se cambia con self.set_unaccent()
         self.use_ranking = False  # valor por defecto, se cambia con self.set_ranking()
+        self.max_terms = None # terminos que pueden expandir las consultas, None sin limite, se cambia con self.set_budget()
+        self.max_postings = None # artid de las posting list que pueden expandir las consultas, None sin limite
+        self.query_timeout = None # segundos a partir de los que no se expanden mas terminos, None sin limite
+        self.truncated = [] # expansiones de la ultima consulta cortadas por el presupuesto (ver expand_posting)
+        self._budget = None # lo que queda del presupuesto de la consulta en curso (ver start_query)
+        self.multifield = False # se indica al indexar, ver self.index_dir()
+        self.positional = False
+        self.stemming = False
+        self.permuterm = False
+        self.bitmap = False
+        self.fuzzy = False
+        self.unaccent = False
+        self.compact = False
+        self.suffix = False
+        self.tagged = False
+        self.biword = False
+        self.biword_min_df = self.BIWORD_MIN_DF
+        self._all_bitmap = None # bitmap con todos los artículos, para los NOT sobre bitmaps
+        self._numpy = None # modulo numpy, se importa la primera vez que se necesita (ver get_numpy)
+        self.memory_budget = None # memoria maxima (en bytes) del indice mientras se construye, None sin limite
+        self._simhash = None # huellas de los artículos indexados para descartar los casi duplicados, None sin dedup (ver SimHashIndex)
+        self._runs = None # ficheros con los trozos del indice ya volcados a disco (ver flush_run)
+        self._runs_dir = None
+        self._run_size = 0 # memoria estimada del trozo del indice que aun esta en memoria
 
 
     ###############################
@@ -110,7 +947,55 @@ class SAR_Indexer:
 
         """
         self.use_stemming = v
-    
+
+    def set_unaccent(self, v:bool):
+        """
+
+        Cambia el modo de busqueda sin acentos.
+
+        input: "v" booleano.
+
+        si self.use_unaccent es True los terminos de las consultas se buscan sin tener en cuenta
+        los diacriticos: 'programacion' recupera tambien los artículos con 'programación' (ver get_unaccent).
+
+        """
+        self.use_unaccent = v
+
+    def set_budget(self, max_terms:Optional[int]=None, max_postings:Optional[int]=None, timeout:Optional[float]=None):
+        """
+
+        Cambia el presupuesto de cada consulta para las expansiones de terminos
+        (comodines, stemming, busquedas aproximadas y sin acentos, ver expand_posting).
+
+        input: "max_terms": numero maximo de terminos expandidos
+               "max_postings": numero maximo de artid sumando las posting list de los terminos expandidos
+               "timeout": segundos desde el inicio de la consulta a partir de los que no se expanden mas terminos
+               None (o 0) para no limitar
+
+        si se agota el presupuesto la expansion se queda con los terminos que ya tenia y se apunta en self.truncated
+
+        """
+        self.max_terms = max_terms or None
+        self.max_postings = max_postings or None
+        self.query_timeout = timeout or None
+
+    @property
+    def stemmer(self):
+        """
+        Stemmer en castellano.
+
+        Se crea la primera vez que se necesita, asi importar SAR_lib o resolver
+        consultas sin stemming no paga la carga de nltk.
+        """
+        if self._stemmer is None:
+            from nltk.stem.snowball import SnowballStemmer
+            self._stemmer = SnowballStemmer('spanish')
+        return self._stemmer
+
+    @stemmer.setter
+    def stemmer(self, v):
+        self._stemmer = v
+
     #############################################
     ###                                       ###
     ###      CARGA Y GUARDADO DEL INDICE      ###
@@ -121,23 +1006,149 @@ class SAR_Indexer:
     def save_info(self, filename:str):
         """
         Guarda la información del índice en un fichero en formato binario
-        
+
+        Cada atributo se serializa en su propia sección y al final se añade una
+        cabecera con la posicion de cada sección, de forma que load_info puede
+        cargar solo los atributos que se vayan a usar.
+        Con multifield los atributos de self.field_atribs tienen una sección por campo.
+        Si el indice se ha construido por trozos (memory_budget), la sección del indice
+        se escribe mientras se mezclan los trozos (ver save_merged_index).
+
         """
-        info = [self.all_atribs] + [getattr(self, atr) for atr in self.all_atribs]
+        phases = self.metrics['phases']
+        t0 = time.perf_counter()
+        others = sum(phases.values()) - phases['serialization']
         with open(filename, 'wb') as fh:
-            pickle.dump(info, fh)
+            fh.write(self.INDEX_MAGIC)
+            fh.write(bytes(8)) # hueco para la posicion de la cabecera
+            sections = {}
+            for atr in self.all_atribs:
+                if atr == 'index' and self._runs is not None:
+                    sections[atr] = self.save_merged_index(fh)
+                    continue
+                val = getattr(self, atr)
+                if self.multifield and atr in self.field_atribs:
+                    sections[atr] = {}
+                    written = {} #los campos que comparten indice (ver share_fields) apuntan a la misma seccion
+                    for field, fval in val.items():
+                        if id(fval) in written:
+                            sections[atr][field] = written[id(fval)]
+                            continue
+                        sections[atr][field] = written[id(fval)] = fh.tell()
+                        pickle.dump(fval, fh, pickle.HIGHEST_PROTOCOL)
+                else:
+                    sections[atr] = fh.tell()
+                    pickle.dump(val, fh, pickle.HIGHEST_PROTOCOL)
+            header_pos = fh.tell()
+            pickle.dump({'atribs': self.all_atribs, 'sections': sections}, fh, pickle.HIGHEST_PROTOCOL)
+            fh.seek(len(self.INDEX_MAGIC))
+            fh.write(header_pos.to_bytes(8, 'little'))
+        if self._runs is not None:
+            self.remove_runs()
+        #las fases que se hacen durante la mezcla (stemming, permuterm...) se cuentan aparte
+        phases['serialization'] += time.perf_counter() - t0 - (sum(phases.values()) - phases['serialization'] - others)
+
+    def save_merged_index(self, fh) -> Union[int, Dict[str, int]]:
+        """
+        Escribe la sección del indice mezclando los trozos volcados a disco (ver merge_runs).
+        Las posting list se escriben a medida que salen de la mezcla, asi que en memoria solo
+        queda el vocabulario: self.index pasa a tener como valores None y con el se construyen
+        los indices de stemming, permuterm, etc. (ver make_extras).
+
+        param:  "fh": fichero del indice, abierto para escritura
+
+        return: posicion de la sección o, con multifield, clave: campo, valor: posicion de su sección
+        """
+        min_df = max(1, math.ceil(len(self.articles) * self.BITMAP_DENSITY))
+        tokenized = {field for field, tokenize in self.fields if tokenize}
+        bitmaps = self.metrics['bitmaps'] = {}
+        vocab = {}
+        sections = {}
+
+        def postings(field, items):
+            terms = vocab[field] = {}
+            for _, term, pl in items:
+                terms[term] = None
+                if self.bitmap and field in tokenized and len(pl) >= min_df:
+                    pl = self.list_to_bitmap(pl)
+                    bitmaps[field] = bitmaps.get(field, 0) + 1
+                yield term, pl
+
+        for field, items in groupby(self.merge_runs(), key=itemgetter(0)):
+            sections[field] = fh.tell()
+            pickler = pickle.Pickler(fh, pickle.HIGHEST_PROTOCOL)
+            pickler.fast = True #sin memo, para no guardar una referencia a cada posting list
+            pickler.dump(StreamedDict(postings(field, items)))
+        if self.multifield:
+            for field, _ in self.fields:
+                if field not in sections: #campo sin terminos
+                    sections[field] = fh.tell()
+                    pickle.dump({}, fh, pickle.HIGHEST_PROTOCOL)
+                    vocab[field] = {}
+            self.index = vocab
+        else:
+            if '' not in sections:
+                sections[''] = fh.tell()
+                pickle.dump({}, fh, pickle.HIGHEST_PROTOCOL)
+            self.index = vocab.get('', {})
+        self.make_extras(merged=True)
+        return sections if self.multifield else sections['']
 
     def load_info(self, filename:str):
         """
         Carga la información del índice desde un fichero en formato binario
-        
+
+        Los atributos de self.lazy_atribs no se deserializan aqui, se cargan
+        desde el fichero la primera vez que se accede a ellos (ver __getattr__).
+        Los indices multifield se cargan campo a campo cuando se consultan (ver LazyFields).
+        Tambien acepta los ficheros del formato antiguo (una unica lista serializada).
+
         """
-        #info = [self.all_atribs] + [getattr(self, atr) for atr in self.all_atribs]
         with open(filename, 'rb') as fh:
-            info = pickle.load(fh)
-        atrs = info[0]
-        for name, val in zip(atrs, info[1:]):
-            setattr(self, name, val)
+            if fh.read(len(self.INDEX_MAGIC)) != self.INDEX_MAGIC:
+                #formato antiguo: [nombres de atributos] + valores
+                fh.seek(0)
+                info = pickle.load(fh)
+                atrs = info[0]
+                for name, val in zip(atrs, info[1:]):
+                    setattr(self, name, val)
+                if getattr(self, 'tagged', False):
+                    self.make_field_views()
+                return
+            header_pos = int.from_bytes(fh.read(8), 'little')
+            fh.seek(header_pos)
+            header = pickle.load(fh)
+            self._lazy = {}
+            for name in header['atribs']:
+                pos = header['sections'][name]
+                if isinstance(pos, dict):
+                    #una seccion por campo
+                    setattr(self, name, LazyFields(filename, pos))
+                elif name in self.lazy_atribs:
+                    #quitamos el valor por defecto para que el acceso pase por __getattr__
+                    self.__dict__.pop(name, None)
+                    self._lazy[name] = (filename, pos)
+                else:
+                    fh.seek(pos)
+                    setattr(self, name, pickle.load(fh))
+        if self.tagged:
+            self.make_field_views()
+
+    def __getattr__(self, name:str):
+        """
+        Solo se llama cuando "name" no es un atributo del objeto: si es un atributo
+        pendiente de cargar (ver load_info) lo deserializa desde su sección del fichero.
+
+        """
+        lazy = self.__dict__.get('_lazy')
+        if lazy is None or name not in lazy:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        filename, pos = lazy.pop(name)
+        with open(filename, 'rb') as fh:
+            fh.seek(pos)
+            val = pickle.load(fh)
+        setattr(self, name, val)
+        return val
 
     ###############################
     ###                         ###
@@ -177,42 +1188,251 @@ class SAR_Indexer:
         
         Recorre recursivamente el directorio "root"  y indexa su contenido
         los argumentos adicionales "**args" solo son necesarios para las funcionalidades ampliadas
+        "root" tambien puede ser una lista de ficheros (p.ej. los de un shard, ver SAR_Shard_lib)
 
         """
         self.multifield = args['multifield']
         self.positional = args['positional']
         self.stemming = args['stem']
         self.permuterm = args['permuterm']
+        self.bitmap = args.get('bitmap', False)
+        self.fuzzy = args.get('fuzzy', False)
+        self.unaccent = args.get('unaccent', False)
+        self.compact = args.get('compact', False)
+        self.suffix = args.get('suffix', False)
+        self.tagged = args.get('tagged', False) and self.multifield
+        if self.tagged and (self.bitmap or args.get('memory_budget') is not None):
+            raise ValueError('tagged postings are not compatible with bitmap or memory_budget')
+        self.biword = args.get('biword', False)
+        if args.get('biword_min_df') is not None:
+            self.biword_min_df = args['biword_min_df']
+        if self.biword and args.get('memory_budget') is not None:
+            raise ValueError('biwords are not compatible with memory_budget')
+        if self.tagged:
+            self.make_field_views()
+        if args.get('dedup') is not None:
+            self._simhash = SimHashIndex(args['dedup'])
+            self.metrics['duplicates'] = {'articles': 0, 'postings': 0}
+        self.progress = args.get('progress')
+        if args.get('memory_budget') is not None:
+            #construccion por trozos: el indice se vuelca a disco cada vez que llega al limite
+            self.memory_budget = int(args['memory_budget'] * 2**20)
+            self._runs = []
+            self._runs_dir = tempfile.mkdtemp(prefix='sar_runs_', dir=args.get('runs_dir'))
+        self._t_start = time.perf_counter()
+
+        for filename in (root if isinstance(root, list) else self.get_files(root)):
+            self.index_file(filename)
+
+        if self._runs is not None:
+            #el ultimo trozo tambien va a disco, el resto se hace al mezclarlos en save_info
+            self.flush_run()
+            return
+        self.make_extras()
+
+    def make_extras(self, merged:bool=False):
+        """
+        Construye los indices de las funcionalidades extra a partir de self.index.
 
-        file_or_dir = Path(root)
-        
-        if file_or_dir.is_file():
-            # is a file
-            self.index_file(root)
-        elif file_or_dir.is_dir():
-            # is a directory
-            for d, _, files in os.walk(root):
-                for filename in sorted(files):
-                    if filename.endswith('.json'):
-                        fullname = os.path.join(d, filename)
-                        self.index_file(fullname)
-        else:
-            print(f"ERROR:{root} is not a file nor directory!", file=sys.stderr)
-            sys.exit(-1)
+        param:  "merged": True si self.index solo tiene el vocabulario porque las posting list
+                se han escrito directamente en el fichero (ver save_merged_index): no se calculan
+                las uniones de npindex (get_unaccent las calcula al consultar), los bitmaps ya se
+                han hecho al escribir y no se usa front coding.
 
+        """
         ###########################################
         ## COMPLETADO PARA FUNCIONALIDADES EXTRA ##
         ###########################################
 
+        phases = self.metrics['phases']
         #si esta activado el uso de stemming llamamos a make_stemming para rellenar sel.sindex
         if self.stemming:
+            t0 = time.perf_counter()
             self.make_stemming()
+            phases['stemming'] += time.perf_counter() - t0
   
         #si esta activado el uso de permuterm llamamos a make_permuterm para rellenar self.ptindex
         if self.permuterm:
+            t0 = time.perf_counter()
             self.make_permuterm()
+            phases['permuterm'] += time.perf_counter() - t0
+
+        #si esta activada la opcion suffix construimos el suffix array del vocabulario para los comodines
+        if self.suffix:
+            t0 = time.perf_counter()
+            self.make_suffix_array()
+            phases['suffix'] += time.perf_counter() - t0
+
+        #si esta activada la opcion biword quitamos los biwords poco frecuentes
+        if self.biword and not merged:
+            t0 = time.perf_counter()
+            self.make_biwords()
+            phases['biwords'] += time.perf_counter() - t0
+
+        #si esta activada la opcion unaccent precalculamos las posting list de los terminos sin acentos
+        if self.unaccent:
+            t0 = time.perf_counter()
+            if merged:
+                if self.multifield:
+                    for field, tokenize in self.fields:
+                        if tokenize:
+                            self.nindex[field] = self.build_unaccent(self.index[field])
+                else:
+                    self.nindex = self.build_unaccent(self.index)
+            else:
+                self.make_unaccent()
+            phases['unaccent'] += time.perf_counter() - t0
+
+        #si esta activada la opcion fuzzy llamamos a make_fuzzy para rellenar self.fzindex
+        if self.fuzzy:
+            t0 = time.perf_counter()
+            self.make_fuzzy()
+            phases['fuzzy'] += time.perf_counter() - t0
+
+        #con multifield ordenamos las urls para las busquedas por prefijo
+        if self.multifield:
+            self.make_urlindex()
+
+        #si esta activada la opcion bitmap pasamos a bitmap las posting list de los terminos mas frecuentes
+        if self.bitmap and not merged:
+            self.make_bitmaps()
+
+        #si esta activada la opcion compact guardamos los diccionarios de terminos con front coding
+        if self.compact and not merged:
+            self.make_compact()
+
+    def flush_run(self):
+        """
+        Vuelca a disco el trozo del indice que hay en memoria y lo vacia (construccion SPIMI).
+        El trozo se guarda ordenado por (campo, termino), un par ((campo, termino), posting list)
+        detras de otro, para poder mezclarlos despues leyendolos en secuencia (ver merge_runs).
+        Sin multifield el campo es ''.
+        """
+        if self.multifield:
+            indexes = sorted(self.index.items())
+        else:
+            indexes = [('', self.index)]
+        filename = os.path.join(self._runs_dir, f'run{len(self._runs):05d}.pkl')
+        with open(filename, 'wb') as fh:
+            for field, index in indexes:
+                for term in sorted(index):
+                    pickle.dump(((field, term), index[term]), fh, pickle.HIGHEST_PROTOCOL)
+                index.clear()
+        self._runs.append(filename)
+        self._run_size = 0
+
+    def read_run(self, filename:str):
+        """Genera los pares ((campo, termino), posting list) de un trozo volcado por flush_run"""
+        with open(filename, 'rb') as fh:
+            while True:
+                try:
+                    yield pickle.load(fh)
+                except EOFError:
+                    return
+
+    def merge_runs(self):
+        """
+        Mezcla los trozos volcados a disco leyendolos a la vez en orden (k-way merge).
+        Los artid de cada trozo son mayores que los del anterior y heapq.merge deja los
+        pares con la misma clave en el orden de los trozos, asi que basta con concatenar
+        las posting list de cada termino.
+
+        return: generador de tuplas (campo, termino, posting list) ordenadas por campo y termino
+        """
+        runs = [self.read_run(filename) for filename in self._runs]
+        for (field, term), group in groupby(heapq.merge(*runs, key=itemgetter(0)), key=itemgetter(0)):
+            pl = []
+            for _, part in group:
+                pl.extend(part)
+            yield field, term, pl
+
+    def remove_runs(self):
+        """Borra los trozos volcados a disco una vez mezclados"""
+        shutil.rmtree(self._runs_dir, ignore_errors=True)
+        self._runs = None
+        self._runs_dir = None
+        
         
+    def get_files(self, root:str) -> List[str]:
+        """
+        Devuelve los ficheros que indexa index_dir, en el orden en que los indexa
+
+        Args:
+            root: fichero o directorio, los directorios se recorren recursivamente buscando ficheros .json
+
+        Returns:
+            List[str]: lista de ficheros
+        """
+        file_or_dir = Path(root)
         
+        if file_or_dir.is_file():
+            # is a file
+            return [root]
+        elif file_or_dir.is_dir():
+            # is a directory
+            files_list = []
+            for d, _, files in os.walk(root):
+                for filename in sorted(files):
+                    if filename.endswith('.json'):
+                        files_list.append(os.path.join(d, filename))
+            return files_list
+        else:
+            print(f"ERROR:{root} is not a file nor directory!", file=sys.stderr)
+            sys.exit(-1)
+
+    def decode_article(self, raw_line:str) -> Dict:
+        """
+        Decodifica una linea json del crawler.
+        Si esta instalado orjson se usa su decodificador, que es bastante mas rapido;
+        si no, o si orjson rechaza la linea, se usa json.loads. El resultado es el mismo.
+
+        Args:
+            raw_line: una linea del fichero generado por el crawler
+
+        Returns:
+            Dict: el artículo tal como lo guarda el crawler
+        """
+        if self._loads is None:
+            try:
+                import orjson
+                self._loads = orjson.loads
+            except ImportError:
+                self._loads = json.loads
+        try:
+            return self._loads(raw_line)
+        except ValueError:
+            return json.loads(raw_line)
+
+    def iter_articles(self, filename:str):
+        """
+        Recorre un fichero del crawler sin cargarlo entero en memoria
+
+        Args:
+            filename: fichero generado por el crawler, cada línea es un objeto json
+
+        Returns:
+            generador de tuplas (posicion del artículo en el fichero, artículo decodificado)
+        """
+        with open(filename, encoding='utf-8') as fh:
+            for i, line in enumerate(fh):
+                yield i, self.decode_article(line)
+
+    def read_article(self, artid:int) -> Dict[str, str]:
+        """
+        Lee y parsea un artículo indexado, leyendo su fichero solo hasta la linea del artículo
+
+        Args:
+            artid: identificador del artículo
+
+        Returns:
+            Dict[str, str]: el artículo, ver parse_article
+        """
+        docid, linea = self.articles[artid]
+        with open(self.docs[docid], 'rb') as fh:
+            for line in islice(fh, linea + 1):
+                self.bytes_read += len(line)
+        return self.parse_article(line.decode('utf-8'))
+
     def parse_article(self, raw_line:str) -> Dict[str, str]:
         """
         Crea un diccionario a partir de una linea que representa un artículo del crawler
@@ -224,16 +1444,17 @@ class SAR_Indexer:
             Dict[str, str]: claves: 'url', 'title', 'summary', 'all', 'section-name'
         """
         
-        article = json.loads(raw_line)
+        article = self.decode_article(raw_line)
         sec_names = []
-        txt_secs = ''
+        #acumulamos los trozos y los unimos al final para no copiar el texto en cada +=
+        txt_all = [article['title'], '\n\n', article['summary'], '\n\n']
         for sec in article['sections']:
-            txt_secs += sec['name'] + '\n' + sec['text'] + '\n'
-            txt_secs += '\n'.join(subsec['name'] + '\n' + subsec['text'] + '\n' for subsec in sec['subsections']) + '\n\n'
+            txt_all += [sec['name'], '\n', sec['text'], '\n']
+            txt_all += ['\n'.join(subsec['name'] + '\n' + subsec['text'] + '\n' for subsec in sec['subsections']), '\n\n']
             sec_names.append(sec['name'])
             sec_names.extend(subsec['name'] for subsec in sec['subsections'])
         article.pop('sections') # no la necesitamos 
-        article['all'] = article['title'] + '\n\n' + article['summary'] + '\n\n' + txt_secs
+        article['all'] = ''.join(txt_all)
         article['section-name'] = '\n'.join(sec_names)
 
         return article
@@ -269,9 +1490,18 @@ class SAR_Indexer:
             for field in self.fields:
                 if self.index.get(field[0]) is None:
                     self.index[field[0]] = {}
+                #con la opcion unaccent cada termino nuevo se añade tambien a self.nindex
+                if self.unaccent and field[1] and self.nindex.get(field[0]) is None:
+                    self.nindex[field[0]] = {}
         
-        for i, line in enumerate(open(filename)):
-            j = self.parse_article(line)
+        self.metrics['files'] += 1
+        phases = self.metrics['phases']
+        clock = time.perf_counter
+        t0 = clock()
+        for i, j in self.iter_articles(filename):
+            t1 = clock()
+            phases['parsing'] += t1 - t0
+            self.metrics['lines'] += 1
         #
         # 
         # En la version basica solo se debe indexar el contenido "article"
@@ -284,41 +1514,147 @@ class SAR_Indexer:
 
             #si el articulo ya esta indexado, no lo indexamos de nuevo
             if self.already_in_index(j):
+                t0 = clock()
                 continue
+            #tokenizamos cada segmento del articulo una sola vez, cada campo es un conjunto de terminos
+            #asi cada termino se añade una sola vez a su posting list y esta queda ordenada
+            terms = self.tokenize_fields(j)
+            t2 = clock()
+            phases['tokenization'] += t2 - t1
+            #con dedup, si el articulo es casi igual a uno ya indexado solo apuntamos su url junto al otro
+            if self._simhash is not None:
+                #los artículos sin terminos no tienen huella (ver SimHashIndex.fingerprint)
+                fingerprint = self._simhash.fingerprint(terms['all'])
+                matches = self._simhash.find(fingerprint) if fingerprint is not None else []
+                if len(matches) > 0:
+                    self.skip_duplicate(j, terms, matches[0][1])
+                    t0 = clock()
+                    phases['dedup'] += t0 - t2
+                    continue
             #sacamos el id para la clave articulo y guardamos en su valor una tupla de docid y la posicion del articulo en el fichero
-            artic= list(self.articles.items())
-            artid=len(artic)+1
+            artid = len(self.articles) + 1
             self.articles[artid] =(docid,i)
-            if self.multifield:
-                #iteramos sobre field para ver que campos tenemos que tokenizar, dentro de los que hay que tokenizar iteramos sobre los tokens y los guardamos en el indice con una posting list de los articulos en los que aparece
-               
+            if self._simhash is not None:
+                if fingerprint is not None:
+                    self._simhash.add(fingerprint, artid)
+                t1, t2 = t2, clock()
+                phases['dedup'] += t2 - t1
+            if self._runs is not None:
+                vocab = self.vocab_size()
+            if self.tagged:
+                #una sola posting list por termino, cada artid con la mascara de los campos en los que aparece (ver FieldView)
+                masks = {}
+                for field, bit in self.field_masks().items():
+                    for token in terms[field]:
+                        masks[token] = masks.get(token, 0) | bit
+                #los 2**FIELD_BITS valores posibles del artículo se crean una vez y las posting list los comparten
+                tags = [artid << self.FIELD_BITS | mask for mask in range(1 << self.FIELD_BITS)]
+                tindex = self.tindex
+                nindex = self.nindex[self.def_field] if self.unaccent else None
+                for token in terms[self.def_field]:
+                    if token in tindex:
+                        tindex[token].append(tags[masks.get(token, 0)])
+                    else:
+                        tindex[token] = [tags[masks.get(token, 0)]]
+                        if nindex is not None:
+                            nindex.setdefault(fold_term(token), []).append(token)
+                for field, tokenize in self.fields:
+                    if not tokenize:
+                        self.index[field].setdefault(self.normalize_url(j[field]), []).append(artid)
+            elif self.multifield:
+                #iteramos sobre field para ver que campos tenemos que tokenizar, los terminos de cada uno se guardan en su indice con una posting list de los articulos en los que aparece
                 for tupla in self.fields:
                     if tupla[1]:
-                        for token in self.tokenize(j[tupla[0]]):
-                            if self.index[tupla[0]].get(token) is None:
-                                self.index[tupla[0]][token] = [artid]
-                            elif artid not in self.index[tupla[0]][token]:
-                                self.index[tupla[0]][token].append(artid)
+                        index = self.index[tupla[0]]
+                        nindex = self.nindex[tupla[0]] if self.unaccent and self._runs is None else None
+                        for token in terms[tupla[0]]:
+                            if token in index:
+                                index[token].append(artid)
+                            else:
+                                index[token] = [artid]
+                                if nindex is not None:
+                                    nindex.setdefault(fold_term(token), []).append(token)
+                    else:
+                        #los campos que no se tokenizan (url) se indexan enteros, normalizados
+                        self.index[tupla[0]].setdefault(self.normalize_url(j[tupla[0]]), []).append(artid)
+            #si no es multifield, guardamos los terminos de 'all' en el indice con una posting list de los articulos en los que aparece
+            else:
+                index = self.index
+                nindex = self.nindex if self.unaccent and self._runs is None else None
+                for token in terms['all']:
+                    if token in index:
+                        index[token].append(artid)
                     else:
-                        self.index[tupla[0]] = j[tupla[0]]           
-               #si no es multifield, tokenizamos el texto de j[all] iteramos sobre los tokens y los guardamos en el indice con una posting list de los articulos en los que aparece
-            else:        
-              txt = j['all']
-              tokens_list = self.tokenize(txt)
-              for token in tokens_list:
-                  if self.index.get(token) is None:
-                      self.index[token] = [artid]
-                  elif self.index[token].count(artid) == 0:
-                      self.index[token].append(artid)
-            self.urls.add(j['url'])    
+                        index[token] = [artid]
+                        if nindex is not None:
+                            nindex.setdefault(fold_term(token), []).append(token)
+            if self.biword:
+                bindex = self.bindex
+                for pair in terms['biwords']:
+                    if pair in bindex:
+                        bindex[pair].append(artid)
+                    else:
+                        bindex[pair] = [artid]
+            self.urls.add(j['url'])
+            t0 = clock()
+            phases['insertion'] += t0 - t2
+            if self._runs is not None:
+                #memoria estimada del trozo: un artid mas por termino del artículo y los terminos nuevos
+                self._run_size += (sum(len(t) for t in terms.values()) * self.RUN_POSTING_BYTES
+                                   + (self.vocab_size() - vocab) * self.RUN_TERM_BYTES)
+                if self._run_size >= self.memory_budget:
+                    self.flush_run()
+                    t1, t0 = t0, clock()
+                    phases['runs'] += t0 - t1
+            self.metrics['articles'] += 1
+            if self.progress and self.metrics['articles'] % self.progress == 0:
+                self.show_progress()
+
+
+    def skip_duplicate(self, article:Dict, terms:Dict[str, set], artid:int):
+        """
+        Descarta un artículo casi igual a otro ya indexado: su url se guarda en self.duplicates
+        junto al artid del otro y se cuentan las posting list en las que ya no se añade.
+
+        param:  "article": artículo descartado
+                "terms": sus terminos por campo (ver tokenize_fields)
+                "artid": artículo indexado del que es casi duplicado
+
+        """
+        self.duplicates.setdefault(artid, []).append(article['url'])
+        self.urls.add(article['url'])
+        if self.multifield:
+            postings = sum(len(terms[field]) if tokenize else 1 for field, tokenize in self.fields)
+        else:
+            postings = len(terms['all'])
+        if self.biword:
+            postings += len(terms['biwords'])
+        stats = self.metrics['duplicates']
+        stats['articles'] += 1
+        stats['postings'] += postings
+
+    def vocab_size(self) -> int:
+        """Numero de terminos que hay en memoria en self.index, sumando todos los campos"""
+        if self.multifield:
+            return sum(len(index) for index in self.index.values())
+        return len(self.index)
 
+    def show_progress(self):
+        """
+        Muestra por la salida de error cuantos artículos se han indexado,
+        a que velocidad y la memoria que ocupa el proceso.
+        """
+        elapsed = time.perf_counter() - self._t_start
+        articles = self.metrics['articles']
+        print(f"{articles} articles, {articles / elapsed if elapsed > 0 else 0:.1f} articles/s, "
+              f"{current_memory() / 2**20:.1f} MB", file=sys.stderr)
 
     def tokenize(self, text:str):
         """
         NECESARIO PARA TODAS LAS VERSIONES
 
         Tokeniza la cadena "texto" eliminando simbolos no alfanumericos y dividientola por espacios.
-        Puedes utilizar la expresion regular 'self.tokenizer'.
+        Equivale a self.tokenizer.sub(' ', text.lower()).split() pero con una sola pasada de 'self.termre'.
 
         params: 'text': texto a tokenizar
 
@@ -326,7 +1662,135 @@ class SAR_Indexer:
 
         """
         
-        return self.tokenizer.sub(' ', text.lower()).split()
+        return self.termre.findall(text.lower())
+
+    def get_segments(self, article:Dict):
+        """
+        Recorre los fragmentos de texto de un artículo tal como lo guarda el crawler
+
+        Args:
+            article (Dict): diccionario con las claves 'title', 'summary' y 'sections'
+
+        Returns:
+            generador de tuplas (campo, texto), el campo es None para el texto de
+            las secciones, que solo forma parte de 'all'
+        """
+        yield 'title', article['title']
+        yield 'summary', article['summary']
+        for sec in article['sections']:
+            yield 'section-name', sec['name']
+            yield None, sec['text']
+            for subsec in sec['subsections']:
+                yield 'section-name', subsec['name']
+                yield None, subsec['text']
+
+    def tokenize_fields(self, article:Dict) -> Dict[str, set]:
+        """
+        Tokeniza una sola vez cada fragmento de un artículo (ver get_segments).
+
+        'all' es la concatenacion de todos los fragmentos separados por saltos de linea,
+        asi que sus terminos son la union de los terminos de cada fragmento y no hace
+        falta volver a tokenizar el texto completo.
+
+        Args:
+            article (Dict): diccionario con la información de un artículo tal como lo guarda el crawler
+
+        Returns:
+            Dict[str, set]: clave: campo que se tokeniza, valor: conjunto de terminos del campo
+                            sin multifield solo se devuelve 'all'.
+                            Con la opcion biword, en 'biwords' los pares "termino1 termino2" de
+                            terminos consecutivos dentro de un mismo fragmento.
+        """
+        findall = self.termre.findall
+        biwords = set() if self.biword else None
+        if not self.multifield:
+            terms = set()
+            for _, text in self.get_segments(article):
+                tokens = findall(text.lower())
+                terms.update(tokens)
+                if biwords is not None:
+                    biwords.update(map(' '.join, zip(tokens, tokens[1:])))
+            res = {'all': terms}
+            if biwords is not None:
+                res['biwords'] = biwords
+            return res
+
+        terms = {field: set() for field, tokenize in self.fields if tokenize}
+        allterms = terms['all']
+        for field, text in self.get_segments(article):
+            tokens = findall(text.lower())
+            if field is not None:
+                terms[field].update(tokens)
+            allterms.update(tokens)
+            if biwords is not None:
+                biwords.update(map(' '.join, zip(tokens, tokens[1:])))
+        if biwords is not None:
+            terms['biwords'] = biwords
+        return terms
+
+    def normalize_url(self, url:str) -> str:
+        """
+        Normaliza una url para el indice del campo url: minusculas, sin esquema,
+        sin codificacion %XX y sin '/' final.
+
+        params: 'url': url a normalizar
+
+        return: url normalizada
+        """
+        return self.schemere.sub('', unquote(url).strip().lower()).rstrip('/')
+
+    def field_masks(self) -> Dict[str, int]:
+        """Bit de cada campo que se tokeniza, salvo self.def_field, en las posting list etiquetadas (ver FieldView)"""
+        masks = {}
+        for field, tokenize in self.fields:
+            if tokenize and field != self.def_field:
+                masks[field] = 1 << len(masks)
+        return masks
+
+    def make_field_views(self):
+        """Con la opcion tagged, el indice de cada campo que se tokeniza es una vista de self.tindex"""
+        for field, mask in [(self.def_field, 0)] + list(self.field_masks().items()):
+            if isinstance(self.index, LazyFields):
+                self.index.sections.pop(field, None)
+            self.index[field] = FieldView(self, mask)
+
+    def extra_fields(self) -> List[str]:
+        """
+        Campos para los que se construyen los indices de stemming, permuterm, etc. con multifield:
+        los que se tokenizan o, con la opcion tagged, solo self.def_field, porque el vocabulario
+        de los demas campos esta incluido en el suyo y se comparte (ver share_fields).
+        """
+        if self.tagged:
+            return [self.def_field]
+        return [field for field, tokenize in self.fields if tokenize]
+
+    def share_fields(self, name:str):
+        """
+        Con la opcion tagged, los campos que se tokenizan usan el indice "name" (sindex, ptindex...)
+        de self.def_field: los terminos que no estan en el campo no tienen posting list en su vista.
+        """
+        if self.tagged:
+            indexes = getattr(self, name)
+            for field in self.field_masks():
+                indexes[field] = indexes[self.def_field]
+
+    def make_urlindex(self):
+        """
+
+        Crea self.uindex a partir de las claves de self.index['url']:
+            'urls': lista ordenada de urls normalizadas
+            'paths': lista ordenada de tuplas (ruta, url) para los patrones que empiezan por '*/'
+
+        NECESARIO PARA LAS BUSQUEDAS POR PREFIJO EN EL CAMPO URL
+
+        """
+        urls = sorted(self.index['url'])
+        paths = []
+        for url in urls:
+            pos = url.find('/')
+            paths.append((url[pos:] if pos >= 0 else '', url))
+        paths.sort()
+        self.uindex = {'urls': urls, 'paths': paths}
 
     def make_stemming(self):#Luis José Ferrer Estellés y  Diana Bachynska
         """
@@ -346,6 +1810,8 @@ class SAR_Indexer:
 
         if self.multifield:
             for tupla in self.fields:
+                if tupla[0] not in self.extra_fields(): #los campos que no se tokenizan no tienen stems
+                    continue
                 self.sindex[tupla[0]] = {}
                 for token in self.index[tupla[0]]:
                     stem = self.stemmer.stem(token)
@@ -353,7 +1819,8 @@ class SAR_Indexer:
                         self.sindex[tupla[0]][stem] = []
                     if token not in self.sindex[tupla[0]][stem]:
                         self.sindex[tupla[0]][stem].append(token)
-                    
+            self.share_fields('sindex')
+
                 
         else:
             for token in self.index:
@@ -383,6 +1850,8 @@ class SAR_Indexer:
         #si es multifield creamos un indice permuterm para cada campo
         if self.multifield:
             for field in self.fields:
+                if field[0] not in self.extra_fields(): #los campos que no se tokenizan tienen su propio indice (ver make_urlindex)
+                    continue
                 #creamos un indice permuterm para cada campo
                 if self.ptindex.get(field[0]) is None:
                     self.ptindex[field[0]] = {}
@@ -398,6 +1867,7 @@ class SAR_Indexer:
                         #si el token no esta en el indice permuterm, lo añadimos
                         if token not in self.ptindex[field[0]][perm]:
                             self.ptindex[field[0]][perm].append(token)
+            self.share_fields('ptindex')
         else:
             for token in self.index:
                 perms = self.get_perms(token)
@@ -413,6 +1883,190 @@ class SAR_Indexer:
 
 
 
+    def make_suffix_array(self):
+        """
+
+        Crea el vocabulario con suffix array (self.saindex) de cada indice, que resuelve los
+        comodines en lugar del permuterm (ver get_permuterm y SuffixVocab).
+        Guarda en self.metrics['wildcards'] la memoria del permuterm (medida si se ha construido,
+        si no estimada) y la del suffix array.
+
+        """
+        fields = self.extra_fields() if self.multifield else [None]
+        rotations = permuterm = suffixes = suffix = 0
+        for field in fields:
+            index = self.index[field] if field is not None else self.index
+            ptindex = self.ptindex.get(field) if field is not None else self.ptindex
+            vocab = SuffixVocab(index)
+            if field is not None:
+                self.saindex[field] = vocab
+            else:
+                self.saindex = vocab
+            keys, nbytes = permuterm_memory(ptindex, index)
+            rotations += keys
+            permuterm += nbytes
+            suffixes += len(vocab.sa)
+            suffix += vocab.memory()
+        if self.multifield:
+            self.share_fields('saindex')
+        self.metrics['wildcards'] = {'permuterm': [rotations, permuterm, bool(self.permuterm)],
+                                     'suffix array': [suffixes, suffix]}
+
+    def make_biwords(self):
+        """
+
+        Poda el indice de biwords que se rellena en index_file: solo se quedan los pares que aparecen
+        en al menos self.biword_min_df artículos. Las frases con un par podado se resuelven con el AND
+        de sus terminos comprobando el texto (ver get_phrase), asi que la poda solo cambia la velocidad.
+        Guarda en self.metrics['biwords'] los pares antes y despues de podar y la memoria del indice.
+
+        """
+        total = len(self.bindex)
+        self.bindex = {pair: pl for pair, pl in self.bindex.items() if len(pl) >= self.biword_min_df}
+        self.metrics['biwords'] = {'total': total, 'kept': len(self.bindex), 'min_df': self.biword_min_df,
+                                   'postings': sum(len(pl) for pl in self.bindex.values()),
+                                   'memory': dict_memory(self.bindex) + sum(sys.getsizeof(pl) for pl in self.bindex.values())}
+
+    def build_unaccent(self, index:Dict) -> Dict[str, List[str]]:
+        """
+        Construye el indice de terminos sin acentos de "index":
+        clave: termino sin diacriticos (ver fold_term), valor: lista de terminos con esa forma.
+        index_file lo va rellenando con los terminos nuevos, esto solo se usa
+        con los indices creados sin la opcion unaccent (ver get_nindex).
+        """
+        nindex = {}
+        for term in index:
+            nindex.setdefault(fold_term(term), []).append(term)
+        return nindex
+
+    def build_npindex(self, index:Dict, nindex:Dict) -> Dict:
+        """
+        Precalcula la union de las posting list de los terminos sin acentos que
+        corresponden a mas de un termino, asi una busqueda sin acentos es un solo acceso al hash.
+        """
+        npindex = {}
+        for folded, terms in nindex.items():
+            if len(terms) > 1:
+                res = []
+                for term in terms:
+                    res = self.or_posting(res, index[term])
+                npindex[folded] = res
+        return npindex
+
+    def make_unaccent(self):
+        """
+
+        Calcula self.npindex a partir de self.nindex, que se rellena en index_file.
+
+        """
+        if self.multifield:
+            for field in self.extra_fields():
+                self.npindex[field] = self.build_npindex(self.index[field], self.nindex[field])
+            #las uniones precalculadas no se comparten, son las de self.def_field
+            self.share_fields('nindex')
+        else:
+            self.npindex = self.build_npindex(self.index, self.nindex)
+
+    def get_deletes(self, term:str, max_dist:int) -> set:
+        """
+        Devuelve las cadenas que se obtienen borrando hasta "max_dist" letras
+        de las primeras self.FUZZY_PREFIX letras de "term" (incluida la cadena sin borrados)
+        """
+        level = {term[:self.FUZZY_PREFIX]}
+        res = set(level)
+        for _ in range(max_dist):
+            level = {t[:i] + t[i + 1:] for t in level for i in range(len(t))}
+            res |= level
+        return res
+
+    def build_fuzzy(self, index:Dict) -> Dict[str, List[str]]:
+        """
+        Construye el indice de borrados (SymSpell) de los terminos de "index":
+        clave: cadena obtenida borrando hasta self.FUZZY_MAX letras de un termino, valor: lista de esos terminos.
+        Dos terminos a distancia d <= self.FUZZY_MAX comparten alguna cadena con d borrados como mucho,
+        asi que los candidatos de una busqueda se encuentran con unos pocos accesos al hash.
+        """
+        fzindex = {}
+        for term in index:
+            for key in self.get_deletes(term, self.FUZZY_MAX):
+                if key in fzindex:
+                    fzindex[key].append(term)
+                else:
+                    fzindex[key] = [term]
+        return fzindex
+
+    def make_fuzzy(self):
+        """
+
+        Crea el indice de borrados (self.fzindex) para los terminos de todos los indices,
+        se usa en las busquedas aproximadas (ver get_fuzzy).
+
+        """
+        if self.multifield:
+            for field in self.extra_fields(): #los campos que no se tokenizan no tienen busquedas aproximadas
+                self.fzindex[field] = self.build_fuzzy(self.index[field])
+            self.share_fields('fzindex')
+        else:
+            self.fzindex = self.build_fuzzy(self.index)
+
+    def make_compact(self):
+        """
+
+        Sustituye los diccionarios de terminos de self.index, self.sindex y self.ptindex por
+        TermDict: las claves se guardan ordenadas y con front coding, ocupan menos memoria y
+        las busquedas por prefijo (termino*) no necesitan el indice permuterm (ver get_prefix).
+        Guarda en self.metrics['dictionary'] la memoria de los terminos antes y despues.
+
+        """
+        memory = self.metrics['dictionary'] = {}
+        for name in self.compact_atribs:
+            if name == 'index' and self.tagged:
+                #las vistas de los campos leen de self.tindex, basta con comprimirlo a el
+                before = dict_memory(self.tindex)
+                self.tindex = TermDict(self.tindex)
+                memory['tindex'] = [before, dict_memory(self.tindex)]
+                continue
+            indexes = getattr(self, name)
+            if self.multifield:
+                fields = [field for field, tokenize in self.fields if tokenize and field in indexes]
+            else:
+                fields = [None]
+            before = after = 0
+            done = {} #los indices compartidos entre campos (ver share_fields) se comprimen una vez
+            for field in fields:
+                index = indexes[field] if field is not None else indexes
+                if id(index) in done:
+                    indexes[field] = done[id(index)]
+                    continue
+                before += dict_memory(index)
+                compact = done[id(index)] = TermDict(index)
+                after += dict_memory(compact)
+                if field is not None:
+                    indexes[field] = compact
+                else:
+                    setattr(self, name, compact)
+            memory[name] = [before, after]
+
+    def make_bitmaps(self):
+        """
+
+        Guarda como bitmap las posting list de los terminos que aparecen en al menos
+        self.BITMAP_DENSITY de los artículos. El bitmap es un entero de python en el que
+        el bit artid vale 1 si el artículo contiene el termino: ocupa len(self.articles)/8 bytes
+        y los AND, OR y NOT entre bitmaps se hacen palabra a palabra (ver and_posting, or_posting
+        y minus_posting). El resto de terminos siguen siendo listas ordenadas.
+
+        """
+        min_df = max(1, math.ceil(len(self.articles) * self.BITMAP_DENSITY))
+        if self.multifield:
+            indexes = [self.index[field] for field, tokenize in self.fields if tokenize]
+        else:
+            indexes = [self.index]
+        for index in indexes:
+            for term, pl in index.items():
+                if not isinstance(pl, int) and len(pl) >= min_df:
+                    index[term] = self.list_to_bitmap(pl)
+
     def show_stats(self):#Luis José Ferrer Estellés
         """
         NECESARIO PARA TODAS LAS VERSIONES
@@ -439,23 +2093,117 @@ class SAR_Indexer:
         #si esta activado el uso de stemming mostramos el numero de stems
         if self.stemming:
             print("----------------------------------------")
-            print("STEMS")
-            #si es multifield mostramos el numero de stems en cada campo
+            print("STEMS")
+            #si es multifield mostramos el numero de stems en cada campo
+            if self.multifield:
+                for field in self.fields:
+                    if field[1]:
+                        print("# of stems in '" + field[0] + "': " + str(len(self.sindex[field[0]])))
+            else:
+                print("# of stems: " + str(len(self.sindex)))
+        #si esta activado el uso de permuterm mostramos el numero de permuterms
+        if self.permuterm:
+            print("----------------------------------------")
+            print("PERMUTERMS")
+            #si es multifield mostramos el numero de permuterms en cada campo
+            if self.multifield:
+                for field in self.fields:
+                    if field[1]:
+                        print("# of permuterms in '" + field[0] + "': " + str(len(self.ptindex[field[0]])))
+            else:
+                print("# of permuterms: " + str(len(self.ptindex)))
+        #si esta activada la opcion suffix comparamos la memoria del suffix array con la del permuterm
+        if self.suffix and 'wildcards' in self.metrics:
+            print("----------------------------------------")
+            print("SUFFIX ARRAY")
+            rotations, permuterm, measured = self.metrics['wildcards']['permuterm']
+            suffixes, suffix = self.metrics['wildcards']['suffix array']
+            print(f"# of suffixes: {suffixes}")
+            print(f"permuterm: {rotations} rotations, {permuterm / 2**20:.1f} MB" + ("" if measured else " (estimated)"))
+            print(f"suffix array: {suffix / 2**20:.1f} MB")
+        #si esta activada la opcion biword mostramos los biwords que quedan despues de podar y su memoria
+        if self.biword and 'biwords' in self.metrics:
+            biwords = self.metrics['biwords']
+            print("----------------------------------------")
+            print("BIWORDS")
+            print(f"# of biwords: {biwords['kept']} of {biwords['total']} (df >= {biwords['min_df']})")
+            print(f"# of biword postings: {biwords['postings']}")
+            print(f"biword index: {biwords['memory'] / 2**20:.1f} MB")
+        #si se han descartado artículos casi duplicados mostramos cuantos y lo que se ha ahorrado en el indice
+        if 'duplicates' in self.metrics:
+            duplicates = self.metrics['duplicates']
+            print("----------------------------------------")
+            print("NEAR DUPLICATES")
+            print(f"# of skipped articles: {duplicates['articles']} of {duplicates['articles'] + len(self.articles)}")
+            print(f"# of postings saved: {duplicates['postings']}"
+                  f" (~{duplicates['postings'] * self.RUN_POSTING_BYTES / 2**20:.1f} MB)")
+        #si esta activada la opcion unaccent mostramos el numero de terminos sin acentos
+        if self.unaccent:
+            print("----------------------------------------")
+            print("UNACCENTED")
+            if self.multifield:
+                for field in self.fields:
+                    if field[1]:
+                        print("# of unaccented terms in '" + field[0] + "': " + str(len(self.nindex[field[0]])))
+            else:
+                print("# of unaccented terms: " + str(len(self.nindex)))
+        #si esta activada la opcion fuzzy mostramos el tamaño del indice de borrados
+        if self.fuzzy:
+            print("----------------------------------------")
+            print("FUZZY")
             if self.multifield:
                 for field in self.fields:
-                    print("# of stems in '" + field[0] + "': " + str(len(self.sindex[field[0]])))
+                    if field[1]:
+                        print("# of deletes in '" + field[0] + "': " + str(len(self.fzindex[field[0]])))
             else:
-                print("# of stems: " + str(len(self.sindex)))
-        #si esta activado el uso de permuterm mostramos el numero de permuterms
-        if self.permuterm:
+                print("# of deletes: " + str(len(self.fzindex)))
+        #si esta activada la opcion compact mostramos la memoria de los terminos antes y despues del front coding
+        if self.compact and 'dictionary' in self.metrics:
             print("----------------------------------------")
-            print("PERMUTERMS")
-            #si es multifield mostramos el numero de permuterms en cada campo
+            print("DICTIONARY")
+            for name, (before, after) in self.metrics['dictionary'].items():
+                if before > 0:
+                    print(f"terms in '{name}': {before / 2**20:.1f} MB --> {after / 2**20:.1f} MB (front coding)")
+        #si esta activada la opcion bitmap mostramos cuantas posting list son bitmaps
+        if self.bitmap:
+            print("----------------------------------------")
+            print("BITMAPS")
+            #si el indice se ha escrito mezclando trozos los bitmaps se han contado al escribirlos
+            bitmaps = self.metrics.get('bitmaps')
             if self.multifield:
                 for field in self.fields:
-                    print("# of permuterms in '" + field[0] + "': " + str(len(self.ptindex[field[0]])))
+                    if field[1]:
+                        n = bitmaps.get(field[0], 0) if bitmaps is not None else sum(isinstance(pl, int) for pl in self.index[field[0]].values())
+                        print("# of bitmaps in '" + field[0] + "': " + str(n))
             else:
-                print("# of permuterms: " + str(len(self.ptindex)))
+                n = bitmaps.get('', 0) if bitmaps is not None else sum(isinstance(pl, int) for pl in self.index.values())
+                print("# of bitmaps: " + str(n))
+
+    def show_metrics(self):
+        """
+        Muestra el tiempo de cada fase de la indexacion y el pico de memoria del proceso
+        """
+        print("----------------------------------------")
+        print("PHASES")
+        for phase, seconds in self.metrics['phases'].items():
+            print(f"{phase}: {seconds:.2f}s")
+        print("----------------------------------------")
+        peak = peak_memory()
+        print("Peak memory: " + (f"{peak / 2**20:.1f} MB" if peak is not None else "not available"))
+
+    def get_metrics(self) -> Dict:
+        """
+        Devuelve las metricas de la indexacion en un diccionario serializable como json:
+        tiempo de cada fase, ficheros, lineas y artículos indexados, pico de memoria (None si no se puede medir)
+        y tamaño de los indices
+        """
+        metrics = dict(self.metrics, phases=dict(self.metrics['phases']))
+        metrics['peak_memory'] = peak_memory()
+        if self.multifield:
+            metrics['terms'] = {field: len(self.index[field]) for field, _ in self.fields}
+        else:
+            metrics['terms'] = len(self.index)
+        return metrics
 
     #################################
     ###                           ###
@@ -469,7 +2217,7 @@ class SAR_Indexer:
     ###                             ###
     ###################################
 
-    def solve_query(self, query:str, prev:Dict={}): #Ricardo Díaz, David Oltra y Diana Bachynska
+    def solve_query(self, query:str, prev:Dict={}, tracer:Optional[QueryTracer]=None): #Ricardo Díaz, David Oltra y Diana Bachynska
         """
         NECESARIO PARA TODAS LAS VERSIONES
 
@@ -479,6 +2227,7 @@ class SAR_Indexer:
 
         param:  "query": cadena con la query
                 "prev": incluido por si se quiere hacer una version recursiva. No es necesario utilizarlo.
+                "tracer": para medir la consulta al explicarla (ver explain_query)
 
 
         return: posting list con el resultado de la query
@@ -487,71 +2236,357 @@ class SAR_Indexer:
         #########################################
         ## COMPLETADO PARA TODAS LAS VERSIONES ##
         #########################################
+        self.start_query()
+        tree = self.parse_query(query)
+        res = self.eval_query(tree, tracer)
+        if isinstance(res, int):
+            return self.bitmap_to_list(res)
+        #un solo termino es la posting list del indice (ver lookup_posting), los operadores dan listas nuevas
+        return list(res) if tree is not None and tree[0] == 'term' else res
+
+    def parse_query(self, query:Union[str, List[str]]): #Ricardo Díaz, David Oltra y Diana Bachynska
+        """
+        Construye el arbol de operadores de una query.
+        El operador que se aplica el ultimo es el penultimo token, asi que los operadores
+        se agrupan de izquierda a derecha y un NOT solo afecta al termino que le sigue.
+
+        param:  "query": cadena con la query o lista con sus tokens
+
+        return: None si la query esta vacia, si no una tupla:
+                    ('term', token), ('not', nodo), ('and', nodo, nodo), ('or', nodo, nodo)
+                    o ('invalid',) si la query no esta bien formada
+
+        """
         if query is None or len(query) == 0:
-            return []
+            return None
         if isinstance(query, str):
-            if '*' in query or '?' in query or ':' in query:
-                tokens = self.permtokenizer.sub(' ', query.lower()).split()
-            else:
-                tokens = self.tokenize(query)   #tokenizamos la query
+            tokens = self.tokenize_query(query)   #tokenizamos la query
         else:
             tokens = query
 
         if len(tokens) == 1:  #si solo hay un token en la query
+            return ('term', tokens[0])
+        opi = len(tokens) - 2  #el penúltimo token de la query es un operador
+        op = tokens[opi]
+        preop = tokens[:opi]  #los tokens anteriores al operador
+        postop = tokens[opi+1:] #los tokens posteriores al operador
+        if op == 'not':
+            if opi == 0: #el NOT está al principio de la query
+                return ('not', self.parse_query(postop))
+            opi -= 1 #el verdadero operador es el que hay antes, y del después haremos el NOT
+            op = tokens[opi] #actualizamos el operador
+            preop = tokens[:opi] #actualizamos los tokens anteriores al operador
+            if op == 'and' or op == 'or':
+                return (op, self.parse_query(preop), ('not', self.parse_query(postop)))
+        elif op == 'and' or op == 'or':
+            return (op, self.parse_query(preop), self.parse_query(postop))
+        return ('invalid',)
+
+    def eval_query(self, node:Optional[tuple], tracer:Optional[QueryTracer]=None):
+        """
+        Evalua un arbol de operadores construido por parse_query.
+        Con "tracer" (ver explain_query) guarda el tamaño del resultado y el tiempo de cada nodo.
+
+        param:  "node": nodo del arbol
+                "tracer": QueryTracer de la consulta que se esta explicando, None si no se explica
+
+        return: posting list con el resultado del nodo
+
+        """
+        if tracer is None:
+            return self._eval_node(node, None)
+        parent = tracer.nodes
+        info = {'op': 'empty' if node is None else node[0], 'children': []}
+        if node is not None and node[0] == 'term':
+            info['term'] = node[1]
+        elif node is not None and node[0] == 'and' and node[2] is not None and node[2][0] == 'not':
+            info['op'] = 'and not'
+        parent.append(info)
+        tracer.nodes = info['children']
+        t0 = time.perf_counter()
+        try:
+            res = self._eval_node(node, tracer)
+        finally:
+            tracer.nodes = parent
+        info['time_ms'] = (time.perf_counter() - t0) * 1000
+        info['size'] = self.posting_len(res) if res is not None else None
+        return res
+
+    def _eval_node(self, node:Optional[tuple], tracer:Optional[QueryTracer]):
+        """
+        Calcula la posting list de un nodo del arbol de parse_query, ver eval_query.
+        """
+        if node is None:
+            return []
+        op = node[0]
+        if op == 'term':
+            if tracer is None:
+                return self.lookup_posting(node[1])  #devolvemos la posting list del token
+            return tracer.call('lookup_posting', self.lookup_posting, node[1], None, tracer)
+        elif op == 'not':
+            return self.reverse_posting(self.eval_query(node[1], tracer))  #devolvemos la NOT del resto (sea un token o una query)
+        elif op == 'and':
+            if node[2] is not None and node[2][0] == 'not':
+                return self.minus_posting(self.eval_query(node[1], tracer), self.eval_query(node[2][1], tracer))  #devolvemos la resta de las dos posting list
+            return self.and_posting(self.eval_query(node[1], tracer), self.eval_query(node[2], tracer)) #devolvemos la AND de las dos posting list
+        elif op == 'or':
+            return self.or_posting(self.eval_query(node[1], tracer), self.eval_query(node[2], tracer)) #devolvemos la OR de las dos posting list
+        return None
+
+    def make_cursor(self, node:Optional[tuple]) -> Optional[QueryCursor]:
+        """
+        Construye los cursores de un arbol de parse_query (ver QueryCursor).
+        Solo se leen las posting list de los terminos, los AND, OR y NOT se resuelven
+        a medida que se piden artid. Los NOT son respecto a los artid de 1 a len(self.articles).
+
+        param:  "node": nodo del arbol
+
+        return: cursor con el resultado del nodo o None si la query no esta bien formada
+
+        """
+        if node is None:
+            return PostingCursor([])
+        op = node[0]
+        if op == 'term':
+            return PostingCursor(self.lookup_posting(node[1]))
+        elif op == 'not':
+            child = self.make_cursor(node[1])
+            return NotCursor(child, len(self.articles)) if child is not None else None
+        elif op == 'and' or op == 'or':
+            left, right = self.make_cursor(node[1]), self.make_cursor(node[2])
+            if left is None or right is None:
+                return None
+            #los AND (y los OR) seguidos son un solo cursor con todos sus operandos
+            cls = AndCursor if op == 'and' else OrCursor
+            children = []
+            for child in (left, right):
+                children.extend(child.children if type(child) is cls else [child])
+            return cls(children)
+        return None
+
+    def iter_query(self, query:str, n:Optional[int]=None):
+        """
+        Genera en orden los artid del resultado de una query, parando despues de "n".
+        Los primeros n resultados cuestan O(n) saltos en las posting list de los terminos
+        en lugar de calcular el resultado entero como solve_query.
+
+        param:  "query": cadena con la query
+                "n": numero maximo de resultados, None para todos
+
+        """
+        self.start_query()
+        cursor = self.make_cursor(self.parse_query(query))
+        if cursor is None:
+            return
+        found = 0
+        while n is None or found < n:
+            doc = cursor.next()
+            if doc == cursor.END:
+                return
+            yield doc
+            found += 1
+
+    def solve_top(self, query:str, n:int) -> List[int]:
+        """
+        Devuelve los "n" primeros artid del resultado de una query (ver iter_query)
+        """
+        return list(self.iter_query(query, n))
+
+    def solve_page(self, query:str, n:int) -> tuple:
+        """
+        Devuelve los "n" primeros artid del resultado de una query y el numero total de resultados
+        con una sola pasada de los cursores: despues de los n primeros el resto solo se cuenta (ver QueryCursor.rest).
+
+        return: tupla (lista de artid, numero de resultados)
+        """
+        self.start_query()
+        cursor = self.make_cursor(self.parse_query(query))
+        if cursor is None:
+            return [], 0
+        sol = []
+        while len(sol) < n:
+            doc = cursor.next()
+            if doc == cursor.END:
+                return sol, len(sol)
+            sol.append(doc)
+        return sol, n + cursor.rest()
+
+    def count_query(self, query:str) -> int:
+        """
+        Devuelve el numero de resultados de una query sin construir ninguna posting list intermedia:
+        se cuentan los artid de los cursores del arbol (ver QueryCursor.rest). Un termino es la longitud
+        de su posting list, NOT x es len(self.articles) menos los de x y los AND y OR de posting list
+        se cuentan recorriendo la mas corta. 0 si la query no esta bien formada.
+        """
+        self.start_query()
+        cursor = self.make_cursor(self.parse_query(query))
+        return cursor.rest() if cursor is not None else 0
+
+    def start_query(self):
+        """
+        Empieza el presupuesto de una consulta (ver set_budget) y vacia self.truncated
+        """
+        self.truncated = []
+        if self.max_terms is None and self.max_postings is None and self.query_timeout is None:
+            self._budget = None
+            return
+        self._budget = {'terms': self.max_terms, 'postings': self.max_postings,
+                        'deadline': time.perf_counter() + self.query_timeout if self.query_timeout is not None else None}
+
+    def expand_posting(self, term:str, postings, field:Optional[str]=None):
+        """
+
+        Devuelve la union de las posting list de los terminos en los que se expande "term"
+        (comodines, stemming, ~, sin acentos) gastando el presupuesto de la consulta (ver set_budget).
+        Cuando se agota, la expansion se queda con los terminos anteriores y se añade a self.truncated
+        un diccionario con el termino, el motivo ('terms', 'postings' o 'timeout') y los terminos expandidos.
+
+        param:  "term": termino de la consulta
+                "postings": posting list de los terminos expandidos, en orden de preferencia (ver budget_order)
+                (las None no cuentan); se piden de una en una y se dejan de pedir al agotar el presupuesto
+                "field": campo del termino, solo para identificarlo en self.truncated
+
+        return: posting list
+
+        """
+        budget = self._budget
+        pls = []
+        reason = None
+        for pl in postings:
+            if pl is None:
+                continue
+            if budget is not None:
+                size = self.posting_len(pl)
+                if budget['terms'] is not None and budget['terms'] <= 0:
+                    reason = 'terms'
+                elif budget['postings'] is not None and size > budget['postings']:
+                    reason = 'postings'
+                elif budget['deadline'] is not None and time.perf_counter() > budget['deadline']:
+                    reason = 'timeout'
+                if reason is not None:
+                    break
+                if budget['terms'] is not None:
+                    budget['terms'] -= 1
+                if budget['postings'] is not None:
+                    budget['postings'] -= size
+            pls.append(pl)
+        if reason is not None:
+            self.truncated.append({'term': f'{field}:{term}' if field not in (None, self.def_field) else term,
+                                   'reason': reason, 'expanded': len(pls)})
+        return self.merge_postings(pls)
+
+    def budget_order(self, terms):
+        """
+        Con presupuesto, los terminos de una expansion en orden lexicografico: asi la expansion cortada
+        no depende del orden en que se indexaron los artículos (es la misma en todos los shards).
+        Sin presupuesto se expanden todos y se devuelven tal cual, sin recorrerlos.
+        """
+        return sorted(terms) if self._budget is not None else terms
 
-            return self.get_posting(tokens[0])  #devolvemos la posting list del token
+    def merge_postings(self, pls:List) -> Union[int, List[int]]:
+        """
+        OR de varias posting list a la vez. Las listas se juntan con un set y se ordenan, en lugar de
+        hacer el OR de dos en dos (que recorre el resultado acumulado por cada lista) o mezclarlas con
+        heapq.merge; los bitmaps se juntan con | y al final con el resto.
+        """
+        lists = [pl for pl in pls if not isinstance(pl, int)]
+        if len(lists) == 0:
+            res = []
+        elif len(lists) == 1:
+            res = list(lists[0]) #la lista puede ser la del indice
         else:
-            opi = len(tokens) - 2  #el penúltimo token de la query es un operador
-            op = tokens[opi]
-            preop = tokens[:opi]  #los tokens anteriores al operador
-            postop = tokens[opi+1:] #los tokens posteriores al operador
-            if op == 'not':
-                if opi == 0: #el NOT está al principio de la query
-                    return self.reverse_posting(self.solve_query(postop))  #devolvemos la NOT del resto (sea un token o una query)
-                else:
-                    opi -= 1 #el verdadero operador es el que hay antes, y del después haremos la reverse_posting
-                    op = tokens[opi] #actualizamos el operador
-                    preop = tokens[:opi] #actualizamos los tokens anteriores al operador
-                    if op == 'and':
-                        return self.minus_posting(self.solve_query(preop), self.solve_query(postop))  #devolvemos la resta de las dos posting list
-                    elif op == 'or':
-                        return self.or_posting(self.solve_query(preop), self.reverse_posting(self.solve_query(postop))) #devolvemos la OR de la posting list de la izquierda y la reverse_posting de la derecha
-            elif op == 'and': 
-                return self.and_posting(self.solve_query(preop), self.solve_query(postop)) #devolvemos la AND de las dos posting list
-            elif op == 'or':
-                return self.or_posting(self.solve_query(preop), self.solve_query(postop)) #devolvemos la OR de las dos posting list
+            res = sorted(set(chain.from_iterable(lists)))
+        if len(lists) < len(pls):
+            bitmap = 0
+            for pl in pls:
+                if isinstance(pl, int):
+                    bitmap |= pl
+            res = self.or_posting(bitmap, res)
+        return res
 
-        
+    def tokenize_query(self, query:str) -> List[str]:
+        """
+        Tokeniza una consulta. Si tiene comodines, campos o busquedas aproximadas se usa
+        'self.permtokenizer' para conservar '*', '?', ':' y '~'. Los terminos del campo url se dejan enteros.
+        Cada frase entre comillas (con su campo delante, p.ej. summary:"todo el mundo") es un solo token
+        con sus terminos separados por espacios (ver get_phrase).
+
+        params: 'query': consulta a tokenizar
+
+        return: lista de tokens
+        """
+        if '"' in query:
+            tokens = []
+            for i, part in enumerate(self.phrasere.split(query)):
+                if i % 2 == 1: #las posiciones impares son las frases
+                    prefix, _, phrase = part.partition('"')
+                    terms = self.tokenize(phrase)
+                    if len(terms) > 0:
+                        tokens.append(prefix.lower() + ' '.join(terms))
+                else:
+                    tokens.extend(self.tokenize_query(part.replace('"', ' ')))
+            return tokens
+        if '*' in query or '?' in query or ':' in query or '~' in query:
+            tokenizer = self.permtokenizer
+        else:
+            tokenizer = self.tokenizer
+        tokens = []
+        for part in query.lower().split():
+            if part.startswith('url:'):
+                tokens.append(part)
+            else:
+                tokens.extend(tokenizer.sub(' ', part).split())
+        return tokens
 
     def get_field(self, cadena:str): #Ricardo Díaz y David Oltra
-        tokens = cadena.split(':') #separamos el token del campo
+        tokens = cadena.split(':', 1) #separamos el token del campo
         if len(tokens) == 1:
             return tokens[0], self.def_field #si no hay campo, devolvemos el token y el campo por defecto
         else:
             return tokens[1], tokens[0] #si hay campo, devolvemos el token y el campo
         
-    def get_posting(self, term:str, field:Optional[str]=None): #Ricardo Díaz y David Oltra
+    def get_posting(self, term:str, field:Optional[str]=None):
+        """
+
+        Devuelve la posting list asociada a un termino (ver lookup_posting). Las listas
+        son copias, se pueden modificar sin cambiar el indice.
+
+        param:  "term": termino del que se debe recuperar la posting list.
+                "field": campo sobre el que se debe recuperar la posting list, solo necesario si se hace la ampliacion de multiples indices
+
+        return: posting list
+
+        NECESARIO PARA TODAS LAS VERSIONES
+
+        """
+        pl = self.lookup_posting(term, field)
+        return list(pl) if isinstance(pl, list) else pl
+
+    def lookup_posting(self, term:str, field:Optional[str]=None, tracer:Optional[QueryTracer]=None): #Ricardo Díaz y David Oltra
         """
 
-        Devuelve la posting list asociada a un termino. 
-        Dependiendo de las ampliaciones implementadas "get_posting" puede llamar a:
+        Devuelve la posting list asociada a un termino, sin copiarla: puede ser la lista guardada
+        en el indice, que no se debe modificar (solve_query y get_posting devuelven copias).
+        Dependiendo de las ampliaciones implementadas "lookup_posting" puede llamar a:
             - self.get_positionals: para la ampliacion de posicionales
             - self.get_permuterm: para la ampliacion de permuterms
             - self.get_stemming: para la amplaicion de stemming
+            - self.get_fuzzy: para las busquedas aproximadas (termino~ o termino~N)
+            - self.get_unaccent: para las busquedas sin acentos
 
 
         param:  "term": termino del que se debe recuperar la posting list.
                 "field": campo sobre el que se debe recuperar la posting list, solo necesario si se hace la ampliacion de multiples indices
+                "tracer": para medir cada tipo de busqueda al explicar la consulta (ver explain_query)
 
         return: posting list
-        
-        NECESARIO PARA TODAS LAS VERSIONES
 
         """
 
         #########################################
         ## COMPLETADO PARA TODAS LAS VERSIONES ##
         #########################################
+        call = tracer.call if tracer is not None else QueryTracer.untimed
         #posibles combinaciones: multifield, stemming, permuterm, multifield+stemming, stemming+permuterm
         if ':' in term:  #si hay un ':' en el token
             term, field = self.get_field(term)  #obtenemos el token y el campo
@@ -562,21 +2597,333 @@ class SAR_Indexer:
             if not bien:
                 return [] #si el campo no es correcto, devolvemos una lista vacía
         else:
-            if isinstance(self.index.get(self.def_field), dict) and field is None: #si no hay campo y el campo por defecto es un diccionario, guardamos el campo como campo por defecto
+            if isinstance(self.index.get(self.def_field), (dict, TermDict, FieldView)) and field is None: #si no hay campo y el campo por defecto es un diccionario (o un TermDict), guardamos el campo como campo por defecto
                 field = self.def_field
-        if '*' in term or '?' in term:  #si hay un comodin en el token
-            pl = self.get_permuterm(term, field)  #devolvemos la posting list del token
+        if field == 'url': #el campo url tiene su propio indice
+            pl = self.get_url_posting(term)
+
+        elif ' ' in term: #frase entre comillas
+            pl = call('get_phrase', self.get_phrase, term, field)
+
+        elif '~' in term: #busqueda aproximada
+            pl = call('get_fuzzy', self.get_fuzzy, term, field)
+
+        elif '*' in term or '?' in term:  #si hay un comodin en el token
+            pl = call('get_permuterm', self.get_permuterm, term, field)  #devolvemos la posting list del token
 
         elif self.use_stemming: #si se usa stemming
-            pl = self.get_stemming(term, field)
+            pl = call('get_stemming', self.get_stemming, term, field)
+
+        elif self.use_unaccent: #si se busca sin acentos
+            pl = self.get_unaccent(term, field)
         
         else:
             if field is not None: #si es multifield devolvemos la posting list del campo y el token
                 pl = self.index[field].get(term)  #devolvemos la posting list del token
             else:
                 pl = self.index.get(term)  #devolvemos la posting list del token
-        return sorted(pl) if pl is not None else []
+        #las posting list guardadas ya estan ordenadas, se devuelven sin copiarlas
+        return pl if pl is not None else []
+
+
+    def get_url_posting(self, url:str):
+        """
+
+        Devuelve la posting list de los articulos cuya url coincide con "url".
+        Sin comodines es una busqueda en el hash self.index['url'];
+        con comodines ('*' o '?') se buscan por prefijo en las listas ordenadas de self.uindex
+        y se comprueba el patron completo solo sobre las candidatas.
+
+        param:  "url": url o patron de url
+
+        return: posting list
+
+        """
+        urlindex = self.index.get('url')
+        if not isinstance(urlindex, dict): #sin multifield no hay campo url
+            return []
+        url = self.normalize_url(url)
+        if '*' not in url and '?' not in url:
+            return urlindex.get(url, [])
+
+        pattern = re.compile('.*'.join('.'.join(re.escape(p) for p in part.split('?')) for part in url.split('*')))
+        if url.startswith('*/'):
+            #cualquier dominio: buscamos el prefijo en las rutas
+            keys = self.uindex['paths']
+            prefix = re.split(r'[*?]', url[1:], 1)[0]
+            pos = bisect_left(keys, (prefix,))
+            candidates = []
+            while pos < len(keys) and keys[pos][0].startswith(prefix):
+                candidates.append(keys[pos][1])
+                pos += 1
+        else:
+            keys = self.uindex['urls']
+            prefix = re.split(r'[*?]', url, 1)[0]
+            pos = bisect_left(keys, prefix)
+            candidates = []
+            while pos < len(keys) and keys[pos].startswith(prefix):
+                candidates.append(keys[pos])
+                pos += 1
+
+        res = []
+        for candidate in candidates:
+            if pattern.fullmatch(candidate):
+                res.extend(urlindex[candidate])
+        res.sort() #las urls candidatas estan en orden alfabetico, no de artid
+        return res
+
+    def get_nindex(self, field:Optional[str]=None) -> Dict[str, List[str]]:
+        """
+        Devuelve el indice de terminos sin acentos del campo "field" (None sin multifield).
+        Si el indice se creo sin la opcion unaccent se construye la primera vez que se necesita.
+        """
+        if field is None:
+            if len(self.nindex) == 0 and len(self.index) > 0:
+                self.nindex = self.build_unaccent(self.index)
+            return self.nindex
+        nindex = self.nindex.get(field)
+        if nindex is None:
+            nindex = self.nindex[field] = self.build_unaccent(self.index[field])
+        return nindex
+
+    def get_unaccent(self, term:str, field:Optional[str]=None):
+        """
+
+        Devuelve la posting list de todos los terminos que sin diacriticos coinciden con "term" sin diacriticos.
+
+        param:  "term": termino
+                "field": campo sobre el que se debe recuperar la posting list, solo necesario con multifield
+
+        return: posting list
+
+        """
+        folded = fold_term(term)
+        if field is not None:
+            npindex = self.npindex.get(field, {})
+            index = self.index[field]
+        else:
+            npindex = self.npindex
+            index = self.index
+        pl = npindex.get(folded) #union precalculada
+        if pl is not None:
+            return pl
+        terms = self.get_nindex(field).get(folded)
+        if terms is None:
+            return []
+        #con tagged los terminos de self.def_field pueden no estar en el campo, index.get devuelve None
+        return self.expand_posting(term, map(index.get, self.budget_order(terms)), field)
+
+    def get_fzindex(self, field:Optional[str]=None) -> Dict[str, List[str]]:
+        """
+        Devuelve el indice de borrados del campo "field" (None sin multifield).
+        Si el indice se creo sin la opcion fuzzy se construye la primera vez que se necesita.
+        """
+        if field is None and isinstance(self.index.get(self.def_field), (dict, TermDict, FieldView)):
+            field = self.def_field
+        if field is None:
+            if len(self.fzindex) == 0 and len(self.index) > 0:
+                self.fzindex = self.build_fuzzy(self.index)
+            return self.fzindex
+        fzindex = self.fzindex.get(field)
+        if fzindex is None:
+            fzindex = self.fzindex[field] = self.build_fuzzy(self.index[field])
+        return fzindex
+
+    def get_fuzzy_terms(self, term:str, max_dist:int, field:Optional[str]=None) -> List[tuple]:
+        """
+
+        Busca en el vocabulario los terminos a distancia de edicion "max_dist" o menos de "term".
 
+        param:  "term": termino sin el operador ~
+                "max_dist": distancia maxima, como mucho self.FUZZY_MAX
+                "field": campo sobre el que se busca, solo necesario con multifield
+
+        return: lista ordenada de tuplas (distancia, termino)
+
+        """
+        max_dist = min(max_dist, self.FUZZY_MAX)
+        fzindex = self.get_fzindex(field)
+        seen = set()
+        res = []
+        for key in self.get_deletes(term, max_dist):
+            for candidate in fzindex.get(key, ()):
+                if candidate not in seen:
+                    seen.add(candidate)
+                    dist = edit_distance(term, candidate, max_dist)
+                    if dist <= max_dist:
+                        res.append((dist, candidate))
+        res.sort()
+        return res
+
+    def get_fuzzy(self, term:str, field:Optional[str]=None):
+        """
+
+        Devuelve la posting list de los terminos parecidos a "term".
+        "termino~N" busca los terminos a distancia de edicion N o menos, "termino~" a distancia self.FUZZY_MAX.
+
+        param:  "term": termino con el operador ~
+                "field": campo sobre el que se debe recuperar la posting list, solo necesario con multifield
+
+        return: posting list
+
+        """
+        term, _, dist = term.partition('~')
+        max_dist = int(dist) if dist.isdigit() else self.FUZZY_MAX
+        if field is not None:
+            getpl = self.index[field].get
+        else:
+            getpl = self.index.get
+        #los terminos mas cercanos primero, son los que se quedan si se agota el presupuesto
+        return self.expand_posting(f'{term}~{dist}', (getpl(token) for _, token in self.get_fuzzy_terms(term, max_dist, field)), field)
+
+    def get_suggestion(self, term:str, field:Optional[str]=None) -> Optional[tuple]:
+        """
+        Busca el termino del vocabulario mas parecido a "term": el de menor distancia
+        de edicion y, a igual distancia, el que aparece en mas artículos.
+
+        return: tupla (distancia, -numero de artículos, termino), la menor es la mejor; None si no hay ninguno
+        """
+        if field is None and isinstance(self.index.get(self.def_field), (dict, TermDict, FieldView)):
+            field = self.def_field
+        index = self.index[field] if field is not None else self.index
+        best = None
+        for dist, candidate in self.get_fuzzy_terms(term, self.FUZZY_MAX, field):
+            pl = index.get(candidate)
+            if pl is None:
+                continue
+            key = (dist, -self.posting_len(pl), candidate)
+            if best is None or key < best:
+                best = key
+        return best
+
+    def suggest_query(self, query:str) -> Optional[str]:
+        """
+        "Quizas quisiste decir": cambia cada termino de la consulta que no aparece en ningun
+        artículo por el termino mas parecido del vocabulario (ver get_suggestion).
+        Solo con los indices construidos con la opcion fuzzy: sin ella habria que construir
+        el indice de borrados de todo el vocabulario solo para mostrar la sugerencia.
+
+        param:  "query": consulta
+
+        return: la consulta corregida o None si no se puede corregir ningun termino
+
+        """
+        return self.apply_suggestions(*self.get_suggestions(query))
+
+    @staticmethod
+    def apply_suggestions(tokens:List[str], *suggestions:Dict[int, tuple]) -> Optional[str]:
+        """
+        Cambia en "tokens" los terminos que no estan en ninguno de los diccionarios de "suggestions"
+        (uno por indice, ver get_suggestions) por la mejor sugerencia de todos ellos.
+
+        return: la consulta corregida o None si no se puede corregir ningun termino
+        """
+        changed = False
+        for i, (prefix, _) in suggestions[0].items():
+            if not all(i in sug for sug in suggestions):
+                continue
+            keys = [sug[i][1] for sug in suggestions if sug[i][1] is not None]
+            if len(keys) > 0:
+                tokens[i] = prefix + min(keys)[2]
+                changed = True
+        return ' '.join(tokens) if changed else None
+
+    def get_suggestions(self, query:str) -> tuple:
+        """
+        Busca una sugerencia para cada termino de la consulta que no aparece en ningun artículo.
+        Sin la opcion fuzzy no busca ninguna (ver suggest_query).
+
+        return: tupla (tokens de la consulta con los operadores en mayusculas,
+                       diccionario posicion del termino --> (prefijo del campo, resultado de get_suggestion))
+        """
+        if not self.fuzzy:
+            return self.tokenize_query(query), {}
+        multifield = isinstance(self.index.get(self.def_field), (dict, TermDict, FieldView))
+        fields = [f[0] for f in self.fields if f[1]]
+        tokens = self.tokenize_query(query)
+        suggestions = {}
+        self._budget = None #comprobar los terminos de una consulta ya resuelta no gasta su presupuesto
+        for i, token in enumerate(tokens):
+            if token in ('and', 'or', 'not'):
+                tokens[i] = token.upper()
+                continue
+            if '*' in token or '?' in token or '~' in token or ' ' in token:
+                continue
+            if ':' in token:
+                term, field = self.get_field(token)
+                if not multifield or field not in fields:
+                    continue
+                prefix = field + ':'
+            else:
+                term, field, prefix = token, None, ''
+            if self.posting_len(self.lookup_posting(token)) > 0:
+                continue
+            suggestions[i] = (prefix, self.get_suggestion(term, field))
+        return tokens, suggestions
+
+    def get_phrase(self, phrase:str, field:Optional[str]=None):
+        """
+
+        Devuelve la posting list de una frase: los artículos en los que sus terminos aparecen
+        seguidos dentro de un mismo fragmento (titulo, resumen, nombre o texto de una seccion).
+        Una frase de dos terminos es un solo acceso al indice de biwords; las mas largas son el AND
+        de sus biwords y se comprueban en el texto (ver verify_phrase). Los pares podados (ver make_biwords),
+        los campos distintos de 'all' y los indices sin biwords usan el AND de los dos terminos.
+        Los terminos de la frase se buscan tal cual, sin stemming ni comodines.
+
+        param:  "phrase": terminos de la frase separados por espacios
+                "field": campo sobre el que se busca, solo necesario con multifield
+
+        return: posting list
+
+        """
+        terms = phrase.split()
+        index = self.index[field] if field is not None else self.index
+        if len(terms) == 1:
+            return index.get(terms[0]) or []
+        biwords = self.bindex if field is None or field == self.def_field else {}
+        verify = len(terms) > 2
+        res = None
+        for t1, t2 in zip(terms, terms[1:]):
+            pl = biwords.get(t1 + ' ' + t2)
+            if pl is None:
+                pl = self.and_posting(index.get(t1) or [], index.get(t2) or [])
+                verify = True
+            res = pl if res is None else self.and_posting(res, pl)
+        if isinstance(res, int):
+            res = self.bitmap_to_list(res)
+        if verify and len(res) > 0:
+            res = self.verify_phrase(res, terms, field)
+        return res
+
+    def verify_phrase(self, artids:List[int], terms:List[str], field:Optional[str]=None) -> List[int]:
+        """
+        Se queda con los artículos de "artids" que contienen los terminos seguidos en un mismo fragmento
+        del campo "field" (None o 'all': cualquier fragmento). Cada fichero se lee una sola vez y
+        solo hasta el ultimo artículo que hay que comprobar.
+        """
+        lines = {}
+        for artid in artids:
+            docid, line = self.articles[artid]
+            lines.setdefault(docid, {})[line] = artid
+        n = len(terms)
+        res = []
+        for docid, wanted in lines.items():
+            with open(self.docs[docid], 'rb') as fh:
+                for i, raw in enumerate(islice(fh, max(wanted) + 1)):
+                    self.bytes_read += len(raw)
+                    if i not in wanted:
+                        continue
+                    article = self.decode_article(raw.decode('utf-8'))
+                    for seg_field, text in self.get_segments(article):
+                        if field is not None and field != self.def_field and seg_field != field:
+                            continue
+                        tokens = self.termre.findall(text.lower())
+                        if any(tokens[k:k + n] == terms for k in range(len(tokens) - n + 1) if tokens[k] == terms[0]):
+                            res.append(wanted[i])
+                            break
+        res.sort()
+        return res
 
     def get_positionals(self, terms:str, index):
         """
@@ -622,13 +2969,8 @@ class SAR_Indexer:
             stems = self.sindex.get(stem)
             getpl = self.index.get
 
-        if stems is not None: #si hay stems
-            res = []
-            for token in stems: #para cada token en los stems, conseguimos su posting list y la sumamos si no se repite
-                pl = getpl(token)
-                if pl is not None:
-                    res = res + [x for x in pl if x not in res]
-            return res
+        if stems is not None: #si hay stems, unimos las posting list de sus terminos
+            return self.expand_posting(term, map(getpl, self.budget_order(stems)), field)
         else:
             return []
              
@@ -655,40 +2997,55 @@ class SAR_Indexer:
         elif '*' in term: #si hay un '*' en el token la palabra puede ser más larga
             largo = True
 
+        index = self.index[field] if field is not None else self.index
+        #con el diccionario de terminos comprimido los prefijos se buscan en el propio diccionario
+        compact = isinstance(index.postings if isinstance(index, FieldView) else index, TermDict)
+        if compact and term.find('*') == len(term) - 1 and '?' not in term:
+            return self.get_prefix(term[:-1], field)
+
         if '*' in term or '?' in term: #si hay un comodin en el token
-            term = term.replace('*', ' ')
-            term = term.replace('?', ' ')
-            perm = term.split() #quitamos el comodín y separamos el token en dos partes
-            if len(perm) == 2: #si hay solo un comodín todo bien
-                perm = perm[1] + '$' + perm[0]
+            parts = re.split(r'[*?]', term) #quitamos el comodín y separamos el token en dos partes (que pueden estar vacias)
+            if len(parts) == 2: #si hay solo un comodín todo bien
+                perm = parts[1] + '$' + parts[0]
             else: #si hay más de un comodín, devolvemos una lista vacía
                 return []
+        getpl = index.get #obtenemos la posting list
 
-        if field is not None: #si es multifield
-            keys = self.ptindex[field].keys() #obtenemos las claves del campo
-            getterm = self.ptindex[field].get #obtenemos el get del campo
-            getpl = self.index[field].get #obtenemos la posting list del campo
-        else: #si no es multifield
-            keys = self.ptindex.keys() #obtenemos las claves
-            getterm = self.ptindex.get #obtenemos el get
-            getpl = self.index.get #obtenemos la posting list
-
-        terms = []
-        if keys is not None: #si hay claves (permuterms completos)
-            for key in keys:
-                #si la clave empieza por el permuterm y tiene la longitud adecuada, la añadimos a la lista de términos si no se repite
-                if key.startswith(perm) and ((not largo and (len(key) == len(perm) + 1)) or largo) and key not in terms:
-                    terms += getterm(key)
-
-        if terms is not None and len(terms) > 0: #si hay términos
-            res = []
-            for token in terms:
-                pl = getpl(token) #obtenemos la posting list del token
-                if pl is not None:
-                    res = res + [x for x in pl if x not in res] #añadimos a res los elementos de la posting list que no se repiten
-            return res
+        if self.suffix: #con el suffix array los terminos se buscan en el vocabulario concatenado
+            saindex = self.saindex[field] if field is not None else self.saindex
+            terms = saindex.wildcard(parts[0], parts[1], not largo)
         else:
-            return []
+            if field is not None: #si es multifield
+                ptindex = self.ptindex[field] #obtenemos el indice permuterm del campo
+            else: #si no es multifield
+                ptindex = self.ptindex
+
+            if isinstance(ptindex, TermDict): #el diccionario comprimido se recorre solo desde el permuterm
+                keys = ptindex.prefix_items(perm)
+            else:
+                keys = ((key, val) for key, val in ptindex.items() if key.startswith(perm))
+
+            #terminos de las claves con la longitud adecuada, se generan a medida que expand_posting
+            #pide sus posting list y el recorrido se corta si se agota el presupuesto de la consulta
+            terms = (token for key, val in keys if largo or len(key) == len(perm) + 1 for token in val)
+
+        #unimos las posting list de los terminos
+        return self.expand_posting(term, map(getpl, self.budget_order(terms)), field)
+
+    def get_prefix(self, prefix:str, field:Optional[str]=None):
+        """
+
+        Devuelve la posting list de los terminos que empiezan por "prefix"
+        recorriendo el diccionario de terminos comprimido (ver TermDict.prefix_items).
+
+        param:  "prefix": prefijo, sin el comodin
+                "field": campo sobre el que se debe recuperar la posting list, solo necesario con multifield
+
+        return: posting list
+
+        """
+        index = self.index[field] if field is not None else self.index
+        return self.expand_posting(prefix + '*', (pl for _, pl in index.prefix_items(prefix)), field)
 
     def reverse_posting(self, p): #Diana Bachynska
         """
@@ -703,6 +3060,11 @@ class SAR_Indexer:
         ##  COMPLETADO  ##
         ##################
 
+        if isinstance(p, int): #NOT de un bitmap: complemento respecto al bitmap de todos los artículos
+            if self._all_bitmap is None:
+                self._all_bitmap = self.list_to_bitmap(list(self.articles.keys()))
+            return self._all_bitmap & ~p
+
         # Obtener todos los documentos en el índice
         all_arts = list(self.articles.keys())
         # Utilizar el método minus_posting para obtener todos los documentos excepto los que están en p
@@ -724,12 +3086,17 @@ class SAR_Indexer:
         ##  COMPLETADO  ##
         ##################
 
+        if isinstance(p1, int) or isinstance(p2, int):
+            return self.and_bitmap(p1, p2)
+
         res  = []
         i1 = 0
         i2 = 0
 
         if p1 == [] or p2 == []:  #si las dos posting list están vacias, devuelvo una lista vacía
             return []
+        if len(p1) + len(p2) >= self.NUMPY_MIN_SIZE and self.get_numpy() is not None:
+            return self.numpy_posting('and', p1, p2)
         
         while i1 < len(p1) and i2 < len(p2): #mientras no llegue al final de p1 y al final de p2
             if  p1[i1] == p2[i2]:  #si p1 y p2 contienen el mismo documento
@@ -759,14 +3126,19 @@ class SAR_Indexer:
         ##  COMPLETADO  ##
         ##################
 
+        if isinstance(p1, int) or isinstance(p2, int): #OR palabra a palabra
+            return self.list_to_bitmap(p1) | self.list_to_bitmap(p2)
+
         res  = []
         i1 = 0
         i2 = 0
 
-        if p1 == [] and p2 != []: #si p1 está vacía y p2 no, devuelvo p2
-            return p2
-        if p2 == [] and p1 != []: #si p2 está vacía y p1 no, devuelvo p1
-            return p1
+        if p1 == [] and p2 != []: #si p1 está vacía y p2 no, devuelvo una copia de p2 (puede ser la del indice)
+            return list(p2)
+        if p2 == [] and p1 != []: #si p2 está vacía y p1 no, devuelvo una copia de p1
+            return list(p1)
+        if len(p1) + len(p2) >= self.NUMPY_MIN_SIZE and self.get_numpy() is not None:
+            return self.numpy_posting('or', p1, p2)
         
         while i1 < len(p1) and i2 < len(p2): #mientras no llegue al final de p1 y al final de p2
             if  p1[i1] == p2[i2]:  #si p1 y p2 contienen el mismo documento
@@ -809,6 +3181,13 @@ class SAR_Indexer:
         ##  COMPLETADO  ##
         #################
 
+        if isinstance(p1, int): #except palabra a palabra
+            return p1 & ~self.list_to_bitmap(p2)
+        if isinstance(p2, int):
+            return self.and_bitmap(p1, p2, negate=True)
+        if len(p1) > 0 and len(p2) > 0 and len(p1) + len(p2) >= self.NUMPY_MIN_SIZE and self.get_numpy() is not None:
+            return self.numpy_posting('minus', p1, p2)
+
         res  = []
         i1 = 0
         i2 = 0
@@ -828,6 +3207,109 @@ class SAR_Indexer:
         
         return res
 
+    def get_numpy(self):
+        """
+        Devuelve el modulo numpy, o None si no esta instalado.
+        Se importa la primera vez que se usa para no pagarlo en las consultas pequeñas.
+        """
+        if self._numpy is None:
+            try:
+                import numpy
+                self._numpy = numpy
+            except ImportError:
+                self._numpy = False
+        return self._numpy or None
+
+    def numpy_posting(self, op:str, p1:list, p2:list) -> List[int]:
+        """
+        Calcula AND, OR o except de dos posting list ordenadas y sin repetidos con numpy.
+        Devuelve lo mismo que and_posting, or_posting y minus_posting, pero sin el bucle
+        elemento a elemento en python.
+
+        param:  "op": 'and', 'or' o 'minus'
+                "p1", "p2": posting lists sobre las que calcular
+
+        return: posting list resultado
+        """
+        np = self._numpy
+        a1 = np.asarray(p1)
+        a2 = np.asarray(p2)
+        if op == 'and':
+            if len(a1) > len(a2):
+                a1, a2 = a2, a1
+            if len(a1) * 16 < len(a2):
+                #listas muy desiguales: buscamos cada artid de la corta en la larga
+                pos = np.searchsorted(a2, a1)
+                found = pos < len(a2)
+                found[found] = a2[pos[found]] == a1[found]
+                return a1[found].tolist()
+            return np.intersect1d(a1, a2, assume_unique=True).tolist()
+        elif op == 'or':
+            #las dos listas ya estan ordenadas: el sort estable solo las mezcla, y quitamos los repetidos
+            merged = np.concatenate((a1, a2))
+            merged.sort(kind='stable')
+            keep = np.empty(len(merged), dtype=bool)
+            keep[0] = True
+            np.not_equal(merged[1:], merged[:-1], out=keep[1:])
+            return merged[keep].tolist()
+        return np.setdiff1d(a1, a2, assume_unique=True).tolist()
+
+    def list_to_bitmap(self, p):
+        """
+        Convierte una posting list en bitmap (ver make_bitmaps). Si ya es un bitmap la devuelve tal cual.
+
+        param:  "p": posting list
+
+        return: bitmap con los artid de p
+        """
+        if isinstance(p, int):
+            return p
+        if len(p) == 0:
+            return 0
+        bits = bytearray((max(p) >> 3) + 1)
+        for artid in p:
+            bits[artid >> 3] |= 1 << (artid & 7)
+        return int.from_bytes(bits, 'little')
+
+    def bitmap_to_list(self, p:int) -> List[int]:
+        """
+        Convierte un bitmap en una posting list ordenada.
+
+        param:  "p": bitmap
+
+        return: posting list con los artid de p
+        """
+        #bin() deja el bit 0 al final, le damos la vuelta para que la posicion de cada '1' sea su artid
+        return [m.start() for m in self.onesre.finditer(bin(p)[:1:-1])]
+
+    def and_bitmap(self, p1, p2, negate:bool=False) -> Union[int, List[int]]:
+        """
+        Calcula el AND de dos posting list cuando al menos una es un bitmap.
+        Si las dos son bitmaps el resultado es un bitmap, si no es una lista.
+
+        param:  "p1", "p2": posting lists sobre las que calcular
+                "negate": si es True calcula p1 AND NOT p2 (p2 debe ser un bitmap)
+
+        return: posting list con los artid incluidos en p1 y p2 (o en p1 y no en p2)
+        """
+        if isinstance(p1, int) and isinstance(p2, int):
+            return p1 & ~p2 if negate else p1 & p2
+        if isinstance(p1, int):
+            p1, p2 = p2, p1
+        if len(p1) == 0:
+            return []
+        #miramos el bit de cada artid de la lista en los bytes del bitmap
+        bits = p2.to_bytes((max(p2.bit_length(), p1[-1] + 1) + 7) // 8, 'little')
+        if negate:
+            return [x for x in p1 if not bits[x >> 3] >> (x & 7) & 1]
+        return [x for x in p1 if bits[x >> 3] >> (x & 7) & 1]
+
+    def posting_len(self, p) -> int:
+        """
+        Devuelve el numero de artículos de una posting list, sea una lista o un bitmap
+        """
+        return p.bit_count() if isinstance(p, int) else len(p)
+
     #####################################
     ###                               ###
     ### PARTE 2.2: MOSTRAR RESULTADOS ###
@@ -838,10 +3320,11 @@ class SAR_Indexer:
         results = []
         for query in ql:
             if len(query) > 0 and query[0] != '#':
-                r = self.solve_query(query)
-                results.append(len(r))
+                r = self.count_query(query) #contamos sin construir la posting list del resultado
+                results.append(r)
                 if verbose:
-                    print(f'{query}\t{len(r)}')
+                    print(f'{query}\t{r}')
+                    self.show_truncated()
             else:
                 results.append(0)
                 if verbose:
@@ -849,31 +3332,102 @@ class SAR_Indexer:
         return results
 
 
-    def solve_and_test(self, ql:List[str]) -> bool:
+    def show_truncated(self):
+        """Muestra las expansiones de la ultima consulta cortadas por el presupuesto (ver expand_posting)"""
+        for cut in self.truncated:
+            print(f"Truncated: '{cut['term']}' expanded to {cut['expanded']} terms ({self.TRUNCATED_REASONS[cut['reason']]})")
+
+    def solve_and_test(self, ql:List[str], explain:bool=False) -> bool:
+        """
+        Comprueba el numero de resultados de cada query de "ql" (lineas query<TAB>resultados).
+        Cada query se resuelve entera con solve_query y se comprueba tambien que count_query,
+        que solo recorre los cursores, cuenta lo mismo.
+        Con "explain" cada query se resuelve con explain_query como la opcion -E (ver check_explain).
+        """
         errors = False
         for line in ql:
             if len(line) > 0 and line[0] != '#':
                 query, ref = line.split('\t')
                 reference = int(ref)
-                result = len(self.solve_query(query))
-                if reference == result:
+                if explain:
+                    result, problem = self.check_explain(query)
+                else:
+                    result, problem = self.check_count(query)
+                if reference == result and problem is None:
                     print(f'{query}\t{result}')
+                elif problem is not None:
+                    print(f'>>>>{query}\t{"EXPLAIN: " if explain else ""}{problem}<<<<')
+                    errors = True
                 else:
                     print(f'>>>>{query}\t{reference} != {result}<<<<')
                     errors = True
+                self.show_truncated()
 
             else:
                 print(line)
 
         return not errors
 
-    def solve_and_show(self, query:str): #Ricardo Díaz y David Oltra
+    def check_count(self, query:str) -> tuple:
+        """
+        Resuelve una query con solve_query y la cuenta con count_query.
+
+        return: tupla (numero de resultados de solve_query, descripcion de la diferencia o None)
+        """
+        count = self.count_query(query)
+        res = self.solve_query(query)
+        result = len(res) if res is not None else 0
+        return result, None if count == result else f"count_query {count} != solve_query {result}"
+
+    def check_explain(self, query:str) -> tuple:
+        """
+        Resuelve una query con explain_query mostrando los resultados (sin imprimirlos) y comprueba
+        que el arbol tiene un nodo por cada operador y termino de la query, que la raiz tiene tantos
+        artículos como resultados y que cada termino se ha buscado una sola vez.
+
+        return: tupla (numero de resultados, descripcion del problema o None)
+        """
+        with redirect_stdout(io.StringIO()):
+            info = self.explain_query(query, show=True)
+        expected = []
+        def walk(node):
+            if node is None or node[0] not in ('and', 'or', 'not', 'term'):
+                return
+            if node[0] == 'term':
+                expected.append(node[1])
+                return
+            expected.append(node[0])
+            for child in node[1:]:
+                #eval_query junta x AND NOT y en un solo nodo 'and not'
+                walk(child[1] if node[0] == 'and' and child is node[2] and child is not None and child[0] == 'not' else child)
+        walk(self.parse_query(query))
+        traced = []
+        def walk_trace(info_node):
+            traced.append(info_node['term'] if 'term' in info_node else info_node['op'].split()[0])
+            for child in info_node['children']:
+                walk_trace(child)
+        if info['tree'] is not None:
+            walk_trace(info['tree'])
+        results = info['results']
+        if len(expected) > 0 and traced != expected:
+            return results, f"tree {traced} != {expected}"
+        if info['tree'] is not None and info['tree']['size'] != results:
+            return results, f"root size {info['tree']['size']} != {results}"
+        terms = sum(1 for node in expected if node not in ('and', 'or', 'not'))
+        #sin resultados "Did you mean" vuelve a buscar los terminos
+        calls = info['lookups']['lookup_posting']['calls']
+        if results > 0 and calls != terms:
+            return results, f"{calls} lookup_posting calls for {terms} terms"
+        return results, None
+
+    def solve_and_show(self, query:str, tracer:Optional[QueryTracer]=None): #Ricardo Díaz y David Oltra
         """
         NECESARIO PARA TODAS LAS VERSIONES
 
         Resuelve una consulta y la muestra junto al numero de resultados 
 
         param:  "query": query que se debe resolver.
+                "tracer": para medir la consulta al explicarla (ver explain_query)
 
         return: el numero de artículo recuperadas, para la opcion -T
 
@@ -881,17 +3435,87 @@ class SAR_Indexer:
         ##################
         ##  COMPLETADO  ##
         ##################
-        sol = self.solve_query(query) #resolvemos la query
+        if self.show_all or tracer is not None: #resolvemos la query entera, tambien al explicarla (ver explain_query)
+            sol = self.solve_query(query, tracer=tracer)
+            if sol is None:
+                sol = []
+            total = len(sol)
+            if not self.show_all:
+                sol = sol[:self.SHOW_MAX]
+        else: #solo guardamos los self.SHOW_MAX primeros resultados, el resto se cuenta en la misma pasada
+            sol, total = self.solve_page(query, self.SHOW_MAX)
         print("========================================")
         i = 1
         for artid in sol: #para cada articulo en la posting list
-            docid, linea = self.articles[artid] #obtenemos el docid y la linea
-            doc = self.docs[docid] #obtenemos el documento
-            with open(doc) as fh: #abrimos el documento
-                dic = self.parse_article(fh.readlines()[linea]) #parseamos el articulo
-            print(f"# {i:02d} {dic['title']}: {dic['url']}") #mostramos el titulo y la url
+            dic = self.read_article(artid) #leemos y parseamos el articulo
+            dups = self.duplicates.get(artid) #artículos casi iguales que no se han indexado (ver skip_duplicate)
+            print(f"# {i:02d} {dic['title']}: {dic['url']}" + (f" (+{len(dups)} near duplicates)" if dups else "")) #mostramos el titulo y la url
             i+=1
         print("========================================")
-        print(f"Number of results: {len(sol)}")
+        print(f"Number of results: {total}")
+        self.show_truncated()
+        if total == 0: #si no hay resultados proponemos una consulta corregida
+            suggestion = self.suggest_query(query)
+            if suggestion is not None:
+                print(f"Did you mean: {suggestion}?")
+
+        return total
+
+    def explain_query(self, query:str, show:bool=False) -> Dict:
+        """
+        Resuelve una consulta guardando donde se va el tiempo.
+
+        param:  "query": query que se debe resolver.
+                "show": si es True se muestran los resultados con solve_and_show
+
+        return: diccionario con
+                    'query': la consulta
+                    'results': numero de artículos recuperados
+                    'tree': arbol de operadores, cada nodo con 'op', 'size' (tamaño de su posting list),
+                            'time_ms', 'children' y 'term' en las hojas
+                    'lookups': por cada metodo de busqueda (lookup_posting, get_stemming, get_permuterm, get_fuzzy, get_phrase)
+                               el numero de llamadas y su tiempo total ('calls', 'time_ms')
+                    'bytes_read': bytes leidos del disco para mostrar los resultados
+                    'truncated': expansiones cortadas por el presupuesto de la consulta (ver expand_posting)
+                    'total_ms': tiempo total
+
+        """
+        #el tracer pasa por solve_query, eval_query y lookup_posting (ver QueryTracer)
+        tracer = QueryTracer()
+        bytes_read = self.bytes_read
+        t0 = time.perf_counter()
+        if show:
+            results = self.solve_and_show(query, tracer)
+        else:
+            res = self.solve_query(query, tracer=tracer)
+            results = len(res) if res is not None else None
+        return {'query': query, 'results': results, 'tree': tracer.tree,
+                'lookups': tracer.lookups, 'bytes_read': self.bytes_read - bytes_read,
+                'truncated': list(self.truncated), 'total_ms': (time.perf_counter() - t0) * 1000}
+
+    def print_explain(self, info:Dict):
+        """
+        Muestra el resultado de explain_query: el arbol de operadores con el tamaño
+        y el tiempo de cada nodo, el tiempo de cada tipo de busqueda y los bytes leidos.
 
-        return len(sol)
\ No newline at end of file
+        param:  "info": diccionario devuelto por explain_query
+
+        """
+        def show_node(node, depth):
+            name = node['op'].upper() + (' ' + node['term'] if 'term' in node else '')
+            print(f"{'  ' * depth}{name}: {node['size']} results, {node['time_ms']:.3f} ms")
+            for child in node['children']:
+                show_node(child, depth + 1)
+
+        print("----------------------------------------")
+        print(f"EXPLAIN: {info['query']}")
+        if info['tree'] is not None:
+            show_node(info['tree'], 1)
+        for name, stats in info['lookups'].items():
+            if stats['calls'] > 0:
+                print(f"{name}: {stats['calls']} calls, {stats['time_ms']:.3f} ms")
+        print(f"bytes read: {info['bytes_read']}")
+        for cut in info.get('truncated', []):
+            print(f"truncated: '{cut['term']}' expanded to {cut['expanded']} terms ({self.TRUNCATED_REASONS[cut['reason']]})")
+        print(f"total: {info['total_ms']:.3f} ms")
+        print("----------------------------------------")
\ No newline at end of file
@@ -0,0 +1,180 @@
+"""
+Recaptura condicional del crawler y archivo de páginas, contra un servidor http local.
+
+    python -m unittest discover -s tests
+"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SAR_Crawler_lib import SAR_Page_Archive, SAR_Wiki_Crawler
+
+PAGE = """<html><body>
+<h1 class="firstHeading">Casa</h1>
+<div id="bodyContent"><div id="mw-content-text">
+<p>Una casa es un edificio para vivir.</p>
+<h2>Historia</h2>
+<p>Las primeras casas eran de barro.</p>
+</div></div>
+</body></html>""".encode("utf-8")
+ETAG = '"v1"'
+# página en latin-1, que no se puede decodificar como utf-8
+LATIN_PAGE = """<html><body>
+<h1 class="firstHeading">Canción</h1>
+<div id="bodyContent"><div id="mw-content-text">
+<p>Una canción es una composición musical.</p>
+</div></div>
+</body></html>""".encode("iso-8859-1")
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    """Sirve PAGE con un ETag y responde 304 si la petición trae ese ETag"""
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("If-None-Match")))
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.send_header("ETag", ETAG)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(PAGE)))
+        self.end_headers()
+        self.wfile.write(PAGE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LatinPageHandler(BaseHTTPRequestHandler):
+    """Sirve LATIN_PAGE indicando su codificación en el Content-Type"""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=iso-8859-1")
+        self.send_header("Content-Length", str(len(LATIN_PAGE)))
+        self.end_headers()
+        self.wfile.write(LATIN_PAGE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CountingCrawler(SAR_Wiki_Crawler):
+    """Crawler que cuenta las páginas que parsea y los documentos que guarda"""
+
+    def __init__(self, base_url):
+        super().__init__(base_url)
+        self.extracted = 0
+        self.saved = 0
+
+    def extract_wikipedia_content(self, html):
+        self.extracted += 1
+        return super().extract_wikipedia_content(html)
+
+    def save_documents(self, documents, *args, **kwargs):
+        self.saved += len(documents)
+        return super().save_documents(documents, *args, **kwargs)
+
+
+class ConditionalRecrawlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), PageHandler)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def crawl(self, out_name, metadata=True):
+        crawler = CountingCrawler(self.base_url)
+        if metadata:
+            crawler.load_metadata(os.path.join(self.tmp.name, "metadata.json"))
+        crawler.start_crawling([self.base_url + "/wiki/Casa"], 10, os.path.join(self.tmp.name, out_name), None, 0)
+        return crawler
+
+    def test_local_urls_are_valid(self):
+        crawler = SAR_Wiki_Crawler(self.base_url)
+        self.assertTrue(crawler.is_valid_url(self.base_url + "/wiki/Casa"))
+        self.assertFalse(crawler.is_valid_url("https://es.wikipedia.org/wiki/Casa"))
+        self.assertEqual(crawler.asegurar_url_absoluta("/wiki/Casa"), self.base_url + "/wiki/Casa")
+
+    def test_unchanged_page_is_not_extracted_nor_saved(self):
+        first = self.crawl("first.json")
+        self.assertEqual(first.extracted, 1)
+        self.assertEqual(first.saved, 1)
+        with open(os.path.join(self.tmp.name, "first.json"), encoding="utf-8") as fh:
+            self.assertEqual(json.loads(fh.readline())["title"], "Casa")
+        with open(os.path.join(self.tmp.name, "metadata.json"), encoding="utf-8") as fh:
+            self.assertEqual(json.load(fh)[self.base_url + "/wiki/Casa"]["etag"], ETAG)
+
+        second = self.crawl("second.json")
+        # la segunda petición es condicional y el servidor responde 304
+        self.assertEqual(self.server.requests, [("/wiki/Casa", None), ("/wiki/Casa", ETAG)])
+        self.assertEqual(second.extracted, 0)
+        self.assertEqual(second.saved, 0)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, "second.json")))
+
+    def test_no_metadata_without_metadata_file(self):
+        crawler = self.crawl("out.json", metadata=False)
+        self.assertEqual(crawler.saved, 1)
+        self.assertEqual(crawler.metadata, {})
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, "metadata.json")))
+
+
+class PageArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, "pages.warc.gz")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_read_write_round_trip(self):
+        archive = SAR_Page_Archive(self.filename)
+        archive.append("http://a/wiki/Uno", PAGE, "utf-8")
+        archive.append("http://a/wiki/Dos", LATIN_PAGE, "ISO-8859-1")
+        archive.append("http://a/wiki/Uno", b"<html>v2</html>")
+        records = archive.records()
+        # de cada url queda el último registro, en el orden de la primera captura
+        self.assertEqual(list(records), ["http://a/wiki/Uno", "http://a/wiki/Dos"])
+        self.assertEqual(archive.read(*records["http://a/wiki/Dos"]), ("http://a/wiki/Dos", LATIN_PAGE, "ISO-8859-1"))
+        self.assertEqual(archive.read(*records["http://a/wiki/Uno"]), ("http://a/wiki/Uno", b"<html>v2</html>", None))
+
+    def test_extraction_uses_response_encoding(self):
+        server = HTTPServer(("127.0.0.1", 0), LatinPageHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        try:
+            crawler = SAR_Wiki_Crawler(base_url)
+            crawler.open_archive(self.filename)
+            crawler.start_crawling([base_url + "/wiki/Cancion"], 1, os.path.join(self.tmp.name, "live.json"), None, 0)
+        finally:
+            server.shutdown()
+            server.server_close()
+        SAR_Wiki_Crawler(base_url).extract_from_archive(self.filename, 10, os.path.join(self.tmp.name, "archive.json"),
+                                                        None, processes=1)
+        with open(os.path.join(self.tmp.name, "live.json"), encoding="utf-8") as fh:
+            live = json.loads(fh.readline())
+        with open(os.path.join(self.tmp.name, "archive.json"), encoding="utf-8") as fh:
+            archived = json.loads(fh.readline())
+        self.assertEqual(live["title"], "Canción")
+        self.assertEqual(archived, live)
+
+
+if __name__ == "__main__":
+    unittest.main()
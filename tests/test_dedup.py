@@ -0,0 +1,70 @@
+"""
+Huellas SimHash y búsqueda de casi duplicados de SimHashIndex.
+
+    python -m unittest discover -s tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SAR_Dedup_lib import SimHashIndex, article_terms
+
+TERMS = {f"t{i}" for i in range(200)}
+FINGERPRINT = 0x0123456789ABCDEF
+
+
+class SimHashIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        # 4 bloques de 16 bits, casi duplicados a distancia 3 o menos
+        self.index = SimHashIndex(0.95)
+
+    def test_empty_terms_have_no_fingerprint(self):
+        self.assertIsNone(self.index.fingerprint(set()))
+        self.assertIsNone(self.index.fingerprint(article_terms({"title": "", "summary": "", "sections": []})))
+
+    def test_fingerprint_of_near_duplicates(self):
+        fingerprint = self.index.fingerprint(TERMS)
+        self.assertEqual(self.index.fingerprint(set(TERMS)), fingerprint)
+        self.index.add(fingerprint, "a")
+        # cambiar un termino de 200 mueve pocos bits
+        near = self.index.fingerprint((TERMS - {"t0"}) | {"x"})
+        self.assertEqual([key for _, key in self.index.find(near)], ["a"])
+        self.assertEqual(self.index.find(self.index.fingerprint({f"u{i}" for i in range(200)})), [])
+
+    def test_find_up_to_max_dist(self):
+        self.index.add(FINGERPRINT, "a")
+        self.assertEqual(self.index.find(FINGERPRINT), [(0, "a")])
+        # un bit en tres bloques distintos: el cuarto bloque sigue siendo igual
+        self.assertEqual(self.index.find(FINGERPRINT ^ (1 | 1 << 16 | 1 << 32)), [(3, "a")])
+        self.assertEqual(self.index.find(FINGERPRINT ^ 0b1111), [])
+
+    def test_find_sorted_by_distance(self):
+        self.index.add(FINGERPRINT ^ 0b11, "b")
+        self.index.add(FINGERPRINT, "a")
+        self.index.add(FINGERPRINT ^ 0b1, "c")
+        self.assertEqual(self.index.find(FINGERPRINT), [(0, "a"), (1, "c"), (2, "b")])
+
+    def test_add_replaces_previous_fingerprint(self):
+        self.index.add(FINGERPRINT, "a")
+        self.index.add(~FINGERPRINT & (2**64 - 1), "a")
+        self.assertEqual(self.index.find(FINGERPRINT), [])
+        self.assertEqual(self.index.find(~FINGERPRINT & (2**64 - 1)), [(0, "a")])
+        self.assertEqual(len(self.index.keys), 1)
+
+    def test_remove(self):
+        self.index.add(FINGERPRINT, "a")
+        self.index.add(FINGERPRINT, "b")
+        self.index.remove("a")
+        self.assertEqual(self.index.find(FINGERPRINT), [(0, "b")])
+        self.index.remove("b")
+        self.assertEqual(self.index.find(FINGERPRINT), [])
+        self.assertEqual(self.index.tables, [{} for _ in self.index.blocks])
+        # quitar una clave que no esta no hace nada
+        self.index.remove("c")
+
+
+if __name__ == "__main__":
+    unittest.main()
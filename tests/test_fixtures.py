@@ -0,0 +1,205 @@
+"""
+Pruebas -T (tests/test_100.txt) de los índices construidos con las distintas opciones de SAR_Indexer.py.
+
+    python -m unittest discover -s tests
+"""
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from SAR_lib import SAR_Indexer, TermDict
+from SAR_Shard_lib import SAR_Sharded_Indexer
+
+CORPUS = os.path.join(ROOT, "tests", "100")
+
+
+def build_index(filename, *options, corpus=CORPUS):
+    """Construye un índice de "corpus" con SAR_Indexer.py y las opciones dadas"""
+    subprocess.run([sys.executable, os.path.join(ROOT, "SAR_Indexer.py"), *options, corpus, filename],
+                   check=True, stdout=subprocess.DEVNULL)
+
+
+def read_fixture(name):
+    """Líneas de un fichero de pruebas de tests (query<TAB>resultados)"""
+    with open(os.path.join(ROOT, "tests", name), encoding="utf-8") as fh:
+        return fh.read().split("\n")
+
+
+class IndexFixtureTest(unittest.TestCase):
+    """Construye una vez por clase un índice con OPTIONS en un directorio temporal"""
+
+    OPTIONS = ("-M", "-S", "-P")
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.index = os.path.join(cls.tmp.name, "index.bin")
+        build_index(cls.index, *cls.OPTIONS)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def load(self, filename=None):
+        searcher = SAR_Indexer()
+        searcher.load_info(filename or self.index)
+        return searcher
+
+    def assertFixture(self, searcher, fixture="test_100.txt", explain=False):
+        """Comprueba las consultas de "fixture" como la opción -T (-E -T con "explain")"""
+        out = io.StringIO()
+        with redirect_stdout(out):
+            ok = searcher.solve_and_test(read_fixture(fixture), explain)
+        self.assertTrue(ok, "\n".join(line for line in out.getvalue().split("\n") if line.startswith(">>>>")))
+
+
+class BitmapFixtureTest(IndexFixtureTest):
+
+    OPTIONS = ("-M", "-S", "-P", "-B")
+
+    def test_bitmaps(self):
+        searcher = self.load()
+        self.assertGreater(sum(isinstance(pl, int) for pl in searcher.index["all"].values()), 0)
+        self.assertFixture(searcher)
+
+    def test_bitmaps_explain(self):
+        self.assertFixture(self.load(), explain=True)
+
+
+@unittest.skipIf(SAR_Indexer().get_numpy() is None, "numpy is not installed")
+class NumpyFixtureTest(IndexFixtureTest):
+    """Las operaciones de posting list con numpy a partir de cualquier tamaño, también con bitmaps"""
+
+    OPTIONS = ("-M", "-S", "-P", "-B")
+
+    def test_numpy(self):
+        searcher = self.load()
+        searcher.NUMPY_MIN_SIZE = 0
+        self.assertFixture(searcher)
+        self.assertFixture(searcher, explain=True)
+
+
+class CompactFixtureTest(IndexFixtureTest):
+
+    OPTIONS = ("-M", "-S", "-P", "-D")
+
+    def test_compact(self):
+        searcher = self.load()
+        self.assertIsInstance(searcher.index["all"], TermDict)
+        self.assertFixture(searcher)
+
+    def test_compact_explain(self):
+        self.assertFixture(self.load(), explain=True)
+
+
+class MemoryBudgetFixtureTest(IndexFixtureTest):
+    """Índice -M -S -P construido por trozos (--memory-budget 1 --runs-dir)"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.index = os.path.join(cls.tmp.name, "index.bin")
+        cls.runs_dir = os.path.join(cls.tmp.name, "runs")
+        os.mkdir(cls.runs_dir)
+        indexer = SAR_Indexer()
+        indexer.index_dir(CORPUS, multifield=True, positional=False, stem=True, permuterm=True,
+                          memory_budget=1, runs_dir=cls.runs_dir)
+        cls.runs = len(indexer._runs)
+        indexer.save_info(cls.index)
+
+    def test_memory_budget(self):
+        self.assertGreater(self.runs, 1)
+        # los trozos se borran al mezclarlos
+        self.assertEqual(os.listdir(self.runs_dir), [])
+        self.assertFixture(self.load())
+
+    def test_memory_budget_explain(self):
+        self.assertFixture(self.load(), explain=True)
+
+
+class TaggedFixtureTest(IndexFixtureTest):
+
+    OPTIONS = ("-M", "-S", "-P", "-G")
+
+    def test_tagged(self):
+        searcher = self.load()
+        self.assertTrue(searcher.tagged)
+        self.assertFixture(searcher)
+
+    def test_tagged_explain(self):
+        self.assertFixture(self.load(), explain=True)
+
+
+class DedupFixtureTest(IndexFixtureTest):
+    """
+    tests/100 tiene artículos repetidos con otra url: con --dedup el resultado de cada consulta
+    es el del índice completo sin los artículos descartados.
+    """
+
+    OPTIONS = ("-M", "-S", "-P", "--dedup", "0.95")
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.full_index = os.path.join(cls.tmp.name, "full.bin")
+        build_index(cls.full_index, "-M", "-S", "-P")
+
+    def test_dedup(self):
+        full = self.load(self.full_index)
+        searcher = self.load()
+        urls = {}
+        for index in (full, searcher):
+            urls[index] = {artid: index.read_article(artid)["url"] for artid in index.articles}
+        skipped = {url for urls in searcher.duplicates.values() for url in urls}
+        self.assertGreater(len(skipped), 0)
+        self.assertEqual(len(searcher.articles) + len(skipped), len(full.articles))
+        self.assertFixture(full)
+        for line in read_fixture("test_100.txt"):
+            if len(line) > 0 and line[0] != "#":
+                query = line.split("\t")[0]
+                res = {urls[searcher][artid] for artid in searcher.solve_query(query)}
+                self.assertEqual(res, {urls[full][artid] for artid in full.solve_query(query)} - skipped, query)
+
+
+class ShardsFixtureTest(IndexFixtureTest):
+    """Índice -M -S -P repartido en 3 shards (--shards 3), comparado con el índice sin repartir"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.shards_index = os.path.join(cls.tmp.name, "shards.bin")
+        build_index(cls.shards_index, "-M", "-S", "-P", "--shards", "3")
+        cls.searcher = SAR_Sharded_Indexer()
+        cls.searcher.load_info(cls.shards_index)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.searcher.close()
+        super().tearDownClass()
+
+    def test_shards(self):
+        self.assertEqual(len(self.searcher.conns), 3)
+        self.assertFixture(self.searcher)
+
+    def test_shards_explain(self):
+        self.assertFixture(self.searcher, explain=True)
+
+    def test_shards_top_results(self):
+        full = self.load()
+        for line in read_fixture("test_100.txt"):
+            if len(line) > 0 and line[0] != "#":
+                query = line.split("\t")[0]
+                for n in (1, 10, 1000):
+                    self.assertEqual(self.searcher.solve_page(query, n), full.solve_page(query, n), query)
+                    self.assertEqual(self.searcher.solve_top(query, n), full.solve_top(query, n), query)
+
+
+if __name__ == "__main__":
+    unittest.main()